@@ -14,6 +14,11 @@ from detectron2.utils.video_visualizer import VideoVisualizer
 from detectron2.utils.visualizer import ColorMode, Visualizer
 
 
+def _sem_seg_labels(sem_seg):
+    # "sem_seg" is either KxHxW scores or, with the "label_map" output, HxW class ids
+    return sem_seg.argmax(dim=0) if sem_seg.dim() == 3 else sem_seg.long()
+
+
 class VisualizationDemo(object):
     def __init__(self, cfg, instance_mode=ColorMode.IMAGE, parallel=False):
         """
@@ -58,7 +63,7 @@ class VisualizationDemo(object):
         else:
             if "sem_seg" in predictions:
                 vis_output = visualizer.draw_sem_seg(
-                    predictions["sem_seg"].argmax(dim=0).to(self.cpu_device)
+                    _sem_seg_labels(predictions["sem_seg"]).to(self.cpu_device)
                 )
             if "instances" in predictions:
                 instances = predictions["instances"].to(self.cpu_device)
@@ -97,7 +102,7 @@ class VisualizationDemo(object):
                 vis_frame = video_visualizer.draw_instance_predictions(frame, predictions)
             elif "sem_seg" in predictions:
                 vis_frame = video_visualizer.draw_sem_seg(
-                    frame, predictions["sem_seg"].argmax(dim=0).to(self.cpu_device)
+                    frame, _sem_seg_labels(predictions["sem_seg"]).to(self.cpu_device)
                 )
 
             # Converts Matplotlib RGB format to OpenCV BGR format
@@ -21,6 +21,9 @@ from .data.dataset_mappers.mask_former_semantic_dataset_mapper import (
 # models
 from .maskformer_model import MaskFormer
 from .test_time_augmentation import SemanticSegmentorWithTTA
+from .tiled_inference import MaskFormerWithTiling
+from .bucketed_inference import BucketedInferenceLoader, BucketedPredictor
 
 # evaluation
 from .evaluation.instance_evaluation import InstanceSegEvaluator
+from .evaluation.sem_seg_evaluation import LabelMapCityscapesSemSegEvaluator, LabelMapSemSegEvaluator
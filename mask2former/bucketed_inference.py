@@ -0,0 +1,243 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import bisect
+import logging
+import math
+
+import numpy as np
+import torch
+
+import detectron2.data.transforms as T
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.modeling import build_model
+from detectron2.utils.logger import log_every_n_seconds
+
+
+__all__ = [
+    "BucketedInferenceLoader",
+    "BucketedPredictor",
+    "PaddingStats",
+    "get_bucket_key",
+]
+
+
+def get_bucket_key(image_size, aspect_ratio_boundaries, size_boundaries):
+    """
+    Args:
+        image_size (tuple): (height, width) of the model input
+        aspect_ratio_boundaries (list[float]): sorted height/width ratios between buckets
+        size_boundaries (list[int]): sorted longest-side lengths between buckets
+    Returns:
+        tuple: (aspect ratio bucket, size bucket). Images of the same bucket have similar
+            shapes, so batching them together needs little padding.
+    """
+    height, width = image_size
+    return (
+        bisect.bisect_right(aspect_ratio_boundaries, height / width),
+        bisect.bisect_right(size_boundaries, max(height, width)),
+    )
+
+
+def padded_fraction(image_sizes, size_divisibility=0):
+    """
+    Fraction of the pixels of a batch that are padding, once padded by
+    :meth:`ImageList.from_tensors` to the largest height and width of the batch.
+    """
+    max_height = max(h for h, _ in image_sizes)
+    max_width = max(w for _, w in image_sizes)
+    if size_divisibility > 1:
+        max_height = int(math.ceil(max_height / size_divisibility) * size_divisibility)
+        max_width = int(math.ceil(max_width / size_divisibility) * size_divisibility)
+    total = len(image_sizes) * max_height * max_width
+    return 1.0 - sum(h * w for h, w in image_sizes) / total
+
+
+class PaddingStats(object):
+    """
+    Record the padded-pixel fraction of every batch, along with the fraction the same
+    images would have had if batched in arrival order, and periodically log both.
+    """
+
+    def __init__(self, size_divisibility=0, log_period=30.0):
+        self.size_divisibility = size_divisibility
+        self.log_period = log_period
+        # one (padded fraction, number of pixels after padding) per batch
+        self.batches = []
+        self.unbucketed_batches = []
+
+    def _add(self, batches, image_sizes):
+        fraction = padded_fraction(image_sizes, self.size_divisibility)
+        total = sum(h * w for h, w in image_sizes) / (1.0 - fraction)
+        batches.append((fraction, total))
+
+    def add_batch(self, image_sizes):
+        self._add(self.batches, image_sizes)
+
+    def add_unbucketed_batch(self, image_sizes):
+        self._add(self.unbucketed_batches, image_sizes)
+
+    @staticmethod
+    def _overall(batches):
+        # pixel-weighted, i.e. the fraction of the backbone input that is padding
+        total = sum(t for _, t in batches)
+        return sum(f * t for f, t in batches) / max(total, 1)
+
+    def summary(self):
+        """
+        Returns:
+            dict: the number of batches and the overall padded-pixel fraction with
+                and without bucketing.
+        """
+        return {
+            "num_batches": len(self.batches),
+            "padded_fraction": self._overall(self.batches),
+            "unbucketed_padded_fraction": self._overall(self.unbucketed_batches),
+        }
+
+    def log(self):
+        summary = self.summary()
+        log_every_n_seconds(
+            logging.INFO,
+            "Bucketed batching: {} batches, {:.1%} padded pixels ({:.1%} without bucketing)".format(
+                summary["num_batches"], summary["padded_fraction"], summary["unbucketed_padded_fraction"]
+            ),
+            n=self.log_period,
+        )
+
+
+class BucketedInferenceLoader(object):
+    """
+    Regroup the inputs of an inference data loader into batches of images of similar
+    aspect ratio and size, see :func:`get_bucket_key`. A batch is yielded as soon as its
+    bucket is full; partial buckets are yielded once the loader is exhausted. The
+    order of the inputs is not preserved.
+    """
+
+    def __init__(
+        self,
+        data_loader,
+        batch_size,
+        aspect_ratio_boundaries=(1.0,),
+        size_boundaries=(),
+        size_divisibility=0,
+    ):
+        """
+        Args:
+            data_loader: iterable over lists of dataset dicts with an "image" field,
+                e.g. from :func:`build_detection_test_loader`
+            batch_size (int): maximum number of images per batch
+            aspect_ratio_boundaries, size_boundaries: see :func:`get_bucket_key`
+            size_divisibility (int): the size divisibility of the model, used to compute
+                the padded-pixel fraction of every batch
+        """
+        self.data_loader = data_loader
+        self.batch_size = batch_size
+        self.aspect_ratio_boundaries = sorted(aspect_ratio_boundaries)
+        self.size_boundaries = sorted(size_boundaries)
+        self.stats = PaddingStats(size_divisibility)
+
+    def __len__(self):
+        # only an estimate, used for progress logging: the number of batches depends on the
+        # bucket of every image. The sampler holds the images of this worker only; it is
+        # wrapped in the batch sampler whether the loader was given a sampler or a batch sampler.
+        return int(math.ceil(len(self.data_loader.batch_sampler.sampler) / self.batch_size))
+
+    def _yield(self, batch):
+        self.stats.add_batch([tuple(x["image"].shape[-2:]) for x in batch])
+        self.stats.log()
+        return batch
+
+    def __iter__(self):
+        buckets = {}
+        arrival = []
+        for inputs in self.data_loader:
+            for x in inputs:
+                arrival.append(tuple(x["image"].shape[-2:]))
+                if len(arrival) == self.batch_size:
+                    self.stats.add_unbucketed_batch(arrival)
+                    arrival = []
+
+                key = get_bucket_key(x["image"].shape[-2:], self.aspect_ratio_boundaries, self.size_boundaries)
+                bucket = buckets.setdefault(key, [])
+                bucket.append(x)
+                if len(bucket) == self.batch_size:
+                    yield self._yield(buckets.pop(key))
+        if arrival:
+            self.stats.add_unbucketed_batch(arrival)
+        for bucket in buckets.values():
+            yield self._yield(bucket)
+
+
+class BucketedPredictor(object):
+    """
+    A :class:`DefaultPredictor` that takes a list of images, groups them into batches of
+    similar aspect ratio and size (see :func:`get_bucket_key`) and runs the model once per
+    batch. The padded-pixel fraction of every batch is recorded in `self.stats`.
+
+    Configured by `cfg.DATALOADER.TEST_BATCH_SIZE`, `cfg.DATALOADER.TEST_ASPECT_RATIO_BOUNDARIES`
+    and `cfg.DATALOADER.TEST_SIZE_BOUNDARIES`.
+
+    Examples:
+    ::
+        pred = BucketedPredictor(cfg)
+        outputs = pred([cv2.imread(f) for f in files])
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg.clone()  # cfg can be modified by model
+        self.model = build_model(self.cfg)
+        self.model.eval()
+
+        checkpointer = DetectionCheckpointer(self.model)
+        checkpointer.load(cfg.MODEL.WEIGHTS)
+
+        self.aug = T.ResizeShortestEdge(
+            [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
+        )
+
+        self.input_format = cfg.INPUT.FORMAT
+        assert self.input_format in ["RGB", "BGR"], self.input_format
+
+        self.batch_size = cfg.DATALOADER.TEST_BATCH_SIZE
+        self.aspect_ratio_boundaries = sorted(cfg.DATALOADER.TEST_ASPECT_RATIO_BOUNDARIES)
+        self.size_boundaries = sorted(cfg.DATALOADER.TEST_SIZE_BOUNDARIES)
+        self.stats = PaddingStats(self.model.size_divisibility)
+
+    def _preprocess(self, original_image):
+        if self.input_format == "RGB":
+            # whether the model expects BGR inputs or RGB
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = self.aug.get_transform(original_image).apply_image(original_image)
+        image = torch.as_tensor(np.ascontiguousarray(image.astype("float32").transpose(2, 0, 1)))
+        return {"image": image, "height": height, "width": width}
+
+    def __call__(self, original_images):
+        """
+        Args:
+            original_images (list[np.ndarray]): images of shape (H, W, C) (in BGR order).
+
+        Returns:
+            list[dict]: the output of the model for every image, in the input order.
+        """
+        with torch.no_grad():  # https://github.com/sphinx-doc/sphinx/issues/4258
+            inputs = [self._preprocess(image) for image in original_images]
+
+            for start in range(0, len(inputs), self.batch_size):
+                self.stats.add_unbucketed_batch(
+                    [tuple(x["image"].shape[-2:]) for x in inputs[start : start + self.batch_size]]
+                )
+
+            buckets = {}
+            for i, x in enumerate(inputs):
+                key = get_bucket_key(x["image"].shape[-2:], self.aspect_ratio_boundaries, self.size_boundaries)
+                buckets.setdefault(key, []).append(i)
+
+            predictions = [None] * len(inputs)
+            for indices in buckets.values():
+                for start in range(0, len(indices), self.batch_size):
+                    batch = indices[start : start + self.batch_size]
+                    self.stats.add_batch([tuple(inputs[i]["image"].shape[-2:]) for i in batch])
+                    for i, prediction in zip(batch, self.model([inputs[i] for i in batch])):
+                        predictions[i] = prediction
+            self.stats.log()
+            return predictions
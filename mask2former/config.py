@@ -18,6 +18,17 @@ def add_maskformer2_config(cfg):
     cfg.INPUT.CROP.SINGLE_CATEGORY_MAX_AREA = 1.0
     # Pad image and segmentation GT in dataset mapper.
     cfg.INPUT.SIZE_DIVISIBILITY = -1
+    # Downsample the gt masks by this factor in the training dataset mappers, e.g. 4 for targets at
+    # the resolution of the predicted masks. Should divide the size divisibility of the model.
+    cfg.INPUT.MASK_DOWNSAMPLE = 1
+    # "area": binary masks of the cells covered at least half, "soft": float16 covered fractions.
+    cfg.INPUT.MASK_DOWNSAMPLE_MODE = "area"
+
+    # inference batching: with a batch size > 1, test loaders and BucketedPredictor group images
+    # into buckets of similar aspect ratio (height / width) and longest side, to limit padding
+    cfg.DATALOADER.TEST_BATCH_SIZE = 1
+    cfg.DATALOADER.TEST_ASPECT_RATIO_BOUNDARIES = [0.8, 1.25]
+    cfg.DATALOADER.TEST_SIZE_BOUNDARIES = []
 
     # solver config
     # weight decay on embedding
@@ -43,6 +54,10 @@ def add_maskformer2_config(cfg):
     cfg.MODEL.MASK_FORMER.ENC_LAYERS = 0
     cfg.MODEL.MASK_FORMER.DEC_LAYERS = 6
     cfg.MODEL.MASK_FORMER.PRE_NORM = False
+    # Attention of the masked transformer decoder layers: "native", or "sdpa" for
+    # torch.nn.functional.scaled_dot_product_attention (PyTorch >= 2.0, falls back to "native").
+    # Both use the weights of the nn.MultiheadAttention modules, checkpoints are compatible.
+    cfg.MODEL.MASK_FORMER.ATTENTION_BACKEND = "native"
 
     cfg.MODEL.MASK_FORMER.HIDDEN_DIM = 256
     cfg.MODEL.MASK_FORMER.NUM_OBJECT_QUERIES = 100
@@ -58,6 +73,54 @@ def add_maskformer2_config(cfg):
     cfg.MODEL.MASK_FORMER.TEST.OBJECT_MASK_THRESHOLD = 0.0
     cfg.MODEL.MASK_FORMER.TEST.OVERLAP_THRESHOLD = 0.0
     cfg.MODEL.MASK_FORMER.TEST.SEM_SEG_POSTPROCESSING_BEFORE_INFERENCE = False
+    # run post-processing once per group of same-sized images instead of once per image; faster,
+    # but holds the mask probabilities of the whole group, about twice the memory of the logits
+    cfg.MODEL.MASK_FORMER.TEST.BATCHED_POSTPROCESSING = False
+    # semantic output: "logits" (dense KxHxW scores) or "label_map" (HxW class ids, computed
+    # in chunks of SEMANTIC_CHUNK_SIZE classes without materializing the dense scores)
+    cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_OUTPUT = "logits"
+    # with "label_map" output, also output the top-1 score of each pixel as "sem_seg_confidence"
+    cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_CONFIDENCE = False
+    cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_CHUNK_SIZE = 64
+    # run query selection, panoptic merging and semantic merging at the resolution of the
+    # predicted masks (1/4 of the input) and upsample only the final outputs
+    cfg.MODEL.MASK_FORMER.TEST.LOW_RES_POSTPROCESSING = False
+    # before upsampling masks, drop the queries that panoptic and instance inference cannot output
+    # (has no effect when SEMANTIC_ON, since semantic inference merges all queries)
+    cfg.MODEL.MASK_FORMER.TEST.EARLY_QUERY_PRUNING = False
+    # periodically log the time of the post-processing shared by all tasks and of every task
+    cfg.MODEL.MASK_FORMER.TEST.PROFILE_POSTPROCESSING = False
+    # compute the boxes of predicted instances from their masks (all-zero boxes otherwise)
+    cfg.MODEL.MASK_FORMER.TEST.PRED_BOXES = True
+    # with LOW_RES_POSTPROCESSING, compute boxes from the low-resolution masks and rescale them
+    cfg.MODEL.MASK_FORMER.TEST.LOW_RES_PRED_BOXES = False
+    # sliding-window inference for large images (see MaskFormerWithTiling), used by train_net.py
+    # with --eval-only. Sizes are in pixels of the model input, i.e. after test-time resizing.
+    cfg.MODEL.MASK_FORMER.TEST.TILED_INFERENCE = False
+    cfg.MODEL.MASK_FORMER.TEST.TILE_SIZE = 1024
+    cfg.MODEL.MASK_FORMER.TEST.TILE_OVERLAP = 256
+    # number of tiles per forward call
+    cfg.MODEL.MASK_FORMER.TEST.TILE_BATCH_SIZE = 4
+    # decoder inference without intermediate predictions: the attention masks are computed from mask
+    # features pooled to the size of every attention level, and no "aux_outputs" are returned
+    cfg.MODEL.MASK_FORMER.TEST.POOLED_INFERENCE = False
+    # Experimental, off by default: its effect on PQ and latency has not been measured yet.
+    # decoder inference that drops the queries whose no-object probability exceeds the threshold
+    # after the given number of decoder layers, the dropped queries keep the predictions of that layer
+    cfg.MODEL.MASK_FORMER.TEST.DECODER_QUERY_PRUNING = False
+    cfg.MODEL.MASK_FORMER.TEST.DECODER_QUERY_PRUNING_THRESHOLD = 0.9
+    cfg.MODEL.MASK_FORMER.TEST.DECODER_QUERY_PRUNING_LAYER = 3
+    # Experimental, off by default: its effect on PQ and latency has not been measured yet, see
+    # EarlyExitStats for the decoder depths it reaches.
+    # decoder inference that stops once the class labels of at least EARLY_EXIT_CLASS_AGREEMENT of the
+    # queries and the masks of the object queries (mean IoU >= EARLY_EXIT_MASK_IOU) no longer change
+    # between consecutive layers, for all images of the batch. Runs at least EARLY_EXIT_MIN_LAYERS and at
+    # most EARLY_EXIT_MAX_LAYERS decoder layers (0 for all). Also used by the video decoder.
+    cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT = False
+    cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT_MIN_LAYERS = 3
+    cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT_MAX_LAYERS = 0
+    cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT_CLASS_AGREEMENT = 1.0
+    cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT_MASK_IOU = 0.95
 
     # Sometimes `backbone.size_divisibility` is set to 0 for some backbone (e.g. ResNet)
     # you can use this config to override
@@ -112,3 +175,36 @@ def add_maskformer2_config(cfg):
     # Importance sampling parameter for PointRend point sampling during training. Parametr `beta` in
     # the original paper.
     cfg.MODEL.MASK_FORMER.IMPORTANCE_SAMPLE_RATIO = 0.75
+    # Compute the point losses of all decoder layers with batched ops (see
+    # SetCriterion.get_fused_losses) instead of one loss computation per layer.
+    cfg.MODEL.MASK_FORMER.FUSED_CRITERION = False
+    # If > 0, sample the uncertain points of the mask losses on chunks of this many masks, without
+    # holding the oversampled logits of all masks (see get_uncertain_point_coords_chunked).
+    cfg.MODEL.MASK_FORMER.POINT_SAMPLING_CHUNK_SIZE = 0
+    # Which intermediate decoder layers are supervised in every iteration (see
+    # SetCriterion.select_aux_layers): "full" for all of them, "random" for
+    # DEEP_SUPERVISION_NUM_LAYERS random layers with their losses scaled to keep their expected sum,
+    # "drop_late" for all layers until DEEP_SUPERVISION_DROP_START * SOLVER.MAX_ITER and none after.
+    cfg.MODEL.MASK_FORMER.DEEP_SUPERVISION_SCHEDULE = "full"
+    cfg.MODEL.MASK_FORMER.DEEP_SUPERVISION_NUM_LAYERS = 3
+    cfg.MODEL.MASK_FORMER.DEEP_SUPERVISION_DROP_START = 0.9
+    # Log the time of the criterion and of the matcher as "time/criterion" and "time/matcher" in the
+    # event storage. Synchronizes CUDA around the timed code, which slows down training, so only enable
+    # it to profile.
+    cfg.MODEL.MASK_FORMER.PROFILE_CRITERION = False
+
+    # matcher configs
+    # Match the outputs of all decoder layers with a single batched cost computation and host transfer
+    # (see HungarianMatcher.batched_forward) instead of one matcher call per layer.
+    cfg.MODEL.MASK_FORMER.BATCHED_MATCHING = False
+    # Number of threads solving the assignment problems of batched matching, 0 to solve them serially.
+    cfg.MODEL.MASK_FORMER.MATCHER_NUM_WORKERS = 0
+    # Assignment solver of the matcher: "scipy" (on the host) or "auction" (batched, in pure torch on the
+    # device of the costs, falling back to scipy for problems it does not solve; scipy on CPU).
+    cfg.MODEL.MASK_FORMER.MATCHER_SOLVER = "scipy"
+    # Sparse matching for images with many targets: if > 0, only this many queries (the most likely
+    # for the target class) are candidates for every target, for images with at least
+    # SPARSE_MATCHING_MIN_TARGETS targets. Falls back to dense matching if no complete assignment exists.
+    # Not used by BATCHED_MATCHING.
+    cfg.MODEL.MASK_FORMER.SPARSE_MATCHING_CANDIDATES = 0
+    cfg.MODEL.MASK_FORMER.SPARSE_MATCHING_MIN_TARGETS = 50
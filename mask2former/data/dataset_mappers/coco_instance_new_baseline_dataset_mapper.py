@@ -14,6 +14,8 @@ from detectron2.structures import BitMasks, Instances
 
 from pycocotools import mask as coco_mask
 
+from ..mask_utils import downsample_masks
+
 __all__ = ["COCOInstanceNewBaselineDatasetMapper"]
 
 
@@ -89,6 +91,8 @@ class COCOInstanceNewBaselineDatasetMapper:
         *,
         tfm_gens,
         image_format,
+        mask_downsample=1,
+        mask_downsample_mode="area",
     ):
         """
         NOTE: this interface is experimental.
@@ -97,6 +101,8 @@ class COCOInstanceNewBaselineDatasetMapper:
             augmentations: a list of augmentations or deterministic transforms to apply
             tfm_gens: data augmentation
             image_format: an image format supported by :func:`detection_utils.read_image`.
+            mask_downsample: downsampling factor of the gt masks, see :func:`downsample_masks`
+            mask_downsample_mode: "area" or "soft", see :func:`downsample_masks`
         """
         self.tfm_gens = tfm_gens
         logging.getLogger(__name__).info(
@@ -105,6 +111,8 @@ class COCOInstanceNewBaselineDatasetMapper:
 
         self.img_format = image_format
         self.is_train = is_train
+        self.mask_downsample = mask_downsample
+        self.mask_downsample_mode = mask_downsample_mode
     
     @classmethod
     def from_config(cls, cfg, is_train=True):
@@ -115,6 +123,8 @@ class COCOInstanceNewBaselineDatasetMapper:
             "is_train": is_train,
             "tfm_gens": tfm_gens,
             "image_format": cfg.INPUT.FORMAT,
+            "mask_downsample": cfg.INPUT.MASK_DOWNSAMPLE,
+            "mask_downsample_mode": cfg.INPUT.MASK_DOWNSAMPLE_MODE,
         }
         return ret
 
@@ -183,7 +193,7 @@ class COCOInstanceNewBaselineDatasetMapper:
             if hasattr(instances, 'gt_masks'):
                 gt_masks = instances.gt_masks
                 gt_masks = convert_coco_poly_to_mask(gt_masks.polygons, h, w)
-                instances.gt_masks = gt_masks
+                instances.gt_masks = downsample_masks(gt_masks, self.mask_downsample, self.mask_downsample_mode)
             dataset_dict["instances"] = instances
 
         return dataset_dict
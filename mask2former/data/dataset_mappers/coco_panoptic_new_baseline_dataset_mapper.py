@@ -12,6 +12,8 @@ from detectron2.data import transforms as T
 from detectron2.data.transforms import TransformGen
 from detectron2.structures import BitMasks, Boxes, Instances
 
+from ..mask_utils import downsample_masks
+
 __all__ = ["COCOPanopticNewBaselineDatasetMapper"]
 
 
@@ -70,6 +72,8 @@ class COCOPanopticNewBaselineDatasetMapper:
         *,
         tfm_gens,
         image_format,
+        mask_downsample=1,
+        mask_downsample_mode="area",
     ):
         """
         NOTE: this interface is experimental.
@@ -79,6 +83,8 @@ class COCOPanopticNewBaselineDatasetMapper:
             crop_gen: crop augmentation
             tfm_gens: data augmentation
             image_format: an image format supported by :func:`detection_utils.read_image`.
+            mask_downsample: downsampling factor of the gt masks, see :func:`downsample_masks`
+            mask_downsample_mode: "area" or "soft", see :func:`downsample_masks`
         """
         self.tfm_gens = tfm_gens
         logging.getLogger(__name__).info(
@@ -89,6 +95,8 @@ class COCOPanopticNewBaselineDatasetMapper:
 
         self.img_format = image_format
         self.is_train = is_train
+        self.mask_downsample = mask_downsample
+        self.mask_downsample_mode = mask_downsample_mode
 
     @classmethod
     def from_config(cls, cfg, is_train=True):
@@ -99,6 +107,8 @@ class COCOPanopticNewBaselineDatasetMapper:
             "is_train": is_train,
             "tfm_gens": tfm_gens,
             "image_format": cfg.INPUT.FORMAT,
+            "mask_downsample": cfg.INPUT.MASK_DOWNSAMPLE,
+            "mask_downsample_mode": cfg.INPUT.MASK_DOWNSAMPLE_MODE,
         }
         return ret
 
@@ -159,6 +169,10 @@ class COCOPanopticNewBaselineDatasetMapper:
                 )
                 instances.gt_masks = masks.tensor
                 instances.gt_boxes = masks.get_bounding_boxes()
+            # boxes are computed at full resolution
+            instances.gt_masks = downsample_masks(
+                instances.gt_masks, self.mask_downsample, self.mask_downsample_mode
+            )
 
             dataset_dict["instances"] = instances
 
@@ -13,6 +13,8 @@ from detectron2.data import transforms as T
 from detectron2.projects.point_rend import ColorAugSSDTransform
 from detectron2.structures import BitMasks, Instances, polygons_to_bitmask
 
+from ..mask_utils import downsample_masks
+
 __all__ = ["MaskFormerInstanceDatasetMapper"]
 
 
@@ -37,6 +39,8 @@ class MaskFormerInstanceDatasetMapper:
         augmentations,
         image_format,
         size_divisibility,
+        mask_downsample=1,
+        mask_downsample_mode="area",
     ):
         """
         NOTE: this interface is experimental.
@@ -45,11 +49,15 @@ class MaskFormerInstanceDatasetMapper:
             augmentations: a list of augmentations or deterministic transforms to apply
             image_format: an image format supported by :func:`detection_utils.read_image`.
             size_divisibility: pad image size to be divisible by this value
+            mask_downsample: downsampling factor of the gt masks, see :func:`downsample_masks`
+            mask_downsample_mode: "area" or "soft", see :func:`downsample_masks`
         """
         self.is_train = is_train
         self.tfm_gens = augmentations
         self.img_format = image_format
         self.size_divisibility = size_divisibility
+        self.mask_downsample = mask_downsample
+        self.mask_downsample_mode = mask_downsample_mode
 
         logger = logging.getLogger(__name__)
         mode = "training" if is_train else "inference"
@@ -81,6 +89,8 @@ class MaskFormerInstanceDatasetMapper:
             "augmentations": augs,
             "image_format": cfg.INPUT.FORMAT,
             "size_divisibility": cfg.INPUT.SIZE_DIVISIBILITY,
+            "mask_downsample": cfg.INPUT.MASK_DOWNSAMPLE,
+            "mask_downsample_mode": cfg.INPUT.MASK_DOWNSAMPLE_MODE,
         }
         return ret
 
@@ -174,6 +184,7 @@ class MaskFormerInstanceDatasetMapper:
         else:
             masks = BitMasks(torch.stack(masks))
             instances.gt_masks = masks.tensor
+        instances.gt_masks = downsample_masks(instances.gt_masks, self.mask_downsample, self.mask_downsample_mode)
 
         dataset_dict["instances"] = instances
 
@@ -11,6 +11,7 @@ from detectron2.data import detection_utils as utils
 from detectron2.data import transforms as T
 from detectron2.structures import BitMasks, Instances
 
+from ..mask_utils import downsample_masks
 from .mask_former_semantic_dataset_mapper import MaskFormerSemanticDatasetMapper
 
 __all__ = ["MaskFormerPanopticDatasetMapper"]
@@ -38,6 +39,8 @@ class MaskFormerPanopticDatasetMapper(MaskFormerSemanticDatasetMapper):
         image_format,
         ignore_label,
         size_divisibility,
+        mask_downsample=1,
+        mask_downsample_mode="area",
     ):
         """
         NOTE: this interface is experimental.
@@ -47,6 +50,8 @@ class MaskFormerPanopticDatasetMapper(MaskFormerSemanticDatasetMapper):
             image_format: an image format supported by :func:`detection_utils.read_image`.
             ignore_label: the label that is ignored to evaluation
             size_divisibility: pad image size to be divisible by this value
+            mask_downsample: downsampling factor of the gt masks, see :func:`downsample_masks`
+            mask_downsample_mode: "area" or "soft", see :func:`downsample_masks`
         """
         super().__init__(
             is_train,
@@ -54,6 +59,8 @@ class MaskFormerPanopticDatasetMapper(MaskFormerSemanticDatasetMapper):
             image_format=image_format,
             ignore_label=ignore_label,
             size_divisibility=size_divisibility,
+            mask_downsample=mask_downsample,
+            mask_downsample_mode=mask_downsample_mode,
         )
 
     def __call__(self, dataset_dict):
@@ -159,6 +166,9 @@ class MaskFormerPanopticDatasetMapper(MaskFormerSemanticDatasetMapper):
                 torch.stack([torch.from_numpy(np.ascontiguousarray(x.copy())) for x in masks])
             )
             instances.gt_masks = masks.tensor
+        instances.gt_masks = downsample_masks(
+            instances.gt_masks, self.mask_downsample, self.mask_downsample_mode
+        )
 
         dataset_dict["instances"] = instances
 
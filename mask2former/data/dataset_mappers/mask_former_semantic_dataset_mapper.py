@@ -13,6 +13,8 @@ from detectron2.data import transforms as T
 from detectron2.projects.point_rend import ColorAugSSDTransform
 from detectron2.structures import BitMasks, Instances
 
+from ..mask_utils import downsample_masks
+
 __all__ = ["MaskFormerSemanticDatasetMapper"]
 
 
@@ -38,6 +40,8 @@ class MaskFormerSemanticDatasetMapper:
         image_format,
         ignore_label,
         size_divisibility,
+        mask_downsample=1,
+        mask_downsample_mode="area",
     ):
         """
         NOTE: this interface is experimental.
@@ -47,12 +51,16 @@ class MaskFormerSemanticDatasetMapper:
             image_format: an image format supported by :func:`detection_utils.read_image`.
             ignore_label: the label that is ignored to evaluation
             size_divisibility: pad image size to be divisible by this value
+            mask_downsample: downsampling factor of the gt masks, see :func:`downsample_masks`
+            mask_downsample_mode: "area" or "soft", see :func:`downsample_masks`
         """
         self.is_train = is_train
         self.tfm_gens = augmentations
         self.img_format = image_format
         self.ignore_label = ignore_label
         self.size_divisibility = size_divisibility
+        self.mask_downsample = mask_downsample
+        self.mask_downsample_mode = mask_downsample_mode
 
         logger = logging.getLogger(__name__)
         mode = "training" if is_train else "inference"
@@ -92,6 +100,8 @@ class MaskFormerSemanticDatasetMapper:
             "image_format": cfg.INPUT.FORMAT,
             "ignore_label": ignore_label,
             "size_divisibility": cfg.INPUT.SIZE_DIVISIBILITY,
+            "mask_downsample": cfg.INPUT.MASK_DOWNSAMPLE,
+            "mask_downsample_mode": cfg.INPUT.MASK_DOWNSAMPLE_MODE,
         }
         return ret
 
@@ -178,6 +188,9 @@ class MaskFormerSemanticDatasetMapper:
                     torch.stack([torch.from_numpy(np.ascontiguousarray(x.copy())) for x in masks])
                 )
                 instances.gt_masks = masks.tensor
+            instances.gt_masks = downsample_masks(
+                instances.gt_masks, self.mask_downsample, self.mask_downsample_mode
+            )
 
             dataset_dict["instances"] = instances
 
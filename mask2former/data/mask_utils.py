@@ -0,0 +1,39 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import torch
+from torch.nn import functional as F
+
+__all__ = ["downsample_masks"]
+
+
+def downsample_masks(masks, factor, mode="area", chunk_size=16):
+    """
+    Downsample binary gt masks by an integer factor, to train with targets at a lower
+    resolution than the images (see `INPUT.MASK_DOWNSAMPLE`).
+
+    Masks are padded with zeros to a multiple of `factor` and every output pixel covers a
+    `factor` x `factor` cell of the input, so the outputs stay aligned with the images padded
+    to a multiple of `factor`.
+
+    Args:
+        masks (Tensor): (N, H, W) binary masks, of any dtype
+        factor (int): downsampling factor, 1 to return `masks` unchanged
+        mode (str): "area" for bool masks of the cells covered at least half by the mask, which
+            preserves the mask areas on average, or "soft" for float16 masks of the fraction of
+            every cell covered by the mask
+        chunk_size (int): number of masks converted to float at a time
+    Returns:
+        Tensor: (N, ceil(H / factor), ceil(W / factor)) masks
+    """
+    assert mode in ["area", "soft"], mode
+    if factor == 1:
+        return masks
+    N, H, W = masks.shape
+    h, w = -(-H // factor), -(-W // factor)
+    coverage = torch.zeros((N, h, w), dtype=torch.float32)
+    for start in range(0, N, chunk_size):
+        chunk = masks[start : start + chunk_size, None].to(torch.float32)
+        chunk = F.pad(chunk, (0, w * factor - W, 0, h * factor - H))
+        coverage[start : start + chunk_size] = F.avg_pool2d(chunk, factor)[:, 0]
+    if mode == "area":
+        return coverage >= 0.5
+    return coverage.half()
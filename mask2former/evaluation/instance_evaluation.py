@@ -25,6 +25,8 @@ from detectron2.structures import Boxes, BoxMode, pairwise_iou
 from detectron2.utils.file_io import PathManager
 from detectron2.utils.logger import create_small_table
 
+from ..utils.misc import id_lookup_table
+
 
 # modified from COCOEvaluator for instance segmetnat
 class InstanceSegEvaluator(COCOEvaluator):
@@ -55,19 +57,18 @@ class InstanceSegEvaluator(COCOEvaluator):
             # num_classes = len(all_contiguous_ids)
             # assert min(all_contiguous_ids) == 0 and max(all_contiguous_ids) == num_classes - 1
 
-            reverse_id_mapping = {v: k for k, v in dataset_id_to_contiguous_id.items()}
-            for result in coco_results:
-                category_id = result["category_id"]
-                # assert category_id < num_classes, (
-                #     f"A prediction has class={category_id}, "
-                #     f"but the dataset only has {num_classes} classes and "
-                #     f"predicted class id should be in [0, {num_classes - 1}]."
-                # )
-                assert category_id in reverse_id_mapping, (
-                    f"A prediction has class={category_id}, "
-                    f"but the dataset only has class ids in {dataset_id_to_contiguous_id}."
-                )
-                result["category_id"] = reverse_id_mapping[category_id]
+            reverse_id_table = id_lookup_table({v: k for k, v in dataset_id_to_contiguous_id.items()})
+            category_ids = np.fromiter(
+                (result["category_id"] for result in coco_results), dtype=np.int64, count=len(coco_results)
+            )
+            valid = (category_ids >= 0) & (category_ids < len(reverse_id_table))
+            valid[valid] = reverse_id_table[category_ids[valid]] >= 0
+            assert valid.all(), (
+                f"A prediction has class={category_ids[~valid][0]}, "
+                f"but the dataset only has class ids in {dataset_id_to_contiguous_id}."
+            )
+            for result, category_id in zip(coco_results, reverse_id_table[category_ids].tolist()):
+                result["category_id"] = category_id
 
         if self._output_dir:
             file_path = os.path.join(self._output_dir, "coco_instances_results.json")
@@ -0,0 +1,60 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import os
+
+import numpy as np
+from PIL import Image
+
+from detectron2.evaluation import CityscapesSemSegEvaluator, SemSegEvaluator
+from detectron2.utils.file_io import PathManager
+
+
+class LabelMapSemSegEvaluator(SemSegEvaluator):
+    """
+    A :class:`SemSegEvaluator` that also accepts "sem_seg" predictions given as HxW label maps
+    (see `MODEL.MASK_FORMER.TEST.SEMANTIC_OUTPUT`), in addition to dense KxHxW scores.
+    """
+
+    def process(self, inputs, outputs):
+        dense = [(i, o) for i, o in zip(inputs, outputs) if o["sem_seg"].dim() == 3]
+        if dense:
+            super().process(*map(list, zip(*dense)))
+        for input, output in zip(inputs, outputs):
+            if output["sem_seg"].dim() == 3:
+                continue
+            pred = np.array(output["sem_seg"].to(self._cpu_device), dtype=int)
+            with PathManager.open(self.input_file_to_gt_file[input["file_name"]], "rb") as f:
+                gt = np.array(Image.open(f), dtype=int)
+
+            gt[gt == self._ignore_label] = self._num_classes
+
+            self._conf_matrix += np.bincount(
+                (self._num_classes + 1) * pred.reshape(-1) + gt.reshape(-1),
+                minlength=self._conf_matrix.size,
+            ).reshape(self._conf_matrix.shape)
+
+            self._predictions.extend(self.encode_json_sem_seg(pred, input["file_name"]))
+
+
+class LabelMapCityscapesSemSegEvaluator(CityscapesSemSegEvaluator):
+    """
+    A :class:`CityscapesSemSegEvaluator` that also accepts "sem_seg" predictions given as HxW
+    label maps, see :class:`LabelMapSemSegEvaluator`.
+    """
+
+    def process(self, inputs, outputs):
+        from cityscapesscripts.helpers.labels import trainId2label
+
+        for input, output in zip(inputs, outputs):
+            file_name = input["file_name"]
+            basename = os.path.splitext(os.path.basename(file_name))[0]
+            pred_filename = os.path.join(self._temp_dir, basename + "_pred.png")
+            output = output["sem_seg"]
+            if output.dim() == 3:
+                output = output.argmax(dim=0)
+            output = output.to(self._cpu_device).numpy()
+            pred = 255 * np.ones(output.shape, dtype=np.uint8)
+            for train_id, label in trainId2label.items():
+                if label.ignoreInEval:
+                    continue
+                pred[output == train_id] = label.id
+            Image.fromarray(pred).save(pred_filename)
@@ -1,6 +1,8 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
+import functools
 from typing import Tuple
 
+import numpy as np
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -9,12 +11,21 @@ from detectron2.config import configurable
 from detectron2.data import MetadataCatalog
 from detectron2.modeling import META_ARCH_REGISTRY, build_backbone, build_sem_seg_head
 from detectron2.modeling.backbone import Backbone
-from detectron2.modeling.postprocessing import sem_seg_postprocess
-from detectron2.structures import Boxes, ImageList, Instances, BitMasks
+from detectron2.structures import Boxes, ImageList, Instances
 from detectron2.utils.memory import retry_if_cuda_oom
 
 from .modeling.criterion import SetCriterion
 from .modeling.matcher import HungarianMatcher
+from .modeling.postprocessing import (
+    InferenceCache,
+    InferenceTimer,
+    batched_sem_seg_postprocess,
+    low_res_crop,
+    low_res_sem_seg_postprocess,
+    masks_to_boxes,
+    semantic_label_map,
+)
+from .utils.misc import PaddedTargets
 
 
 @META_ARCH_REGISTRY.register()
@@ -43,6 +54,16 @@ class MaskFormer(nn.Module):
         panoptic_on: bool,
         instance_on: bool,
         test_topk_per_image: int,
+        batched_postprocessing: bool = False,
+        semantic_output: str = "logits",
+        semantic_confidence: bool = False,
+        semantic_chunk_size: int = 64,
+        low_res_postprocessing: bool = False,
+        early_query_pruning: bool = False,
+        profile_postprocessing: bool = False,
+        pred_boxes: bool = True,
+        low_res_pred_boxes: bool = False,
+        mask_downsample: int = 1,
     ):
         """
         Args:
@@ -67,6 +88,25 @@ class MaskFormer(nn.Module):
             instance_on: bool, whether to output instance segmentation prediction
             panoptic_on: bool, whether to output panoptic segmentation prediction
             test_topk_per_image: int, instance segmentation parameter, keep topk instances per image
+            batched_postprocessing: bool, whether to run post-processing once for every group of
+                images sharing the same input and output size instead of once per image
+            semantic_output: str, "logits" to output the dense KxHxW semantic scores in
+                "sem_seg", or "label_map" to output an HxW integer label map instead
+            semantic_confidence: bool, with "label_map" output, also output the top-1 score
+                of every pixel in "sem_seg_confidence"
+            semantic_chunk_size: int, number of classes processed at once for "label_map" output
+            low_res_postprocessing: bool, whether to run post-processing at the resolution of the
+                predicted masks and upsample only the final outputs to the output resolution
+            early_query_pruning: bool, whether to drop the queries that no enabled task can output,
+                based on their class scores, before upsampling the predicted masks
+            profile_postprocessing: bool, whether to periodically log the time of the post-processing
+                work shared by all tasks and the time each enabled task adds on top of it
+            pred_boxes: bool, whether to compute the boxes of the predicted instances from their
+                masks, instead of outputting all-zero boxes
+            low_res_pred_boxes: bool, with `low_res_postprocessing`, whether to compute the boxes
+                from the masks at the resolution of the predicted masks and rescale them
+            mask_downsample: int, downsampling factor of the gt masks produced by the dataset
+                mappers, the targets are padded to the padded image size divided by it
         """
         super().__init__()
         self.backbone = backbone
@@ -80,15 +120,30 @@ class MaskFormer(nn.Module):
             # use backbone size_divisibility if not set
             size_divisibility = self.backbone.size_divisibility
         self.size_divisibility = size_divisibility
+        assert mask_downsample == 1 or size_divisibility % mask_downsample == 0, (
+            "INPUT.MASK_DOWNSAMPLE={} must divide the size divisibility {}".format(mask_downsample, size_divisibility)
+        )
         self.sem_seg_postprocess_before_inference = sem_seg_postprocess_before_inference
         self.register_buffer("pixel_mean", torch.Tensor(pixel_mean).view(-1, 1, 1), False)
         self.register_buffer("pixel_std", torch.Tensor(pixel_std).view(-1, 1, 1), False)
+        self._register_metadata_tables(metadata, sem_seg_head.num_classes)
 
         # additional args
         self.semantic_on = semantic_on
         self.instance_on = instance_on
         self.panoptic_on = panoptic_on
         self.test_topk_per_image = test_topk_per_image
+        self.batched_postprocessing = batched_postprocessing
+        assert semantic_output in ["logits", "label_map"], semantic_output
+        self.semantic_output = semantic_output
+        self.semantic_confidence = semantic_confidence
+        self.semantic_chunk_size = semantic_chunk_size
+        self.low_res_postprocessing = low_res_postprocessing
+        self.early_query_pruning = early_query_pruning
+        self.postprocessing_timer = InferenceTimer(enabled=profile_postprocessing)
+        self.pred_boxes = pred_boxes
+        self.low_res_pred_boxes = low_res_pred_boxes
+        self.mask_downsample = mask_downsample
 
         if not self.semantic_on:
             assert self.sem_seg_postprocess_before_inference
@@ -113,6 +168,10 @@ class MaskFormer(nn.Module):
             cost_mask=mask_weight,
             cost_dice=dice_weight,
             num_points=cfg.MODEL.MASK_FORMER.TRAIN_NUM_POINTS,
+            num_workers=cfg.MODEL.MASK_FORMER.MATCHER_NUM_WORKERS,
+            solver=cfg.MODEL.MASK_FORMER.MATCHER_SOLVER,
+            num_candidates=cfg.MODEL.MASK_FORMER.SPARSE_MATCHING_CANDIDATES,
+            sparse_min_targets=cfg.MODEL.MASK_FORMER.SPARSE_MATCHING_MIN_TARGETS,
         )
 
         weight_dict = {"loss_ce": class_weight, "loss_mask": mask_weight, "loss_dice": dice_weight}
@@ -135,6 +194,15 @@ class MaskFormer(nn.Module):
             num_points=cfg.MODEL.MASK_FORMER.TRAIN_NUM_POINTS,
             oversample_ratio=cfg.MODEL.MASK_FORMER.OVERSAMPLE_RATIO,
             importance_sample_ratio=cfg.MODEL.MASK_FORMER.IMPORTANCE_SAMPLE_RATIO,
+            batched_matching=cfg.MODEL.MASK_FORMER.BATCHED_MATCHING,
+            fused_losses=cfg.MODEL.MASK_FORMER.FUSED_CRITERION,
+            point_sampling_chunk_size=cfg.MODEL.MASK_FORMER.POINT_SAMPLING_CHUNK_SIZE,
+            deep_supervision_schedule=cfg.MODEL.MASK_FORMER.DEEP_SUPERVISION_SCHEDULE,
+            deep_supervision_num_layers=cfg.MODEL.MASK_FORMER.DEEP_SUPERVISION_NUM_LAYERS,
+            deep_supervision_drop_iter=int(
+                cfg.MODEL.MASK_FORMER.DEEP_SUPERVISION_DROP_START * cfg.SOLVER.MAX_ITER
+            ),
+            profile=cfg.MODEL.MASK_FORMER.PROFILE_CRITERION,
         )
 
         return {
@@ -158,8 +226,33 @@ class MaskFormer(nn.Module):
             "instance_on": cfg.MODEL.MASK_FORMER.TEST.INSTANCE_ON,
             "panoptic_on": cfg.MODEL.MASK_FORMER.TEST.PANOPTIC_ON,
             "test_topk_per_image": cfg.TEST.DETECTIONS_PER_IMAGE,
+            "batched_postprocessing": cfg.MODEL.MASK_FORMER.TEST.BATCHED_POSTPROCESSING,
+            "semantic_output": cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_OUTPUT,
+            "semantic_confidence": cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_CONFIDENCE,
+            "semantic_chunk_size": cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_CHUNK_SIZE,
+            "low_res_postprocessing": cfg.MODEL.MASK_FORMER.TEST.LOW_RES_POSTPROCESSING,
+            "early_query_pruning": cfg.MODEL.MASK_FORMER.TEST.EARLY_QUERY_PRUNING,
+            "profile_postprocessing": cfg.MODEL.MASK_FORMER.TEST.PROFILE_POSTPROCESSING,
+            "pred_boxes": cfg.MODEL.MASK_FORMER.TEST.PRED_BOXES,
+            "low_res_pred_boxes": cfg.MODEL.MASK_FORMER.TEST.LOW_RES_PRED_BOXES,
+            "mask_downsample": cfg.INPUT.MASK_DOWNSAMPLE,
         }
 
+    def _register_metadata_tables(self, metadata, num_classes):
+        """
+        Lookup tables of class metadata, indexed by class id, so that inference filters
+        labels with gathers on the model device:
+
+        * is_thing_table: bool, whether each contiguous id (and the no-object class) is a thing
+
+        Predictions keep contiguous ids; the evaluators map them back to dataset ids, so no
+        contiguous -> dataset id table is kept here.
+        """
+        thing_map = metadata.get("thing_dataset_id_to_contiguous_id", {})
+        is_thing = np.zeros(num_classes + 1, dtype=bool)
+        is_thing[[v for v in thing_map.values() if v < num_classes]] = True
+        self.register_buffer("is_thing_table", torch.as_tensor(is_thing), False)
+
     @property
     def device(self):
         return self.pixel_mean.device
@@ -183,7 +276,11 @@ class MaskFormer(nn.Module):
                     A Tensor that represents the
                     per-pixel segmentation prediced by the head.
                     The prediction has shape KxHxW that represents the logits of
-                    each class for each pixel.
+                    each class for each pixel. With the "label_map" semantic output,
+                    it is an HxW integer tensor of predicted class ids instead.
+                * "sem_seg_confidence":
+                    Only with the "label_map" semantic output and `semantic_confidence`,
+                    a HxW tensor of the top-1 score of each pixel.
                 * "panoptic_seg":
                     A tuple that represent panoptic output
                     panoptic_seg (Tensor): of shape (height, width) where the values are ids for each segment.
@@ -218,6 +315,21 @@ class MaskFormer(nn.Module):
         else:
             mask_cls_results = outputs["pred_logits"]
             mask_pred_results = outputs["pred_masks"]
+
+            # semantic inference merges all queries, so nothing can be pruned for it
+            if self.early_query_pruning and not self.semantic_on:
+                mask_cls_results, mask_pred_results = self.prune_queries(mask_cls_results, mask_pred_results)
+
+            if self.low_res_postprocessing:
+                del outputs
+                stride = (
+                    images.tensor.shape[-2] / mask_pred_results.shape[-2],
+                    images.tensor.shape[-1] / mask_pred_results.shape[-1],
+                )
+                return self.batched_inference(
+                    mask_cls_results, mask_pred_results, batched_inputs, images.image_sizes, stride=stride
+                )
+
             # upsample masks
             mask_pred_results = F.interpolate(
                 mask_pred_results,
@@ -228,153 +340,416 @@ class MaskFormer(nn.Module):
 
             del outputs
 
+            if self.batched_postprocessing:
+                return self.batched_inference(
+                    mask_cls_results, mask_pred_results, batched_inputs, images.image_sizes
+                )
+
             processed_results = []
-            for mask_cls_result, mask_pred_result, input_per_image, image_size in zip(
-                mask_cls_results, mask_pred_results, batched_inputs, images.image_sizes
-            ):
+            for i, (input_per_image, image_size) in enumerate(zip(batched_inputs, images.image_sizes)):
                 height = input_per_image.get("height", image_size[0])
                 width = input_per_image.get("width", image_size[1])
-                processed_results.append({})
-
-                if self.sem_seg_postprocess_before_inference:
-                    mask_pred_result = retry_if_cuda_oom(sem_seg_postprocess)(
-                        mask_pred_result, image_size, height, width
+                processed_results.extend(
+                    self.full_res_inference(
+                        mask_cls_results[i : i + 1], mask_pred_results[i : i + 1], image_size, height, width
                     )
-                    mask_cls_result = mask_cls_result.to(mask_pred_result)
-
-                # semantic segmentation inference
-                if self.semantic_on:
-                    r = retry_if_cuda_oom(self.semantic_inference)(mask_cls_result, mask_pred_result)
-                    if not self.sem_seg_postprocess_before_inference:
-                        r = retry_if_cuda_oom(sem_seg_postprocess)(r, image_size, height, width)
-                    processed_results[-1]["sem_seg"] = r
-
-                # panoptic segmentation inference
-                if self.panoptic_on:
-                    panoptic_r = retry_if_cuda_oom(self.panoptic_inference)(mask_cls_result, mask_pred_result)
-                    processed_results[-1]["panoptic_seg"] = panoptic_r
-                
-                # instance segmentation inference
-                if self.instance_on:
-                    instance_r = retry_if_cuda_oom(self.instance_inference)(mask_cls_result, mask_pred_result)
-                    processed_results[-1]["instances"] = instance_r
+                )
 
             return processed_results
 
+    def batched_inference(self, mask_cls_results, mask_pred_results, batched_inputs, image_sizes, stride=None):
+        """
+        Post-process a batch of predictions. Images that share the same input size and output
+        resolution are processed together, so every task runs once per group of images.
+
+        Args:
+            mask_cls_results: class logits of shape [B, Q, K+1]
+            mask_pred_results: mask logits of shape [B, Q, H, W] at the padded input resolution
+            batched_inputs: the inputs given to :meth:`forward`
+            image_sizes: list of (height, width) of the unpadded input images
+            stride: if given, `mask_pred_results` are at 1/stride of the padded input
+                resolution and are post-processed at that resolution,
+                see :meth:`low_res_inference`
+        Returns:
+            list[dict]: same format as the output of :meth:`forward`
+        """
+        groups = {}
+        for i, (input_per_image, image_size) in enumerate(zip(batched_inputs, image_sizes)):
+            height = input_per_image.get("height", image_size[0])
+            width = input_per_image.get("width", image_size[1])
+            groups.setdefault((tuple(image_size), height, width), []).append(i)
+
+        processed_results = [{} for _ in batched_inputs]
+        for (image_size, height, width), indices in groups.items():
+            if len(indices) == len(batched_inputs):
+                mask_cls_result, mask_pred_result = mask_cls_results, mask_pred_results
+            else:
+                index = torch.as_tensor(indices, device=mask_cls_results.device)
+                mask_cls_result = mask_cls_results[index]
+                mask_pred_result = mask_pred_results[index]
+
+            if stride is None:
+                results = self.full_res_inference(mask_cls_result, mask_pred_result, image_size, height, width)
+            else:
+                results = self.low_res_inference(
+                    mask_cls_result, mask_pred_result, image_size, stride, height, width
+                )
+            for i, r in zip(indices, results):
+                processed_results[i].update(r)
+
+        return processed_results
+
+    def full_res_inference(self, mask_cls, mask_pred, image_size, height, width):
+        """
+        Run all enabled tasks on a group of images sharing the same sizes, with masks
+        upsampled to the padded input resolution.
+
+        Returns:
+            list[dict]: one dict of outputs per image
+        """
+        processed_results = [{} for _ in range(len(mask_cls))]
+        timer = self.postprocessing_timer
+
+        with timer("resize"):
+            if self.sem_seg_postprocess_before_inference:
+                mask_pred = retry_if_cuda_oom(batched_sem_seg_postprocess)(mask_pred, image_size, height, width)
+                mask_cls = mask_cls.to(mask_pred)
+
+        # probabilities, binarized masks and mask statistics shared by all tasks, computed by the
+        # first task that needs them, or upfront when profiling to time them apart from the tasks
+        cache = InferenceCache(mask_cls, mask_pred)
+        if timer.enabled:
+            with timer("shared"):
+                cache.materialize(masks=self.panoptic_on or self.instance_on)
+
+        # semantic segmentation inference
+        with timer("semantic"):
+            if self.semantic_on and self.semantic_output == "label_map":
+                postprocess = None
+                if not self.sem_seg_postprocess_before_inference:
+                    postprocess = functools.partial(
+                        batched_sem_seg_postprocess, img_size=image_size, output_height=height, output_width=width
+                    )
+                r, confidence = retry_if_cuda_oom(self.semantic_label_map_inference)(
+                    mask_cls, mask_pred, postprocess, cache=cache
+                )
+                self._add_semantic_label_map(processed_results, r, confidence)
+            elif self.semantic_on:
+                r = retry_if_cuda_oom(self.semantic_inference)(mask_cls, mask_pred, cache=cache)
+                if not self.sem_seg_postprocess_before_inference:
+                    r = retry_if_cuda_oom(batched_sem_seg_postprocess)(r, image_size, height, width)
+                for res, r_i in zip(processed_results, r):
+                    res["sem_seg"] = r_i
+
+        # panoptic segmentation inference
+        with timer("panoptic"):
+            if self.panoptic_on:
+                panoptic_r = retry_if_cuda_oom(self.panoptic_inference)(mask_cls, mask_pred, cache=cache)
+                for res, panoptic_r_i in zip(processed_results, panoptic_r):
+                    res["panoptic_seg"] = panoptic_r_i
+
+        # instance segmentation inference
+        with timer("instance"):
+            if self.instance_on:
+                # instance inference only reads the binarized masks and the mask scores, so the
+                # probabilities, as large as the mask logits, can go once the scores are computed
+                cache.mask_score
+                cache.release("mask_prob")
+                instance_r = retry_if_cuda_oom(self.instance_inference)(mask_cls, mask_pred, cache=cache)
+                for res, instance_r_i in zip(processed_results, instance_r):
+                    res["instances"] = instance_r_i
+
+        timer.log(len(processed_results))
+        return processed_results
+
+    def low_res_inference(self, mask_cls, mask_pred, image_size, stride, height, width):
+        """
+        Run all enabled tasks on a group of images sharing the same sizes, directly on the
+        predicted masks at 1/stride of the padded input resolution. Query selection, the
+        panoptic arg-max and semantic merging all happen at that resolution; only the final
+        outputs are upsampled, once, to the output resolution: the semantic scores (one chunk
+        of classes at a time for the "label_map" output), the panoptic id map (nearest
+        neighbor) and the masks of the kept instances.
+
+        Returns:
+            list[dict]: one dict of outputs per image
+        """
+        processed_results = [{} for _ in range(len(mask_cls))]
+        timer = self.postprocessing_timer
+        mask_pred = low_res_crop(mask_pred, image_size, stride)
+        resize = functools.partial(
+            low_res_sem_seg_postprocess,
+            img_size=image_size,
+            stride=stride,
+            output_height=height,
+            output_width=width,
+        )
+
+        # instance masks are binarized after resizing, only panoptic inference uses low-res ones
+        cache = InferenceCache(mask_cls, mask_pred)
+        if timer.enabled:
+            with timer("shared"):
+                cache.materialize(masks=self.panoptic_on)
+
+        # semantic segmentation inference
+        with timer("semantic"):
+            if self.semantic_on and self.semantic_output == "label_map":
+                r, confidence = retry_if_cuda_oom(self.semantic_label_map_inference)(
+                    mask_cls, mask_pred, resize, cache=cache
+                )
+                self._add_semantic_label_map(processed_results, r, confidence)
+            elif self.semantic_on:
+                r = retry_if_cuda_oom(self.semantic_inference)(mask_cls, mask_pred, cache=cache)
+                r = retry_if_cuda_oom(resize)(r)
+                for res, r_i in zip(processed_results, r):
+                    res["sem_seg"] = r_i
+
+        # panoptic segmentation inference
+        with timer("panoptic"):
+            if self.panoptic_on:
+                panoptic_r = retry_if_cuda_oom(self.panoptic_inference)(mask_cls, mask_pred, cache=cache)
+                panoptic_seg = torch.stack([panoptic_seg for panoptic_seg, _ in panoptic_r])
+                panoptic_seg = retry_if_cuda_oom(resize)(panoptic_seg[:, None], mode="nearest")[:, 0]
+                for res, panoptic_seg_i, (_, segments_info) in zip(processed_results, panoptic_seg, panoptic_r):
+                    res["panoptic_seg"] = (panoptic_seg_i, segments_info)
+
+        # instance segmentation inference
+        with timer("instance"):
+            if self.instance_on:
+                # scale from the (cropped) predicted masks to the output resolution
+                box_scale = None
+                if self.low_res_pred_boxes:
+                    box_scale = (stride[0] * height / image_size[0], stride[1] * width / image_size[1])
+                instance_r = retry_if_cuda_oom(self.instance_inference)(
+                    mask_cls, mask_pred, resize, cache=cache, box_scale=box_scale
+                )
+                for res, instance_r_i in zip(processed_results, instance_r):
+                    res["instances"] = instance_r_i
+
+        timer.log(len(processed_results))
+        return processed_results
+
+    def _add_semantic_label_map(self, processed_results, labels, confidence):
+        for i, res in enumerate(processed_results):
+            res["sem_seg"] = labels[i]
+            if confidence is not None:
+                res["sem_seg_confidence"] = confidence[i]
+
+    def prune_queries(self, mask_cls, mask_pred):
+        """
+        Score queries from their class logits only and keep the ones that panoptic or instance
+        inference can output: queries passing `object_mask_threshold` for panoptic inference,
+        and queries in the top-k (query, class) pairs for instance inference. Running
+        panoptic and instance inference on the kept queries gives the same results.
+
+        Args:
+            mask_cls: class logits of shape [B, Q, K+1]
+            mask_pred: low-resolution mask logits of shape [B, Q, H, W]
+        Returns:
+            mask_cls, mask_pred: the same tensors restricted to [B, Q', ...] queries, in their
+                original order. Images keeping fewer than Q' queries are padded with queries
+                no task selects.
+        """
+        num_classes = self.sem_seg_head.num_classes
+        probs = F.softmax(mask_cls, dim=-1)
+        needed = torch.zeros(probs.shape[:2], dtype=torch.bool, device=probs.device)
+
+        if self.panoptic_on:
+            scores, labels = probs.max(-1)
+            needed |= labels.ne(num_classes) & (scores > self.object_mask_threshold)
+
+        if self.instance_on:
+            topk_indices = probs[..., :-1].flatten(1).topk(self.test_topk_per_image, dim=1, sorted=False)[1]
+            needed.scatter_(1, topk_indices // num_classes, True)
+
+        num_kept = max(int(needed.sum(1).max()), 1)
+        if num_kept == mask_cls.shape[1]:
+            return mask_cls, mask_pred
+        # needed queries first, then sorted back to their original order
+        kept_indices = needed.float().topk(num_kept, dim=1)[1].sort(dim=1)[0]
+        batch_indices = torch.arange(len(kept_indices), device=kept_indices.device)[:, None]
+        return mask_cls[batch_indices, kept_indices], mask_pred[batch_indices, kept_indices]
+
     def prepare_targets(self, targets, images):
         h_pad, w_pad = images.tensor.shape[-2:]
-        new_targets = []
-        for targets_per_image in targets:
-            # pad gt
-            gt_masks = targets_per_image.gt_masks
-            padded_masks = torch.zeros((gt_masks.shape[0], h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
-            padded_masks[:, : gt_masks.shape[1], : gt_masks.shape[2]] = gt_masks
-            new_targets.append(
-                {
-                    "labels": targets_per_image.gt_classes,
-                    "masks": padded_masks,
-                }
+        # downsampled masks cover whole cells of the padded image
+        assert h_pad % self.mask_downsample == 0 and w_pad % self.mask_downsample == 0, (
+            "The padded image size {}x{} is not divisible by INPUT.MASK_DOWNSAMPLE={}".format(
+                h_pad, w_pad, self.mask_downsample
             )
-        return new_targets
-
-    def semantic_inference(self, mask_cls, mask_pred):
-        mask_cls = F.softmax(mask_cls, dim=-1)[..., :-1]
-        mask_pred = mask_pred.sigmoid()
-        semseg = torch.einsum("qc,qhw->chw", mask_cls, mask_pred)
+        )
+        h_pad, w_pad = h_pad // self.mask_downsample, w_pad // self.mask_downsample
+        gt_masks = [targets_per_image.gt_masks for targets_per_image in targets]
+        num_targets = [len(m) for m in gt_masks]
+        # empty masks of the mappers are float, keep the dtype of the actual masks
+        dtype = next((m.dtype for m in gt_masks if len(m)), torch.bool)
+        # pad gt once, in a single tensor for all images
+        padded_masks = torch.zeros((sum(num_targets), h_pad, w_pad), dtype=dtype, device=self.device)
+        for masks, padded in zip(gt_masks, padded_masks.split(num_targets)):
+            padded[:, : masks.shape[1], : masks.shape[2]] = masks
+        labels = torch.cat([targets_per_image.gt_classes for targets_per_image in targets])
+        return PaddedTargets(padded_masks, labels, num_targets)
+
+    def semantic_inference(self, mask_cls, mask_pred, cache=None):
+        # works for both a single image ([Q, K+1], [Q, H, W]) and a batch ([B, Q, K+1], [B, Q, H, W])
+        cache = InferenceCache.get(cache, mask_cls, mask_pred)
+        mask_cls = cache.cls_prob[..., :-1]
+        mask_pred = cache.mask_prob
+        semseg = torch.einsum("...qc,...qhw->...chw", mask_cls, mask_pred)
         return semseg
 
-    def panoptic_inference(self, mask_cls, mask_pred):
-        scores, labels = F.softmax(mask_cls, dim=-1).max(-1)
-        mask_pred = mask_pred.sigmoid()
-
-        keep = labels.ne(self.sem_seg_head.num_classes) & (scores > self.object_mask_threshold)
-        cur_scores = scores[keep]
-        cur_classes = labels[keep]
-        cur_masks = mask_pred[keep]
-        cur_mask_cls = mask_cls[keep]
-        cur_mask_cls = cur_mask_cls[:, :-1]
+    def semantic_label_map_inference(self, mask_cls, mask_pred, postprocess=None, cache=None):
+        """
+        Batched semantic inference for the "label_map" output, see :func:`semantic_label_map`.
+        `postprocess` resizes the scores to the output resolution one class chunk at a time.
+        """
+        cache = InferenceCache.get(cache, mask_cls, mask_pred)
+        return semantic_label_map(
+            cache.cls_prob,
+            cache.mask_prob,
+            postprocess=postprocess,
+            chunk_size=self.semantic_chunk_size,
+            return_confidence=self.semantic_confidence,
+        )
 
-        cur_prob_masks = cur_scores.view(-1, 1, 1) * cur_masks
+    def panoptic_inference(self, mask_cls, mask_pred, cache=None):
+        """
+        Merge the kept masks into a panoptic segmentation with tensor ops only.
 
-        h, w = cur_masks.shape[-2:]
-        panoptic_seg = torch.zeros((h, w), dtype=torch.int32, device=cur_masks.device)
-        segments_info = []
+        Args:
+            mask_cls: class logits of shape [Q, K+1], or [B, Q, K+1] for a batch of images
+            mask_pred: mask logits of shape [Q, H, W], or [B, Q, H, W] for a batch of images
+            cache: optional :class:`InferenceCache` of batched inputs shared with other tasks
+        Returns:
+            a tuple (panoptic_seg, segments_info), or a list of such tuples for batched inputs
+        """
+        if mask_cls.dim() == 2:
+            return self.panoptic_inference(mask_cls[None], mask_pred[None])[0]
 
-        current_segment_id = 0
+        num_images, num_queries = mask_cls.shape[:2]
+        device = mask_pred.device
+        cache = InferenceCache.get(cache, mask_cls, mask_pred)
+        scores, labels = cache.cls_prob.max(-1)
+        mask_pred = cache.mask_prob
 
-        if cur_masks.shape[0] == 0:
-            # We didn't detect any mask :(
-            return panoptic_seg, segments_info
-        else:
-            # take argmax
-            cur_mask_ids = cur_prob_masks.argmax(0)
-            stuff_memory_list = {}
-            for k in range(cur_classes.shape[0]):
-                pred_class = cur_classes[k].item()
-                isthing = pred_class in self.metadata.thing_dataset_id_to_contiguous_id.values()
-                mask_area = (cur_mask_ids == k).sum().item()
-                original_area = (cur_masks[k] >= 0.5).sum().item()
-                mask = (cur_mask_ids == k) & (cur_masks[k] >= 0.5)
-
-                if mask_area > 0 and original_area > 0 and mask.sum().item() > 0:
-                    if mask_area / original_area < self.overlap_threshold:
-                        continue
-
-                    # merge stuff regions
-                    if not isthing:
-                        if int(pred_class) in stuff_memory_list.keys():
-                            panoptic_seg[mask] = stuff_memory_list[int(pred_class)]
-                            continue
-                        else:
-                            stuff_memory_list[int(pred_class)] = current_segment_id + 1
-
-                    current_segment_id += 1
-                    panoptic_seg[mask] = current_segment_id
-
-                    segments_info.append(
-                        {
-                            "id": current_segment_id,
-                            "isthing": bool(isthing),
-                            "category_id": int(pred_class),
-                        }
-                    )
+        keep = labels.ne(self.sem_seg_head.num_classes) & (scores > self.object_mask_threshold)
+        # probabilities of kept queries are >= 0, so dropped queries never win the argmax
+        prob_masks = torch.where(
+            keep[..., None, None], scores[..., None, None] * mask_pred, mask_pred.new_tensor(-1.0)
+        )
+        mask_ids = prob_masks.argmax(1)
+        del prob_masks
+        # whether each pixel passes the mask threshold of the query it is assigned to
+        fg = mask_pred.gather(1, mask_ids[:, None]).squeeze(1) >= 0.5
+
+        # per-query areas from a single bincount over all images
+        flat_ids = (mask_ids.flatten(1) + torch.arange(num_images, device=device)[:, None] * num_queries).flatten()
+        mask_area = torch.bincount(flat_ids, minlength=num_images * num_queries).view(num_images, num_queries)
+        fg_area = torch.bincount(flat_ids[fg.flatten()], minlength=num_images * num_queries).view(
+            num_images, num_queries
+        )
+        original_area = cache.mask_area
+
+        valid = keep & (mask_area > 0) & (original_area > 0) & (fg_area > 0)
+        valid &= mask_area.double() / original_area.clamp(min=1).double() >= self.overlap_threshold
+
+        isthing = self.is_thing_table.to(device)[labels]
+
+        # merge stuff regions: every stuff query points to the first kept query of its class
+        query_idx = torch.arange(num_queries, device=device)
+        same_stuff = (labels[:, :, None] == labels[:, None, :]) & (valid & ~isthing)[:, None, :]
+        first_stuff = torch.where(same_stuff, query_idx, query_idx.new_tensor(num_queries)).min(-1).values
+        is_new = valid & (isthing | first_stuff.eq(query_idx))
+        segment_ids = torch.cumsum(is_new.long(), dim=1)
+        query_to_segment = segment_ids.gather(1, torch.where(isthing, query_idx, first_stuff).clamp(max=num_queries - 1))
+        query_to_segment = query_to_segment * valid
+
+        panoptic_seg = query_to_segment.gather(1, mask_ids.flatten(1)).view_as(mask_ids)
+        panoptic_seg = (panoptic_seg * fg).int()
+
+        # single host transfer for all segment descriptions
+        info = torch.stack([is_new.long(), segment_ids, labels, isthing.long()], dim=-1).cpu().tolist()
+        results = []
+        for panoptic_seg_per_image, info_per_image in zip(panoptic_seg, info):
+            segments_info = [
+                {
+                    "id": segment_id,
+                    "isthing": bool(thing),
+                    "category_id": category_id,
+                }
+                for new, segment_id, category_id, thing in info_per_image
+                if new
+            ]
+            results.append((panoptic_seg_per_image, segments_info))
+        return results
 
-            return panoptic_seg, segments_info
+    def instance_inference(self, mask_cls, mask_pred, mask_postprocess=None, cache=None, box_scale=None):
+        """
+        Args:
+            mask_cls: class logits of shape [Q, K+1], or [B, Q, K+1] for a batch of images
+            mask_pred: mask logits of shape [Q, H, W], or [B, Q, H, W] for a batch of images
+            mask_postprocess: optional callable applied to the [1, N, H, W] logits of the
+                selected masks of each image, e.g. to resize them to the output resolution.
+            cache: optional :class:`InferenceCache` of batched inputs shared with other tasks.
+                Without `mask_postprocess`, its binarized masks and mask scores are reused.
+            box_scale: optional (scale_y, scale_x). If given, boxes are computed from the masks
+                before `mask_postprocess` and rescaled by it, instead of from the processed masks.
+        Returns:
+            an :class:`Instances`, or a list of :class:`Instances` for batched inputs
+        """
+        if mask_cls.dim() == 2:
+            return self.instance_inference(mask_cls[None], mask_pred[None], mask_postprocess, box_scale=box_scale)[0]
 
-    def instance_inference(self, mask_cls, mask_pred):
-        # mask_pred is already processed to have the same shape as original input
-        image_size = mask_pred.shape[-2:]
+        num_queries = mask_cls.shape[1]
+        num_classes = self.sem_seg_head.num_classes
+        cache = InferenceCache.get(cache, mask_cls, mask_pred)
 
-        # [Q, K]
-        scores = F.softmax(mask_cls, dim=-1)[:, :-1]
-        labels = torch.arange(self.sem_seg_head.num_classes, device=self.device).unsqueeze(0).repeat(self.num_queries, 1).flatten(0, 1)
-        # scores_per_image, topk_indices = scores.flatten(0, 1).topk(self.num_queries, sorted=False)
-        scores_per_image, topk_indices = scores.flatten(0, 1).topk(self.test_topk_per_image, sorted=False)
+        # [B, Q, K]
+        scores = cache.cls_prob[..., :-1]
+        labels = torch.arange(num_classes, device=mask_cls.device).repeat(num_queries)
+        scores_per_image, topk_indices = scores.flatten(1).topk(self.test_topk_per_image, dim=1, sorted=False)
         labels_per_image = labels[topk_indices]
-
-        topk_indices = topk_indices // self.sem_seg_head.num_classes
-        # mask_pred = mask_pred.unsqueeze(1).repeat(1, self.sem_seg_head.num_classes, 1).flatten(0, 1)
-        mask_pred = mask_pred[topk_indices]
+        topk_indices = topk_indices // num_classes
 
         # if this is panoptic segmentation, we only keep the "thing" classes
         if self.panoptic_on:
-            keep = torch.zeros_like(scores_per_image).bool()
-            for i, lab in enumerate(labels_per_image):
-                keep[i] = lab in self.metadata.thing_dataset_id_to_contiguous_id.values()
-
-            scores_per_image = scores_per_image[keep]
-            labels_per_image = labels_per_image[keep]
-            mask_pred = mask_pred[keep]
-
-        result = Instances(image_size)
-        # mask (before sigmoid)
-        result.pred_masks = (mask_pred > 0).float()
-        result.pred_boxes = Boxes(torch.zeros(mask_pred.size(0), 4))
-        # Uncomment the following to get boxes from masks (this is slow)
-        # result.pred_boxes = BitMasks(mask_pred > 0).get_bounding_boxes()
-
-        # calculate average mask prob
-        mask_scores_per_image = (mask_pred.sigmoid().flatten(1) * result.pred_masks.flatten(1)).sum(1) / (result.pred_masks.flatten(1).sum(1) + 1e-6)
-        result.scores = scores_per_image * mask_scores_per_image
-        result.pred_classes = labels_per_image
-        return result
+            keep = self.is_thing_table.to(labels_per_image.device)[labels_per_image]
+        else:
+            keep = torch.ones_like(labels_per_image, dtype=torch.bool)
+
+        results = []
+        for i, (keep_i, query_i, scores_i, labels_i) in enumerate(
+            zip(keep, topk_indices, scores_per_image, labels_per_image)
+        ):
+            query_i = query_i[keep_i].to(mask_pred.device)
+            pred_boxes_i = None
+            if mask_postprocess is None:
+                # binarized masks and average mask probs shared with panoptic inference
+                pred_masks_i = cache.mask_fg[i, query_i]
+                mask_scores_i = cache.mask_score[i, query_i]
+            else:
+                # a query can be selected with several labels, process its mask only once
+                unique_i, inverse_i = torch.unique(query_i, return_inverse=True)
+                if self.pred_boxes and box_scale is not None:
+                    pred_boxes_i = masks_to_boxes(mask_pred[i, unique_i] > 0, box_scale)[inverse_i]
+                mask_pred_i = mask_postprocess(mask_pred[i, unique_i][None])[0][inverse_i]
+                pred_masks_i = mask_pred_i > 0
+                # calculate average mask prob
+                mask_scores_i = (mask_pred_i.sigmoid().flatten(1) * pred_masks_i.flatten(1)).sum(1) / (
+                    pred_masks_i.flatten(1).sum(1) + 1e-6
+                )
+
+            # mask_pred is already processed to have the same shape as original input
+            result = Instances(pred_masks_i.shape[-2:])
+            result.pred_masks = pred_masks_i.float()
+            if not self.pred_boxes:
+                pred_boxes_i = torch.zeros(result.pred_masks.size(0), 4)
+            elif pred_boxes_i is None:
+                pred_boxes_i = masks_to_boxes(pred_masks_i)
+            result.pred_boxes = Boxes(pred_boxes_i)
+            result.pred_boxes.clip(result.image_size)
+
+            result.scores = scores_i[keep_i].to(mask_scores_i) * mask_scores_i
+            result.pred_classes = labels_i[keep_i].to(mask_scores_i.device)
+            results.append(result)
+        return results
@@ -0,0 +1,145 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Linear sum assignment solvers for :class:`HungarianMatcher`.
+"""
+import torch
+from scipy.optimize import linear_sum_assignment
+
+
+def scipy_linear_sum_assignment(cost_matrices):
+    """
+    Solve every cost matrix on the host with scipy.
+
+    Args:
+        cost_matrices (list[Tensor]): cost matrices of shape (Q, N_i)
+    Returns:
+        list[tuple[Tensor, Tensor]]: (row_ind, col_ind) of every problem, as returned by
+            :func:`scipy.optimize.linear_sum_assignment`
+    """
+    results = []
+    for C in cost_matrices:
+        i, j = linear_sum_assignment(C.cpu())
+        results.append((torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)))
+    return results
+
+
+def _auction_phase(benefit, prices, eps, max_iter, check_period):
+    """
+    One epsilon phase of the Jacobi auction algorithm on square (P, n, n) benefit matrices
+    indexed by (problem, bidder, object): all unassigned bidders bid at once and every
+    object goes to its highest bidder.
+
+    Returns:
+        assigned (Tensor): (P, n) object assigned to every bidder, -1 if unassigned
+        prices (Tensor): (P, n) object prices, to start the next phase from
+    """
+    num_problems, n = benefit.shape[:2]
+    owner = benefit.new_full((num_problems, n), -1, dtype=torch.int64)
+    assigned = benefit.new_full((num_problems, n), -1, dtype=torch.int64)
+    objects = torch.arange(n, device=benefit.device).repeat(num_problems, 1)
+    neg_inf = benefit.new_tensor(float("-inf"))
+
+    for it in range(max_iter):
+        unassigned = assigned < 0
+        # a host sync, so only every few iterations; extra iterations are no-ops
+        if it % check_period == 0 and not bool(unassigned.any()):
+            break
+        top_values, top_objects = (benefit - prices[:, None, :]).topk(2, dim=2)
+        best_object = top_objects[..., 0]
+        bids = prices.gather(1, best_object) + (top_values[..., 0] - top_values[..., 1]) + eps
+        bids = torch.where(unassigned, bids, neg_inf)
+
+        # (P, bidder, object) bids, the highest bidder of every object wins it
+        bid_matrix = benefit.new_full(benefit.shape, float("-inf"))
+        bid_matrix.scatter_(2, best_object[..., None], bids[..., None])
+        best_bid, winner = bid_matrix.max(dim=1)
+        has_bid = best_bid > neg_inf
+
+        prices = torch.where(has_bid, best_bid, prices)
+        owner = torch.where(has_bid, winner, owner)
+        # rebuild bidder -> object from object -> owner, unowned objects go to a sink column
+        assigned = benefit.new_full((num_problems, n + 1), -1, dtype=torch.int64)
+        assigned.scatter_(1, torch.where(owner >= 0, owner, owner.new_tensor(n)), objects)
+        assigned = assigned[:, :n]
+    return assigned, prices
+
+
+def auction_linear_sum_assignment(cost_matrices, scale=1e4, theta=4.0, max_iter=10000, check_period=8):
+    """
+    Batched minimum-cost assignment with the auction algorithm and epsilon scaling, in pure
+    torch on the device of the cost matrices.
+
+    Costs are rounded to integers after multiplying by `scale`, and matrices are padded to
+    (Q, Q) with dummy targets of constant benefit. With a final epsilon below 1 / Q, the
+    auction algorithm then finds an optimal assignment of the rounded problem, which is
+    optimal for the original problem up to the rounding.
+
+    Args:
+        cost_matrices (list[Tensor]): cost matrices of shape (Q, N_i) with N_i <= Q,
+            all on the same device
+        scale (float): resolution of the costs
+        theta (float): factor by which epsilon decreases after every phase
+        max_iter (int): maximum number of bidding rounds per phase
+        check_period (int): number of bidding rounds between convergence checks
+
+    Returns:
+        list[tuple[Tensor, Tensor] or None]: (row_ind, col_ind) of every problem, with the
+            same ordering as :func:`scipy.optimize.linear_sum_assignment`, or None for the
+            problems that did not converge.
+    """
+    n = cost_matrices[0].shape[0]
+    device = cost_matrices[0].device
+    # bidders are targets (padded with dummies), objects are queries
+    benefit = torch.zeros(len(cost_matrices), n, n, dtype=torch.float64, device=device)
+    for p, C in enumerate(cost_matrices):
+        benefit[p, : C.shape[1]] = torch.round(-C.t().double() * scale)
+
+    prices = torch.zeros(len(cost_matrices), n, dtype=torch.float64, device=device)
+    final_eps = 1.0 / (n + 1)
+    eps = max(float(benefit.max() - benefit.min()) / 2, final_eps)
+    while True:
+        assigned, prices = _auction_phase(benefit, prices, eps, max_iter, check_period)
+        if eps <= final_eps:
+            break
+        eps = max(eps / theta, final_eps)
+    failed = (assigned < 0).any(1).tolist()
+
+    results = []
+    for p, C in enumerate(cost_matrices):
+        if failed[p]:
+            results.append(None)
+            continue
+        rows = assigned[p, : C.shape[1]]
+        order = rows.argsort()
+        results.append((rows[order], order))
+    return results
+
+
+def batched_linear_sum_assignment(cost_matrices, solver="scipy"):
+    """
+    Args:
+        cost_matrices (list[Tensor]): cost matrices of shape (Q, N_i), on the same device
+        solver (str): "scipy" or "auction". The auction solver falls back to scipy for the
+            problems it cannot solve: N_i > Q, Q < 2, or no convergence. It is only used for
+            costs on an accelerator, on CPU scipy is orders of magnitude faster.
+    Returns:
+        list[tuple[Tensor, Tensor]]: (row_ind, col_ind) of every problem, on the host with
+            the scipy solver and on the device of the costs with the auction solver,
+            including the problems solved by the fallback
+    """
+    assert solver in ["scipy", "auction"], solver
+    if solver == "scipy" or not cost_matrices or cost_matrices[0].device.type == "cpu":
+        return scipy_linear_sum_assignment(cost_matrices)
+
+    num_queries = cost_matrices[0].shape[0]
+    auction = [p for p, C in enumerate(cost_matrices) if 2 <= num_queries and C.shape[1] <= num_queries]
+    results = [None] * len(cost_matrices)
+    if auction:
+        for p, r in zip(auction, auction_linear_sum_assignment([cost_matrices[p] for p in auction])):
+            results[p] = r
+    device = cost_matrices[0].device
+    for p, r in enumerate(results):
+        if r is None:
+            i, j = scipy_linear_sum_assignment([cost_matrices[p]])[0]
+            results[p] = (i.to(device), j.to(device))
+    return results
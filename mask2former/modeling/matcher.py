@@ -3,6 +3,8 @@
 """
 Modules to compute the matching cost and solve the corresponding LSAP.
 """
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn.functional as F
 from scipy.optimize import linear_sum_assignment
@@ -11,6 +13,15 @@ from torch.cuda.amp import autocast
 
 from detectron2.projects.point_rend.point_features import point_sample
 
+from .assignment import batched_linear_sum_assignment
+
+try:
+    # scipy >= 1.6
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+except ImportError:
+    min_weight_full_bipartite_matching = None
+
 
 def batch_dice_loss(inputs: torch.Tensor, targets: torch.Tensor):
     """
@@ -67,6 +78,68 @@ batch_sigmoid_ce_loss_jit = torch.jit.script(
 )  # type: torch.jit.ScriptModule
 
 
+def binary_point_sample(masks, point_coords, mask_indices=None):
+    """
+    Bilinear sampling of bool, uint8 or low precision masks, equivalent to `point_sample`
+    with `align_corners=False` on the masks cast to float, but reading only the 4 neighbors
+    of every point from the storage of the masks.
+
+    Args:
+        masks (Tensor): [M, H, W] masks
+        point_coords (Tensor): [P, 2] points shared by all sampled masks, or [N, P, 2] points
+            of every sampled mask, as normalized (x, y) coordinates in [0, 1]
+        mask_indices (Tensor): optional [N] indices of the masks to sample, all of them by default
+    Returns:
+        Tensor: [N, P] float sampled values
+    """
+    M, H, W = masks.shape
+    if mask_indices is None:
+        mask_indices = torch.arange(M, device=masks.device)
+    point_coords = point_coords.float()
+    x = point_coords[..., 0] * W - 0.5
+    y = point_coords[..., 1] * H - 0.5
+    x0 = x.floor()
+    y0 = y.floor()
+    wx = x - x0
+    wy = y - y0
+    x0 = x0.long()
+    y0 = y0.long()
+
+    flat_masks = masks.reshape(-1)
+    offsets = mask_indices.to(masks.device)[:, None] * (H * W)
+    output = point_coords.new_zeros(len(mask_indices), point_coords.shape[-2])
+    for dy, weight_y in ((0, 1 - wy), (1, wy)):
+        for dx, weight_x in ((0, 1 - wx), (1, wx)):
+            xi = x0 + dx
+            yi = y0 + dy
+            # zero padding outside of the masks, as in grid_sample
+            inside = (xi >= 0) & (xi < W) & (yi >= 0) & (yi < H)
+            index = offsets + yi.clamp(0, H - 1) * W + xi.clamp(0, W - 1)
+            output += flat_masks[index].float() * (weight_x * weight_y * inside)
+    return output
+
+
+def shared_point_sample(masks, point_coords):
+    """
+    Sample all masks at the same points, equivalent to `point_sample` with
+    `align_corners=False` and the points repeated for every mask, without copying them.
+
+    Floating point masks are sampled with a single `grid_sample` call that treats the masks
+    as channels. Other masks (bool or uint8) are read with :func:`binary_point_sample`, so
+    they are never cast at full resolution.
+
+    Args:
+        masks (Tensor): [N, H, W] masks
+        point_coords (Tensor): [P, 2] normalized (x, y) coordinates in [0, 1]
+    Returns:
+        Tensor: [N, P] sampled values, float for non floating point masks
+    """
+    if masks.is_floating_point():
+        # keep the coordinates in float32, half precision loses sub-pixel accuracy on large masks
+        return point_sample(masks[None], point_coords[None].to(masks.device), align_corners=False)[0]
+    return binary_point_sample(masks, point_coords)
+
+
 class HungarianMatcher(nn.Module):
     """This class computes an assignment between the targets and the predictions of the network
 
@@ -75,13 +148,31 @@ class HungarianMatcher(nn.Module):
     while the others are un-matched (and thus treated as non-objects).
     """
 
-    def __init__(self, cost_class: float = 1, cost_mask: float = 1, cost_dice: float = 1, num_points: int = 0):
+    def __init__(
+        self,
+        cost_class: float = 1,
+        cost_mask: float = 1,
+        cost_dice: float = 1,
+        num_points: int = 0,
+        num_workers: int = 0,
+        solver: str = "scipy",
+        num_candidates: int = 0,
+        sparse_min_targets: int = 0,
+    ):
         """Creates the matcher
 
         Params:
             cost_class: This is the relative weight of the classification error in the matching cost
             cost_mask: This is the relative weight of the focal loss of the binary mask in the matching cost
             cost_dice: This is the relative weight of the dice loss of the binary mask in the matching cost
+            num_workers: number of threads solving the LSAPs of :meth:`batched_forward`, 0 to
+                solve them in the calling thread
+            solver: "scipy" to solve the LSAPs on the host, or "auction" to solve them on the
+                device of the costs, see :func:`batched_linear_sum_assignment`
+            num_candidates: if > 0, images with at least `sparse_min_targets` targets are matched
+                sparsely: only the `num_candidates` queries with the highest probability of the
+                class of a target are candidates for it, see :meth:`sparse_match`
+            sparse_min_targets: minimum number of targets of an image for sparse matching
         """
         super().__init__()
         self.cost_class = cost_class
@@ -91,13 +182,49 @@ class HungarianMatcher(nn.Module):
         assert cost_class != 0 or cost_mask != 0 or cost_dice != 0, "all costs cant be 0"
 
         self.num_points = num_points
+        self.num_workers = num_workers
+        self._pool = None
+        assert solver in ["scipy", "auction"], solver
+        self.solver = solver
+        self.num_candidates = num_candidates
+        self.sparse_min_targets = sparse_min_targets
+        if num_candidates > 0:
+            assert min_weight_full_bipartite_matching is not None, "Sparse matching requires scipy >= 1.6"
 
     @torch.no_grad()
-    def memory_efficient_forward(self, outputs, targets):
+    def sample_targets(self, targets, point_coords=None):
+        """
+        Draw the points of every image and sample the target masks at them.
+
+        The result can be passed to :meth:`forward` for several layers, which then share
+        the points and the sampled target labels.
+
+        Returns:
+            list[tuple[Tensor, Tensor]]: for every image, the [num_points, 2] point
+                coordinates and the [num_targets, num_points] sampled target masks
+        """
+        sampled = []
+        for t in targets:
+            # gt masks are already padded when preparing target
+            tgt_mask = t["masks"]
+            if point_coords is None:
+                coords = torch.rand(self.num_points, 2, device=tgt_mask.device)
+            else:
+                coords = point_coords
+            # read in place, whatever the dtype: bool, or float16 for soft downsampled masks
+            sampled.append((coords, binary_point_sample(tgt_mask, coords)))
+        return sampled
+
+    @torch.no_grad()
+    def memory_efficient_forward(self, outputs, targets, sampled_targets=None):
         """More memory-friendly matching"""
         bs, num_queries = outputs["pred_logits"].shape[:2]
+        if sampled_targets is None:
+            # all masks share the same set of points for efficient matching!
+            sampled_targets = self.sample_targets(targets)
 
-        indices = []
+        costs = []
+        indices = [None] * bs
 
         # Iterate through batch size
         for b in range(bs):
@@ -111,25 +238,14 @@ class HungarianMatcher(nn.Module):
             cost_class = -out_prob[:, tgt_ids]
 
             out_mask = outputs["pred_masks"][b]  # [num_queries, H_pred, W_pred]
-            # gt masks are already padded when preparing target
-            tgt_mask = targets[b]["masks"].to(out_mask)
+            point_coords, tgt_mask = sampled_targets[b]
 
-            out_mask = out_mask[:, None]
-            tgt_mask = tgt_mask[:, None]
-            # all masks share the same set of points for efficient matching!
-            point_coords = torch.rand(1, self.num_points, 2, device=out_mask.device)
-            # get gt labels
-            tgt_mask = point_sample(
-                tgt_mask,
-                point_coords.repeat(tgt_mask.shape[0], 1, 1),
-                align_corners=False,
-            ).squeeze(1)
-
-            out_mask = point_sample(
-                out_mask,
-                point_coords.repeat(out_mask.shape[0], 1, 1),
-                align_corners=False,
-            ).squeeze(1)
+            if self.num_candidates > 0 and self.sparse_min_targets <= len(tgt_ids) <= num_queries:
+                indices[b] = self.sparse_match(cost_class, out_mask, tgt_mask, point_coords)
+                if indices[b] is not None:
+                    continue
+
+            out_mask = shared_point_sample(out_mask, point_coords)
 
             with autocast(enabled=False):
                 out_mask = out_mask.float()
@@ -146,17 +262,152 @@ class HungarianMatcher(nn.Module):
                 + self.cost_class * cost_class
                 + self.cost_dice * cost_dice
             )
-            C = C.reshape(num_queries, -1).cpu()
+            costs.append(C.reshape(num_queries, -1))
+
+        # images that were not matched sparsely
+        dense_indices = iter(batched_linear_sum_assignment(costs, self.solver))
+        return [i if i is not None else next(dense_indices) for i in indices]
+
+    def sparse_match(self, cost_class, out_mask, tgt_mask, point_coords):
+        """
+        Match the targets of one image with only `num_candidates` candidate queries each, the
+        ones with the highest probability of the target class. Mask costs are only computed
+        for the candidate pairs, and the sparse assignment problem is solved with
+        :func:`scipy.sparse.csgraph.min_weight_full_bipartite_matching`. The result is optimal
+        among the candidate pairs, but not necessarily for all pairs.
+
+        The mask costs are computed between the (at most num_queries) distinct candidate
+        queries and all targets, so the memory never exceeds the one of dense matching.
+
+        Params:
+            cost_class: [num_queries, num_targets] classification costs
+            out_mask: [num_queries, H_pred, W_pred] predicted mask logits
+            tgt_mask: [num_targets, num_points] target masks sampled at `point_coords`
+            point_coords: [num_points, 2] points shared by all masks
+
+        Returns:
+            a tuple (index_i, index_j) as returned by :meth:`forward`, on the same device as
+            the indices of dense matching, or None when no assignment of all targets exists
+            among the candidate pairs.
+        """
+        num_queries, num_targets = cost_class.shape
+        num_candidates = min(self.num_candidates, num_queries)
+        # candidate pairs, target-major
+        pair_queries = (-cost_class).topk(num_candidates, dim=0).indices.t().flatten()
+        pair_targets = torch.arange(num_targets, device=cost_class.device).repeat_interleave(num_candidates)
+
+        # sample the masks of the candidate queries only
+        queries, pair_to_query = torch.unique(pair_queries, return_inverse=True)
+        out_mask = shared_point_sample(out_mask[queries], point_coords)
+
+        with autocast(enabled=False):
+            out_mask = out_mask.float()
+            tgt_mask = tgt_mask.float()
+            # [num_candidate_queries, num_targets] costs, read at the candidate pairs
+            cost_mask = batch_sigmoid_ce_loss_jit(out_mask, tgt_mask)[pair_to_query, pair_targets]
+            cost_dice = batch_dice_loss_jit(out_mask, tgt_mask)[pair_to_query, pair_targets]
+
+        C = (
+            self.cost_mask * cost_mask
+            + self.cost_class * cost_class[pair_queries, pair_targets]
+            + self.cost_dice * cost_dice
+        )
+        # the sparse solver treats missing entries as missing edges, costs must be positive
+        C = (C - C.min() + 1).cpu().numpy()
+        graph = csr_matrix(
+            (C, (pair_targets.cpu().numpy(), pair_queries.cpu().numpy())), shape=(num_targets, num_queries)
+        )
+        try:
+            targets, queries = min_weight_full_bipartite_matching(graph)
+        except ValueError:
+            # no complete assignment among the candidates, use dense matching
+            return None
+        # the auction solver returns the indices of dense matching on the device of the costs
+        device = cost_class.device if self.solver == "auction" else torch.device("cpu")
+        i, order = torch.as_tensor(queries, dtype=torch.int64, device=device).sort()
+        return i, torch.as_tensor(targets, dtype=torch.int64, device=device)[order]
+
+    @torch.no_grad()
+    def batched_forward(self, outputs_list, targets):
+        """
+        Match the outputs of several decoder layers at once. All cost matrices are computed
+        with batched ops over the layers, using the same sampled points for every layer and
+        image, copied to the host with a single transfer, and their LSAPs are solved on
+        `num_workers` threads.
+
+        Params:
+            outputs_list: list of dicts with the same format as the `outputs` of :meth:`forward`,
+                e.g. the final outputs followed by the "aux_outputs"
+            targets: see :meth:`forward`
+
+        Returns:
+            A list with the output of :meth:`forward` for every element of `outputs_list`.
+        """
+        num_layers = len(outputs_list)
+        pred_logits = torch.stack([outputs["pred_logits"] for outputs in outputs_list], dim=1)
+        bs, _, num_queries = pred_logits.shape[:3]
+
+        # all masks share the same set of points for efficient matching!
+        point_coords = torch.rand(self.num_points, 2, device=pred_logits.device)
+        sampled_targets = self.sample_targets(targets, point_coords)
+
+        costs = []
+        for b in range(bs):
+            out_prob = pred_logits[b].softmax(-1)  # [num_layers, num_queries, num_classes]
+            tgt_ids = targets[b]["labels"]
+            cost_class = -out_prob[:, :, tgt_ids]
+
+            # [num_layers * num_queries, num_points], sampled layer by layer without
+            # concatenating the full resolution masks
+            out_mask = torch.cat(
+                [shared_point_sample(outputs["pred_masks"][b], point_coords) for outputs in outputs_list]
+            )
+            tgt_mask = sampled_targets[b][1]
+
+            with autocast(enabled=False):
+                out_mask = out_mask.float()
+                tgt_mask = tgt_mask.float()
+                cost_mask = batch_sigmoid_ce_loss_jit(out_mask, tgt_mask)
+                cost_dice = batch_dice_loss_jit(out_mask, tgt_mask)
+
+            C = (
+                self.cost_mask * cost_mask.view(num_layers, num_queries, -1)
+                + self.cost_class * cost_class
+                + self.cost_dice * cost_dice.view(num_layers, num_queries, -1)
+            )
+            costs.append(C.float())
 
-            indices.append(linear_sum_assignment(C))
+        # one problem per (image, layer)
+        if self.solver == "scipy":
+            indices = self._solve_on_host(costs)
+        else:
+            indices = batched_linear_sum_assignment([C_l for C in costs for C_l in C], self.solver)
+        return [[indices[b * num_layers + layer] for b in range(bs)] for layer in range(num_layers)]
 
+    def _solve_on_host(self, costs):
+        """
+        Copy the [num_layers, num_queries, num_targets] costs of every image to the host with a
+        single transfer and solve their LSAPs, on a thread pool if `num_workers > 0`.
+        """
+        flat_costs = torch.cat([C.flatten() for C in costs]).cpu().numpy()
+        problems = []
+        offset = 0
+        for C in costs:
+            problems.extend(flat_costs[offset : offset + C.numel()].reshape(C.shape))
+            offset += C.numel()
+
+        if self.num_workers <= 0 or len(problems) <= 1:
+            indices = [linear_sum_assignment(C) for C in problems]
+        else:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.num_workers)
+            indices = list(self._pool.map(linear_sum_assignment, problems))
         return [
-            (torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64))
-            for i, j in indices
+            (torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices
         ]
 
     @torch.no_grad()
-    def forward(self, outputs, targets):
+    def forward(self, outputs, targets, sampled_targets=None):
         """Performs the matching
 
         Params:
@@ -169,6 +420,9 @@ class HungarianMatcher(nn.Module):
                            objects in the target) containing the class labels
                  "masks": Tensor of dim [num_target_boxes, H_gt, W_gt] containing the target masks
 
+            sampled_targets: optional output of :meth:`sample_targets`, to share the sampled
+                points and target labels between several calls
+
         Returns:
             A list of size batch_size, containing tuples of (index_i, index_j) where:
                 - index_i is the indices of the selected predictions (in order)
@@ -176,7 +430,7 @@ class HungarianMatcher(nn.Module):
             For each batch element, it holds:
                 len(index_i) = len(index_j) = min(num_queries, num_target_boxes)
         """
-        return self.memory_efficient_forward(outputs, targets)
+        return self.memory_efficient_forward(outputs, targets, sampled_targets)
 
     def __repr__(self, _repr_indent=4):
         head = "Matcher " + self.__class__.__name__
@@ -0,0 +1,276 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Batched post-processing helpers used by MaskFormer inference.
+"""
+import contextlib
+import logging
+import math
+import time
+from collections import defaultdict
+
+import torch
+from torch.nn import functional as F
+
+from detectron2.utils.logger import log_every_n_seconds
+
+
+def batched_sem_seg_postprocess(results, img_size, output_height, output_width):
+    """
+    Batched version of :func:`detectron2.modeling.postprocessing.sem_seg_postprocess`.
+
+    Args:
+        results (Tensor): predictions of shape (B, C, H, W), where all images of the
+            batch share the same unpadded input size.
+        img_size (tuple): image size (height, width) that the model is taking as input,
+            i.e. before padding.
+        output_height, output_width: the desired output resolution.
+
+    Returns:
+        Tensor of shape (B, C, output_height, output_width).
+    """
+    results = results[:, :, : img_size[0], : img_size[1]]
+    return F.interpolate(
+        results, size=(output_height, output_width), mode="bilinear", align_corners=False
+    )
+
+
+def low_res_crop(results, img_size, stride):
+    """
+    Crop predictions made at a fraction of the padded input resolution to the smallest
+    region that covers the unpadded image.
+
+    Args:
+        results (Tensor): predictions of shape (..., h, w)
+        img_size (tuple): unpadded input size (height, width)
+        stride (tuple): number of input pixels per prediction pixel along (height, width)
+    """
+    crop_h = min(math.ceil(img_size[0] / stride[0]), results.shape[-2])
+    crop_w = min(math.ceil(img_size[1] / stride[1]), results.shape[-1])
+    return results[..., :crop_h, :crop_w]
+
+
+def low_res_sem_seg_postprocess(
+    results, img_size, stride, output_height, output_width, mode="bilinear"
+):
+    """
+    Counterpart of :func:`batched_sem_seg_postprocess` for predictions made at a fraction
+    of the padded input resolution (e.g. 1/4 for `mask_features`). The predictions are
+    resized once, straight to the output resolution, and stay aligned with the image:
+    the region cropped by :func:`low_res_crop` may extend past the image border, so it is
+    resized to its own extent at the output scale and the overhang is cropped afterwards.
+
+    Args:
+        results (Tensor): predictions of shape (B, C, h, w), cropped or not
+        img_size (tuple): unpadded input size (height, width)
+        stride (tuple): number of input pixels per prediction pixel along (height, width)
+        output_height, output_width: the desired output resolution
+        mode (str): "bilinear" for scores and logits, "nearest" for id maps
+
+    Returns:
+        Tensor of shape (B, C, output_height, output_width).
+    """
+    results = low_res_crop(results, img_size, stride)
+    size = (
+        max(round(results.shape[-2] * stride[0] * output_height / img_size[0]), output_height),
+        max(round(results.shape[-1] * stride[1] * output_width / img_size[1]), output_width),
+    )
+    if mode == "nearest":
+        # nearest interpolation is not implemented for integer tensors
+        results = F.interpolate(results.float(), size=size, mode=mode).to(results.dtype)
+    else:
+        results = F.interpolate(results, size=size, mode=mode, align_corners=False)
+    return results[:, :, :output_height, :output_width]
+
+
+def semantic_label_map(cls_prob, mask_prob, postprocess=None, chunk_size=64, return_confidence=False):
+    """
+    Semantic inference that directly returns the per-pixel arg-max label instead of the dense
+    (K, H, W) score map. The einsum and arg-max are streamed over chunks of `chunk_size`
+    classes, so at most `chunk_size` class maps are alive at any time. Every step is linear
+    per class, hence the result is the same as arg-max over the dense score map.
+
+    Args:
+        cls_prob (Tensor): class probabilities of shape (B, Q, K+1), including no-object
+        mask_prob (Tensor): mask probabilities of shape (B, Q, H, W)
+        postprocess (callable): if given, applied to the (B, C, H, W) scores of every chunk
+            before the arg-max, e.g. to crop and resize them to the output resolution
+        chunk_size (int): number of classes processed at once
+        return_confidence (bool): whether to also return the top-1 score of every pixel
+
+    Returns:
+        labels (Tensor): int16 label map of shape (B, H', W'). PyTorch has no uint16
+            dtype; int16 covers all datasets we support (ADE20K-full has 847 classes).
+        confidence (Tensor or None): top-1 score of shape (B, H', W')
+    """
+    cls_prob = cls_prob[..., :-1]
+    num_classes = cls_prob.shape[-1]
+    label_dtype = torch.int16 if num_classes <= torch.iinfo(torch.int16).max else torch.int32
+
+    best_score, best_label = None, None
+    for start in range(0, num_classes, chunk_size):
+        semseg = torch.einsum("bqc,bqhw->bchw", cls_prob[..., start : start + chunk_size], mask_prob)
+        if postprocess is not None:
+            semseg = postprocess(semseg)
+        score, label = semseg.max(1)
+        del semseg
+        label = (label + start).to(label_dtype)
+        if best_score is None:
+            best_score, best_label = score, label
+        else:
+            # strict comparison keeps the lowest class id on ties, like argmax
+            better = score > best_score
+            best_score = torch.where(better, score, best_score)
+            best_label = torch.where(better, label, best_label)
+
+    return best_label, (best_score if return_confidence else None)
+
+
+def masks_to_boxes(masks, scale=None):
+    """
+    Vectorized :meth:`BitMasks.get_bounding_boxes`: boxes (x0, y0, x1, y1) of binary masks
+    from row and column `any` reductions, with x1 and y1 one past the last foreground
+    pixel. Empty masks get all-zero boxes.
+
+    Args:
+        masks (Tensor): bool masks of shape (..., H, W)
+        scale (tuple): if given, (scale_y, scale_x) to rescale the boxes by, e.g. from
+            the resolution of `mask_features` to the output resolution
+
+    Returns:
+        Tensor: boxes of shape (..., 4)
+    """
+    height, width = masks.shape[-2:]
+    rows = masks.any(-1)
+    cols = masks.any(-2)
+    row_idx = torch.arange(height, device=masks.device)
+    col_idx = torch.arange(width, device=masks.device)
+    boxes = torch.stack(
+        [
+            torch.where(cols, col_idx, col_idx.new_tensor(width)).min(-1).values,
+            torch.where(rows, row_idx, row_idx.new_tensor(height)).min(-1).values,
+            torch.where(cols, col_idx, col_idx.new_tensor(-1)).max(-1).values + 1,
+            torch.where(rows, row_idx, row_idx.new_tensor(-1)).max(-1).values + 1,
+        ],
+        dim=-1,
+    ).float()
+    boxes = boxes * rows.any(-1, keepdim=True)
+    if scale is not None:
+        boxes = boxes * boxes.new_tensor([scale[1], scale[0], scale[1], scale[0]])
+    return boxes
+
+
+class InferenceCache(object):
+    """
+    Quantities shared by the semantic, panoptic and instance inference of a group of images,
+    each computed at most once and only when a task asks for it:
+
+    * cls_prob: softmax of the class logits, (B, Q, K+1)
+    * mask_prob: sigmoid of the mask logits, (B, Q, H, W)
+    * mask_fg: binarized masks of instance inference, `mask_pred > 0`, (B, Q, H, W)
+    * mask_area: area of each mask as panoptic inference measures it, `mask_prob >= 0.5`, (B, Q)
+    * mask_score: average `mask_prob` inside each binarized mask, (B, Q)
+
+    The two thresholds are those of the original per-image inference, so that results stay
+    bit-identical to it even for logits whose sigmoid rounds to exactly 0.5.
+    """
+
+    def __init__(self, mask_cls, mask_pred):
+        self.mask_cls = mask_cls
+        self.mask_pred = mask_pred
+        self._cache = {}
+
+    @classmethod
+    def get(cls, cache, mask_cls, mask_pred):
+        """
+        Return `cache` if it was built for exactly these tensors, or a new cache otherwise,
+        e.g. when `retry_if_cuda_oom` has moved the inputs to CPU.
+        """
+        if cache is not None and cache.mask_cls is mask_cls and cache.mask_pred is mask_pred:
+            return cache
+        return cls(mask_cls, mask_pred)
+
+    def _get(self, name, fn):
+        if name not in self._cache:
+            self._cache[name] = fn()
+        return self._cache[name]
+
+    @property
+    def cls_prob(self):
+        return self._get("cls_prob", lambda: F.softmax(self.mask_cls, dim=-1))
+
+    @property
+    def mask_prob(self):
+        return self._get("mask_prob", lambda: self.mask_pred.sigmoid())
+
+    @property
+    def mask_fg(self):
+        return self._get("mask_fg", lambda: self.mask_pred > 0)
+
+    @property
+    def mask_area(self):
+        return self._get("mask_area", lambda: (self.mask_prob >= 0.5).flatten(2).sum(-1))
+
+    @property
+    def mask_score(self):
+        return self._get(
+            "mask_score",
+            lambda: (self.mask_prob * self.mask_fg).flatten(2).sum(-1) / (self.mask_fg.flatten(2).sum(-1) + 1e-6),
+        )
+
+    def release(self, *names):
+        """
+        Drop cached quantities that no remaining task needs, to bound the peak memory.
+        """
+        for name in names:
+            self._cache.pop(name, None)
+
+    def materialize(self, masks=True):
+        """
+        Compute the shared quantities eagerly, e.g. to time them apart from the tasks.
+
+        Args:
+            masks (bool): whether to also compute the binarized masks and their statistics,
+                which only panoptic and instance inference use.
+        """
+        self.cls_prob, self.mask_prob
+        if masks:
+            self.mask_area, self.mask_score
+
+
+class InferenceTimer(object):
+    """
+    Measure the time of post-processing steps, synchronizing CUDA around every step, and
+    periodically log the average time per image of each step.
+    """
+
+    def __init__(self, enabled=False, log_period=10.0):
+        self.enabled = enabled
+        self.log_period = log_period
+        self.times = defaultdict(float)
+        self.num_images = 0
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        if not self.enabled:
+            yield
+            return
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        yield
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.times[name] += time.perf_counter() - start
+
+    def log(self, num_images):
+        if not self.enabled:
+            return
+        self.num_images += num_images
+        log_every_n_seconds(
+            logging.INFO,
+            "Post-processing time per image: "
+            + ", ".join(
+                "{} {:.2f} ms".format(name, 1000 * t / self.num_images) for name, t in self.times.items()
+            ),
+            n=self.log_period,
+        )
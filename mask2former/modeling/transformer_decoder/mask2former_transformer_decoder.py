@@ -9,17 +9,182 @@ from torch.nn import functional as F
 
 from detectron2.config import configurable
 from detectron2.layers import Conv2d
+from detectron2.utils.logger import log_every_n_seconds
 
 from .position_encoding import PositionEmbeddingSine
 from .maskformer_transformer_decoder import TRANSFORMER_DECODER_REGISTRY
 
 
+def masked_multihead_attention(
+    attn,
+    query,
+    key,
+    value,
+    attn_mask: Optional[Tensor] = None,
+    key_padding_mask: Optional[Tensor] = None,
+    use_sdpa: bool = False,
+):
+    """
+    Same as `attn(query, key, value, attn_mask=attn_mask)[0]` for a `nn.MultiheadAttention`,
+    but with a boolean mask of shape (N, L, S) shared by all heads, which is broadcast across
+    heads instead of being repeated to (N * num_heads, L, S).
+
+    Args:
+        attn (nn.MultiheadAttention): module whose projections are used
+        query: (L, N, E) queries
+        key, value: (S, N, E) keys and values
+        attn_mask: (N, L, S) or (L, S), True for the positions that are not allowed to attend
+        key_padding_mask: (N, S), True for the keys that are ignored
+        use_sdpa: whether to compute the attention with the fused
+            `F.scaled_dot_product_attention` (PyTorch >= 2.0) instead of explicit ops
+    Returns:
+        (L, N, E) attention outputs
+    """
+    # the packed input projection and the (L, N, E) layout are used below
+    assert attn._qkv_same_embed_dim, "Separate key and value dimensions are not supported"
+    assert not getattr(attn, "batch_first", False), "batch_first is not supported"
+    assert attn.bias_k is None and not attn.add_zero_attn, "bias_kv and add_zero_attn are not supported"
+    L, N, E = query.shape
+    S = key.shape[0]
+    num_heads = attn.num_heads
+    head_dim = E // num_heads
+    w_q, w_k, w_v = attn.in_proj_weight.chunk(3)
+    b_q, b_k, b_v = attn.in_proj_bias.chunk(3) if attn.in_proj_bias is not None else (None, None, None)
+    # (N, num_heads, L or S, head_dim)
+    q = F.linear(query, w_q, b_q).view(L, N, num_heads, head_dim).permute(1, 2, 0, 3)
+    k = F.linear(key, w_k, b_k).view(S, N, num_heads, head_dim).permute(1, 2, 0, 3)
+    v = F.linear(value, w_v, b_v).view(S, N, num_heads, head_dim).permute(1, 2, 0, 3)
+
+    # broadcastable to (N, num_heads, L, S)
+    if attn_mask is not None and attn_mask.dim() == 3:
+        attn_mask = attn_mask[:, None]
+    if key_padding_mask is not None:
+        key_padding_mask = key_padding_mask[:, None, None]
+        attn_mask = key_padding_mask if attn_mask is None else attn_mask | key_padding_mask
+    dropout = attn.dropout if attn.training else 0.0
+
+    if use_sdpa:
+        # boolean masks of scaled_dot_product_attention are True for the allowed positions
+        output = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=None if attn_mask is None else ~attn_mask, dropout_p=dropout
+        )
+    else:
+        weights = torch.matmul(q * head_dim ** -0.5, k.transpose(-2, -1))
+        if attn_mask is not None:
+            weights.masked_fill_(attn_mask, float("-inf"))
+        output = torch.matmul(F.dropout(weights.softmax(-1), p=dropout), v)
+    output = output.permute(2, 0, 1, 3).reshape(L, N, E)
+    return attn.out_proj(output)
+
+
+def resolve_attention_backend(attention_backend):
+    """
+    Returns the attention backend to use: "sdpa" falls back to "native" when
+    `F.scaled_dot_product_attention` is not available.
+    """
+    assert attention_backend in ["native", "sdpa"], attention_backend
+    if attention_backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+        logging.getLogger(__name__).warning(
+            "scaled_dot_product_attention requires PyTorch >= 2.0, using the native attention backend."
+        )
+        return "native"
+    return attention_backend
+
+
+def converged_images(prev_state, state, class_agreement, mask_iou, no_object_label):
+    """
+    Compare the predictions of two consecutive decoder layers.
+
+    Args:
+        prev_state, state: tuples of (B, Q) class labels and (B, Q, N) boolean masks
+        class_agreement (float): minimum fraction of queries whose label did not change
+        mask_iou (float): minimum mean IoU between the masks of the queries that are not
+            predicted as no-object
+        no_object_label (int):
+    Returns:
+        (B,) bool, whether the predictions of every image have converged
+    """
+    prev_labels, prev_masks = prev_state
+    labels, masks = state
+    same_label = (labels == prev_labels).float().mean(1)
+    intersection = (masks & prev_masks).sum(-1).float()
+    union = (masks | prev_masks).sum(-1).float()
+    iou = torch.where(union > 0, intersection / union.clamp(min=1), torch.ones_like(union))
+    objects = (labels != no_object_label).float()
+    mean_iou = (iou * objects).sum(1) / objects.sum(1).clamp(min=1)
+    mean_iou = torch.where(objects.sum(1) > 0, mean_iou, torch.ones_like(mean_iou))
+    return (same_label >= class_agreement) & (mean_iou >= mask_iou)
+
+
+class EarlyExitStats:
+    """
+    Decoder depth of early-exit inference, logged periodically. Two depths are recorded per
+    image: the number of layers run, which all images of a batch share since a batch only
+    exits once all its images have converged, and the number of layers after which the image
+    itself converged, i.e. its depth with a batch size of 1.
+    """
+
+    def __init__(self, num_layers, log_period=60):
+        self.num_layers = num_layers
+        self.log_period = log_period
+        self.reset()
+
+    def update(self, depth, image_depths):
+        """
+        Args:
+            depth (int): number of layers run on the batch
+            image_depths (list[int]): number of layers after which every image of the batch
+                converged, `depth` for the images that did not converge
+        """
+        self.run_counts[depth] += len(image_depths)
+        for d in image_depths:
+            self.counts[d] += 1
+        summary = self.summary()
+        log_every_n_seconds(
+            logging.INFO,
+            "Decoder early exit over {} images: {:.2f} of {} layers run per image on average "
+            "({:.1f}% skipped), images converge after {:.2f} layers on average".format(
+                summary["num_images"],
+                summary["average_run_depth"],
+                self.num_layers,
+                100 * (1 - summary["average_run_depth"] / max(self.num_layers, 1)),
+                summary["average_depth"],
+            ),
+            n=self.log_period,
+        )
+
+    def summary(self):
+        """
+        Returns:
+            dict: "num_images", "average_depth" and "counts", the number of images per
+                convergence layer, and "average_run_depth" and "run_counts", the number of
+                images per number of layers run
+        """
+        num_images = sum(self.counts)
+
+        def average(counts):
+            return sum(depth * count for depth, count in enumerate(counts)) / max(num_images, 1)
+
+        return {
+            "num_images": num_images,
+            "average_depth": average(self.counts),
+            "counts": list(self.counts),
+            "average_run_depth": average(self.run_counts),
+            "run_counts": list(self.run_counts),
+        }
+
+    def reset(self):
+        self.counts = [0] * (self.num_layers + 1)
+        self.run_counts = [0] * (self.num_layers + 1)
+
+
 class SelfAttentionLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dropout=0.0,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attention_backend="native"):
         super().__init__()
         self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.use_sdpa = attention_backend == "sdpa"
 
         self.norm = nn.LayerNorm(d_model)
         self.dropout = nn.Dropout(dropout)
@@ -42,8 +207,12 @@ class SelfAttentionLayer(nn.Module):
                      tgt_key_padding_mask: Optional[Tensor] = None,
                      query_pos: Optional[Tensor] = None):
         q = k = self.with_pos_embed(tgt, query_pos)
-        tgt2 = self.self_attn(q, k, value=tgt, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)[0]
+        if self.use_sdpa:
+            tgt2 = masked_multihead_attention(self.self_attn, q, k, value=tgt, attn_mask=tgt_mask,
+                                              key_padding_mask=tgt_key_padding_mask, use_sdpa=True)
+        else:
+            tgt2 = self.self_attn(q, k, value=tgt, attn_mask=tgt_mask,
+                                  key_padding_mask=tgt_key_padding_mask)[0]
         tgt = tgt + self.dropout(tgt2)
         tgt = self.norm(tgt)
 
@@ -55,8 +224,12 @@ class SelfAttentionLayer(nn.Module):
                     query_pos: Optional[Tensor] = None):
         tgt2 = self.norm(tgt)
         q = k = self.with_pos_embed(tgt2, query_pos)
-        tgt2 = self.self_attn(q, k, value=tgt2, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)[0]
+        if self.use_sdpa:
+            tgt2 = masked_multihead_attention(self.self_attn, q, k, value=tgt2, attn_mask=tgt_mask,
+                                              key_padding_mask=tgt_key_padding_mask, use_sdpa=True)
+        else:
+            tgt2 = self.self_attn(q, k, value=tgt2, attn_mask=tgt_mask,
+                                  key_padding_mask=tgt_key_padding_mask)[0]
         tgt = tgt + self.dropout(tgt2)
         
         return tgt
@@ -73,11 +246,15 @@ class SelfAttentionLayer(nn.Module):
 
 
 class CrossAttentionLayer(nn.Module):
+    """
+    Cross-attention with a boolean `memory_mask` of shape (N, L, S), shared by all heads.
+    """
 
     def __init__(self, d_model, nhead, dropout=0.0,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attention_backend="native"):
         super().__init__()
         self.multihead_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.use_sdpa = attention_backend == "sdpa"
 
         self.norm = nn.LayerNorm(d_model)
         self.dropout = nn.Dropout(dropout)
@@ -100,10 +277,12 @@ class CrossAttentionLayer(nn.Module):
                      memory_key_padding_mask: Optional[Tensor] = None,
                      pos: Optional[Tensor] = None,
                      query_pos: Optional[Tensor] = None):
-        tgt2 = self.multihead_attn(query=self.with_pos_embed(tgt, query_pos),
-                                   key=self.with_pos_embed(memory, pos),
-                                   value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)[0]
+        tgt2 = masked_multihead_attention(self.multihead_attn,
+                                          query=self.with_pos_embed(tgt, query_pos),
+                                          key=self.with_pos_embed(memory, pos),
+                                          value=memory, attn_mask=memory_mask,
+                                          key_padding_mask=memory_key_padding_mask,
+                                          use_sdpa=self.use_sdpa)
         tgt = tgt + self.dropout(tgt2)
         tgt = self.norm(tgt)
         
@@ -115,10 +294,12 @@ class CrossAttentionLayer(nn.Module):
                     pos: Optional[Tensor] = None,
                     query_pos: Optional[Tensor] = None):
         tgt2 = self.norm(tgt)
-        tgt2 = self.multihead_attn(query=self.with_pos_embed(tgt2, query_pos),
-                                   key=self.with_pos_embed(memory, pos),
-                                   value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)[0]
+        tgt2 = masked_multihead_attention(self.multihead_attn,
+                                          query=self.with_pos_embed(tgt2, query_pos),
+                                          key=self.with_pos_embed(memory, pos),
+                                          value=memory, attn_mask=memory_mask,
+                                          key_padding_mask=memory_key_padding_mask,
+                                          use_sdpa=self.use_sdpa)
         tgt = tgt + self.dropout(tgt2)
 
         return tgt
@@ -247,6 +428,16 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         pre_norm: bool,
         mask_dim: int,
         enforce_input_project: bool,
+        attention_backend: str = "native",
+        pooled_inference: bool = False,
+        query_pruning: bool = False,
+        query_pruning_threshold: float = 0.9,
+        query_pruning_layer: int = 3,
+        early_exit: bool = False,
+        early_exit_min_layers: int = 3,
+        early_exit_max_layers: int = 0,
+        early_exit_class_agreement: float = 1.0,
+        early_exit_mask_iou: float = 0.95,
     ):
         """
         NOTE: this interface is experimental.
@@ -264,6 +455,20 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
             mask_dim: mask feature dimension
             enforce_input_project: add input project 1x1 conv even if input
                 channels and hidden dim is identical
+            attention_backend: "native" or "sdpa", to compute the attention of the decoder
+                layers with `F.scaled_dot_product_attention` when it is available
+            pooled_inference: whether to compute the intermediate attention masks from pooled
+                mask features at inference, see :meth:`forward_inference`
+            query_pruning: whether to drop the queries that are likely no-object after
+                `query_pruning_layer` layers at inference, see :meth:`forward_inference`
+            query_pruning_threshold: no-object probability above which queries are dropped
+            query_pruning_layer: number of layers run on all queries
+            early_exit: whether to stop decoding at inference once the predictions of
+                consecutive layers agree, see :meth:`forward_inference`
+            early_exit_min_layers: minimum number of layers run with early exit
+            early_exit_max_layers: maximum number of layers run with early exit, 0 for all
+            early_exit_class_agreement, early_exit_mask_iou: convergence thresholds, see
+                :func:`converged_images`
         """
         super().__init__()
 
@@ -280,6 +485,7 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         self.transformer_self_attention_layers = nn.ModuleList()
         self.transformer_cross_attention_layers = nn.ModuleList()
         self.transformer_ffn_layers = nn.ModuleList()
+        attention_backend = resolve_attention_backend(attention_backend)
 
         for _ in range(self.num_layers):
             self.transformer_self_attention_layers.append(
@@ -288,6 +494,7 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
                     nhead=nheads,
                     dropout=0.0,
                     normalize_before=pre_norm,
+                    attention_backend=attention_backend,
                 )
             )
 
@@ -297,6 +504,7 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
                     nhead=nheads,
                     dropout=0.0,
                     normalize_before=pre_norm,
+                    attention_backend=attention_backend,
                 )
             )
 
@@ -333,6 +541,27 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
             self.class_embed = nn.Linear(hidden_dim, num_classes + 1)
         self.mask_embed = MLP(hidden_dim, hidden_dim, mask_dim, 3)
 
+        self.pooled_inference = pooled_inference
+        if query_pruning:
+            # queries are pruned from their no-object probability
+            assert mask_classification, "Query pruning requires mask classification"
+            assert 0 < query_pruning_layer < self.num_layers, (
+                "query_pruning_layer must be in [1, {}), got {}".format(self.num_layers, query_pruning_layer)
+            )
+        self.query_pruning = query_pruning
+        self.query_pruning_threshold = query_pruning_threshold
+        self.query_pruning_layer = query_pruning_layer
+        self.early_exit = early_exit
+        self.early_exit_min_layers = early_exit_min_layers
+        assert 0 <= early_exit_max_layers <= self.num_layers, (
+            "early_exit_max_layers must be in [0, {}], got {}".format(self.num_layers, early_exit_max_layers)
+        )
+        self.early_exit_max_layers = early_exit_max_layers if early_exit_max_layers > 0 else self.num_layers
+        self.early_exit_class_agreement = early_exit_class_agreement
+        self.early_exit_mask_iou = early_exit_mask_iou
+        # decoder depths of early-exit inference, see EarlyExitStats.summary
+        self.early_exit_stats = EarlyExitStats(self.num_layers)
+
     @classmethod
     def from_config(cls, cfg, in_channels, mask_classification):
         ret = {}
@@ -357,6 +586,16 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         ret["enforce_input_project"] = cfg.MODEL.MASK_FORMER.ENFORCE_INPUT_PROJ
 
         ret["mask_dim"] = cfg.MODEL.SEM_SEG_HEAD.MASK_DIM
+        ret["attention_backend"] = cfg.MODEL.MASK_FORMER.ATTENTION_BACKEND
+        ret["pooled_inference"] = cfg.MODEL.MASK_FORMER.TEST.POOLED_INFERENCE
+        ret["query_pruning"] = cfg.MODEL.MASK_FORMER.TEST.DECODER_QUERY_PRUNING
+        ret["query_pruning_threshold"] = cfg.MODEL.MASK_FORMER.TEST.DECODER_QUERY_PRUNING_THRESHOLD
+        ret["query_pruning_layer"] = cfg.MODEL.MASK_FORMER.TEST.DECODER_QUERY_PRUNING_LAYER
+        ret["early_exit"] = cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT
+        ret["early_exit_min_layers"] = cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT_MIN_LAYERS
+        ret["early_exit_max_layers"] = cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT_MAX_LAYERS
+        ret["early_exit_class_agreement"] = cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT_CLASS_AGREEMENT
+        ret["early_exit_mask_iou"] = cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT_MASK_IOU
 
         return ret
 
@@ -385,6 +624,9 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         query_embed = self.query_embed.weight.unsqueeze(1).repeat(1, bs, 1)
         output = self.query_feat.weight.unsqueeze(1).repeat(1, bs, 1)
 
+        if (self.pooled_inference or self.query_pruning or self.early_exit) and not self.training:
+            return self.forward_inference(output, src, pos, size_list, query_embed, mask_features)
+
         predictions_class = []
         predictions_mask = []
 
@@ -394,26 +636,9 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         predictions_mask.append(outputs_mask)
 
         for i in range(self.num_layers):
-            level_index = i % self.num_feature_levels
-            attn_mask[torch.where(attn_mask.sum(-1) == attn_mask.shape[-1])] = False
-            # attention: cross-attention first
-            output = self.transformer_cross_attention_layers[i](
-                output, src[level_index],
-                memory_mask=attn_mask,
-                memory_key_padding_mask=None,  # here we do not apply masking on padded region
-                pos=pos[level_index], query_pos=query_embed
-            )
-
-            output = self.transformer_self_attention_layers[i](
-                output, tgt_mask=None,
-                tgt_key_padding_mask=None,
-                query_pos=query_embed
-            )
-            
-            # FFN
-            output = self.transformer_ffn_layers[i](
-                output
-            )
+            # queries whose mask is empty attend everywhere
+            attn_mask = attn_mask & ~attn_mask.all(-1, keepdim=True)
+            output = self.forward_layer(i, output, src, pos, attn_mask, query_embed)
 
             outputs_class, outputs_mask, attn_mask = self.forward_prediction_heads(output, mask_features, attn_mask_target_size=size_list[(i + 1) % self.num_feature_levels])
             predictions_class.append(outputs_class)
@@ -430,19 +655,165 @@ class MultiScaleMaskedTransformerDecoder(nn.Module):
         }
         return out
 
+    def forward_layer(self, i, output, src, pos, attn_mask, query_embed):
+        level_index = i % self.num_feature_levels
+        # attention: cross-attention first
+        output = self.transformer_cross_attention_layers[i](
+            output, src[level_index],
+            memory_mask=attn_mask,
+            memory_key_padding_mask=None,  # here we do not apply masking on padded region
+            pos=pos[level_index], query_pos=query_embed
+        )
+
+        output = self.transformer_self_attention_layers[i](
+            output, tgt_mask=None,
+            tgt_key_padding_mask=None,
+            query_pos=query_embed
+        )
+
+        # FFN
+        output = self.transformer_ffn_layers[i](
+            output
+        )
+        return output
+
+    def forward_inference(self, output, src, pos, size_list, query_embed, mask_features):
+        """
+        Inference without intermediate predictions: only the final layer predicts masks at
+        full resolution, and no "aux_outputs" are returned.
+
+        With `pooled_inference`, the attention masks of the intermediate layers are computed
+        directly at the size of their attention level, from mask features pooled once per
+        level. Since the mask head is linear, this is the same as interpolating the full
+        resolution masks, up to rounding.
+
+        With `query_pruning`, the queries whose no-object probability exceeds
+        `query_pruning_threshold` after `query_pruning_layer` layers are dropped: the later
+        layers only run on the other queries, and the dropped queries keep the predictions of
+        that layer. The outputs still have one prediction per query, in the original order.
+
+        With `early_exit`, decoding stops after the first layer (between
+        `early_exit_min_layers` and `early_exit_max_layers`) whose class labels and masks agree
+        with the ones of the previous layer for all images of the batch. The predictions are
+        the ones computed anyway for the attention mask of the next layer, compared at the
+        size of the first attention level. The depths are recorded in `early_exit_stats`.
+        """
+        if self.pooled_inference:
+            pooled_mask_features = [
+                F.interpolate(mask_features, size=size, mode="bilinear", align_corners=False)
+                for size in size_list
+            ]
+        num_layers = self.early_exit_max_layers if self.early_exit else self.num_layers
+        depth = num_layers
+        # [B] number of layers after which every image converged
+        image_depths = torch.full((output.shape[1],), num_layers, dtype=torch.int64, device=output.device)
+        prev_state = None
+        all_output = None
+        for i in range(num_layers):
+            if self.query_pruning and i == self.query_pruning_layer:
+                # [M, B, C] index of the queries that are still decoded
+                all_output = output
+                index = self.select_queries(output)[..., None].expand(-1, -1, output.shape[-1])
+                output = output.gather(0, index)
+                query_embed = query_embed.gather(0, index)
+                # predictions of different query sets cannot be compared
+                prev_state = None
+
+            level_index = i % self.num_feature_levels
+            if self.pooled_inference:
+                outputs_class, outputs_mask = self.forward_inference_heads(
+                    output, pooled_mask_features[level_index], None
+                )
+            else:
+                outputs_class, outputs_mask = self.forward_inference_heads(
+                    output, mask_features, size_list[level_index]
+                )
+
+            if self.early_exit:
+                # predictions of the output of the first i layers
+                state = self.convergence_state(outputs_class, outputs_mask, size_list[0])
+                if prev_state is not None and i >= self.early_exit_min_layers:
+                    converged = converged_images(
+                        prev_state,
+                        state,
+                        self.early_exit_class_agreement,
+                        self.early_exit_mask_iou,
+                        self.class_embed.out_features - 1,
+                    )
+                    image_depths = torch.where(
+                        converged & (image_depths == num_layers), image_depths.new_tensor(i), image_depths
+                    )
+                    if bool(converged.all()):
+                        depth = i
+                        break
+                prev_state = state
+
+            attn_mask = (outputs_mask.sigmoid().flatten(2) < 0.5).detach()
+            attn_mask = attn_mask & ~attn_mask.all(-1, keepdim=True)
+            output = self.forward_layer(i, output, src, pos, attn_mask, query_embed)
+
+        if self.early_exit:
+            self.early_exit_stats.update(depth, image_depths.tolist())
+        if all_output is not None:
+            output = all_output.scatter(0, index, output)
+        outputs_class, outputs_mask, _ = self.forward_prediction_heads(output, mask_features, None)
+        return {"pred_logits": outputs_class, "pred_masks": outputs_mask}
+
+    def forward_inference_heads(self, output, mask_features, target_size):
+        """
+        Prediction heads of :meth:`forward_inference`, whose masks give the attention mask of
+        the next layer.
+
+        Returns:
+            (B, Q, K + 1) class logits, only with `early_exit` (None otherwise), and
+            (B, Q, H, W) mask logits at `target_size`, or at the size of `mask_features` if None
+        """
+        decoder_output = self.decoder_norm(output).transpose(0, 1)
+        outputs_class = self.class_embed(decoder_output) if self.early_exit else None
+        outputs_mask = torch.einsum("bqc,bchw->bqhw", self.mask_embed(decoder_output), mask_features)
+        if target_size is not None:
+            outputs_mask = F.interpolate(outputs_mask, size=target_size, mode="bilinear", align_corners=False)
+        return outputs_class, outputs_mask
+
+    @staticmethod
+    def convergence_state(outputs_class, outputs_mask, size):
+        """
+        Returns:
+            (B, Q) class labels and (B, Q, H*W) foreground masks at `size`, to compare
+            consecutive layers with :func:`converged_images`
+        """
+        if outputs_mask.shape[-2:] != size:
+            outputs_mask = F.interpolate(outputs_mask, size=size, mode="bilinear", align_corners=False)
+        return outputs_class.argmax(-1), outputs_mask.flatten(2) > 0
+
+    def select_queries(self, output):
+        """
+        Returns:
+            (M, B) indices of the queries of every image that are not pruned, in their original
+            order. M is the largest number of such queries in the batch, the images with fewer
+            of them keep their M queries with the lowest no-object probabilities.
+        """
+        decoder_output = self.decoder_norm(output)
+        no_object_prob = self.class_embed(decoder_output).softmax(-1)[..., -1]
+        num_kept = max(int((no_object_prob <= self.query_pruning_threshold).sum(0).max()), 1)
+        return (-no_object_prob).topk(num_kept, dim=0)[1].sort(dim=0)[0]
+
     def forward_prediction_heads(self, output, mask_features, attn_mask_target_size):
         decoder_output = self.decoder_norm(output)
         decoder_output = decoder_output.transpose(0, 1)
         outputs_class = self.class_embed(decoder_output)
         mask_embed = self.mask_embed(decoder_output)
         outputs_mask = torch.einsum("bqc,bchw->bqhw", mask_embed, mask_features)
+        if attn_mask_target_size is None:
+            # no next layer
+            return outputs_class, outputs_mask, None
 
         # NOTE: prediction is of higher-resolution
-        # [B, Q, H, W] -> [B, Q, H*W] -> [B, h, Q, H*W] -> [B*h, Q, HW]
+        # [B, Q, H, W] -> [B, Q, H*W], shared by all heads
         attn_mask = F.interpolate(outputs_mask, size=attn_mask_target_size, mode="bilinear", align_corners=False)
         # must use bool type
         # If a BoolTensor is provided, positions with ``True`` are not allowed to attend while ``False`` values will be unchanged.
-        attn_mask = (attn_mask.sigmoid().flatten(2).unsqueeze(1).repeat(1, self.num_heads, 1, 1).flatten(0, 1) < 0.5).bool()
+        attn_mask = (attn_mask.sigmoid().flatten(2) < 0.5).bool()
         attn_mask = attn_mask.detach()
 
         return outputs_class, outputs_mask, attn_mask
@@ -38,6 +38,9 @@ class SemanticSegmentorWithTTA(nn.Module):
         if isinstance(model, DistributedDataParallel):
             model = model.module
         self.cfg = cfg.clone()
+        assert cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_OUTPUT == "logits", (
+            "Test-time augmentation averages semantic scores and does not support label map outputs."
+        )
 
         self.model = model
 
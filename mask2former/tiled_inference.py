@@ -0,0 +1,299 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torch.nn.parallel import DistributedDataParallel
+
+from detectron2.structures import Boxes, Instances
+
+from .modeling.postprocessing import masks_to_boxes
+
+
+__all__ = [
+    "MaskFormerWithTiling",
+]
+
+
+def _tile_starts(size, tile_size, overlap):
+    """
+    Start offsets of the tiles covering [0, size) along one axis. The last tile is aligned
+    with the end of the axis, so it may overlap its neighbor by more than `overlap`.
+    """
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, size - tile_size, stride))
+    return starts + [size - tile_size]
+
+
+def _tile_cores(starts, size, tile_size):
+    """
+    Split [0, size) into one core interval per tile: the pixels closer to the center of
+    that tile than to the center of its neighbors. Every pixel belongs to exactly one core.
+    """
+    ends = [min(start + tile_size, size) for start in starts]
+    bounds = [0] + [(end + start) // 2 for end, start in zip(ends[:-1], starts[1:])] + [size]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _blending_weights(size, overlap, device):
+    # linear ramp over `overlap` pixels from every border, strictly positive everywhere
+    idx = torch.arange(size, device=device, dtype=torch.float32)
+    dist = torch.min(idx + 0.5, size - idx - 0.5)
+    return (dist / max(overlap, 1)).clamp(max=1.0)
+
+
+class MaskFormerWithTiling(nn.Module):
+    """
+    A MaskFormer with tiled sliding-window inference, for images much larger than the
+    training crops. Every image is split into overlapping tiles that are run through the
+    model in batches, and the per-tile outputs are stitched back together:
+
+    * "sem_seg": scores are blended with weights that decay linearly over the overlap.
+    * "panoptic_seg": every pixel takes the segment of the tile whose center is closest.
+      A "thing" segment reuses the id of an already stitched segment of the same category
+      when their IoU over the already stitched part of the tile is above `match_threshold`.
+      Stuff segments of the same category are merged, as in :meth:`MaskFormer.panoptic_inference`.
+    * "instances": instances of overlapping tiles with the same class and a mask IoU over
+      the tiles' intersection above `match_threshold` are merged into one instance,
+      with the union of their masks and the highest score.
+
+    Its :meth:`__call__` method has the same interface as :meth:`MaskFormer.forward`.
+    """
+
+    def __init__(self, cfg, model, tile_size=None, overlap=None, batch_size=None, match_threshold=0.5):
+        """
+        Args:
+            cfg (CfgNode):
+            model (MaskFormer): a MaskFormer to run on the tiles.
+            tile_size (int): size of the square tiles, in input pixels.
+                Defaults to `cfg.MODEL.MASK_FORMER.TEST.TILE_SIZE`.
+            overlap (int): minimum overlap between neighboring tiles, in input pixels.
+                Defaults to `cfg.MODEL.MASK_FORMER.TEST.TILE_OVERLAP`.
+            batch_size (int): number of tiles per forward call.
+                Defaults to `cfg.MODEL.MASK_FORMER.TEST.TILE_BATCH_SIZE`.
+            match_threshold (float): IoU above which segments or instances of different
+                tiles are considered the same.
+        """
+        super().__init__()
+        if isinstance(model, DistributedDataParallel):
+            model = model.module
+        self.cfg = cfg.clone()
+        assert (
+            not cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_ON or cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_OUTPUT == "logits"
+        ), "Tiled inference blends semantic scores and does not support label map outputs."
+
+        self.model = model
+        self.tile_size = tile_size or cfg.MODEL.MASK_FORMER.TEST.TILE_SIZE
+        self.overlap = cfg.MODEL.MASK_FORMER.TEST.TILE_OVERLAP if overlap is None else overlap
+        assert 0 <= self.overlap < self.tile_size, (self.overlap, self.tile_size)
+        self.batch_size = batch_size or cfg.MODEL.MASK_FORMER.TEST.TILE_BATCH_SIZE
+        self.match_threshold = match_threshold
+        self.test_topk_per_image = cfg.TEST.DETECTIONS_PER_IMAGE
+
+    def __call__(self, batched_inputs):
+        """
+        Same input/output format as :meth:`MaskFormer.forward`
+        """
+        # tiles of all images are batched together, so that all tiles except the ones of
+        # small images share the same size and need few forward calls
+        tile_inputs, tile_windows = [], []
+        for input in batched_inputs:
+            windows = self._get_windows(input["image"].shape[-2:])
+            for y0, y1, x0, x1 in windows:
+                tile_inputs.append(
+                    {"image": input["image"][:, y0:y1, x0:x1], "height": y1 - y0, "width": x1 - x0}
+                )
+            tile_windows.append(windows)
+
+        with torch.no_grad():
+            tile_outputs = []
+            for start in range(0, len(tile_inputs), self.batch_size):
+                tile_outputs.extend(self.model(tile_inputs[start : start + self.batch_size]))
+
+        processed_results = []
+        for input, windows in zip(batched_inputs, tile_windows):
+            outputs, tile_outputs = tile_outputs[: len(windows)], tile_outputs[len(windows) :]
+            processed_results.append(self._stitch_one_image(input, windows, outputs))
+        return processed_results
+
+    def _get_windows(self, image_size):
+        """
+        Returns:
+            list[tuple]: the (y0, y1, x0, x1) window of every tile, row by row
+        """
+        height, width = image_size
+        ys = _tile_starts(height, self.tile_size, self.overlap)
+        xs = _tile_starts(width, self.tile_size, self.overlap)
+        return [
+            (y, min(y + self.tile_size, height), x, min(x + self.tile_size, width)) for y in ys for x in xs
+        ]
+
+    def _stitch_one_image(self, input, windows, outputs):
+        """
+        Args:
+            input (dict): one input dict with "image" field being a CHW tensor
+            windows (list[tuple]): the windows of its tiles, see :meth:`_get_windows`
+            outputs (list[dict]): the model outputs of its tiles
+        Returns:
+            dict: one output dict
+        """
+        image_size = tuple(input["image"].shape[-2:])
+        output_size = (input.get("height", image_size[0]), input.get("width", image_size[1]))
+        result = {}
+        if "sem_seg" in outputs[0]:
+            sem_seg = self._stitch_semantic(windows, [x["sem_seg"] for x in outputs], image_size)
+            if output_size != image_size:
+                sem_seg = F.interpolate(sem_seg[None], size=output_size, mode="bilinear", align_corners=False)[0]
+            result["sem_seg"] = sem_seg
+        if "panoptic_seg" in outputs[0]:
+            panoptic_seg, segments_info = self._stitch_panoptic(
+                windows, [x["panoptic_seg"] for x in outputs], image_size
+            )
+            if output_size != image_size:
+                panoptic_seg = F.interpolate(panoptic_seg[None, None].float(), size=output_size, mode="nearest")
+                panoptic_seg = panoptic_seg[0, 0].int()
+            result["panoptic_seg"] = (panoptic_seg, segments_info)
+        if "instances" in outputs[0]:
+            result["instances"] = self._stitch_instances(
+                windows, [x["instances"] for x in outputs], image_size, output_size
+            )
+        return result
+
+    def _stitch_semantic(self, windows, tile_scores, image_size):
+        scores = tile_scores[0].new_zeros((tile_scores[0].shape[0],) + image_size)
+        total_weight = tile_scores[0].new_zeros(image_size)
+        for (y0, y1, x0, x1), tile_score in zip(windows, tile_scores):
+            weight = (
+                _blending_weights(y1 - y0, self.overlap, scores.device)[:, None]
+                * _blending_weights(x1 - x0, self.overlap, scores.device)[None, :]
+            )
+            scores[:, y0:y1, x0:x1] += tile_score * weight
+            total_weight[y0:y1, x0:x1] += weight
+        return scores / total_weight
+
+    def _stitch_panoptic(self, windows, tile_results, image_size):
+        device = tile_results[0][0].device
+        panoptic_seg = torch.zeros(image_size, dtype=torch.int32, device=device)
+        # pixels already written by the tile they belong to
+        stitched = torch.zeros(image_size, dtype=torch.bool, device=device)
+        segments_info = []
+        stuff_ids = {}
+
+        ys = sorted({(y0, y1) for y0, y1, _, _ in windows})
+        xs = sorted({(x0, x1) for _, _, x0, x1 in windows})
+        y_cores = dict(zip(ys, _tile_cores([y0 for y0, _ in ys], image_size[0], self.tile_size)))
+        x_cores = dict(zip(xs, _tile_cores([x0 for x0, _ in xs], image_size[1], self.tile_size)))
+
+        for (y0, y1, x0, x1), (tile_seg, tile_segments_info) in zip(windows, tile_results):
+            tile_seg = tile_seg.long()
+            num_local = int(tile_seg.max()) + 1
+            num_global = len(segments_info) + 1
+
+            # IoU between the tile segments and the stitched segments, over the stitched pixels
+            overlap = stitched[y0:y1, x0:x1]
+            pairs = tile_seg[overlap] * num_global + panoptic_seg[y0:y1, x0:x1][overlap].long()
+            intersection = torch.bincount(pairs, minlength=num_local * num_global).view(num_local, num_global)
+            local_area = intersection.sum(1, keepdim=True)
+            global_area = intersection.sum(0, keepdim=True)
+            iou = (intersection.double() / (local_area + global_area - intersection).clamp(min=1)).cpu()
+
+            local_to_global = torch.zeros(num_local, dtype=torch.int32)
+            for info in tile_segments_info:
+                category_id, isthing = info["category_id"], info["isthing"]
+                if not isthing and category_id in stuff_ids:
+                    local_to_global[info["id"]] = stuff_ids[category_id]
+                    continue
+                if isthing:
+                    # only segments stitched by previous tiles, `iou` has no column for new ones
+                    candidates = [
+                        s["id"]
+                        for s in segments_info[: num_global - 1]
+                        if s["isthing"] and s["category_id"] == category_id
+                    ]
+                    if candidates:
+                        best_iou, best = iou[info["id"], candidates].max(0)
+                        if best_iou >= self.match_threshold:
+                            local_to_global[info["id"]] = candidates[int(best)]
+                            continue
+                segment_id = len(segments_info) + 1
+                segments_info.append({"id": segment_id, "isthing": isthing, "category_id": category_id})
+                if not isthing:
+                    stuff_ids[category_id] = segment_id
+                local_to_global[info["id"]] = segment_id
+
+            # write the pixels of the tile core only
+            cy0, cy1 = y_cores[(y0, y1)]
+            cx0, cx1 = x_cores[(x0, x1)]
+            core_seg = tile_seg[cy0 - y0 : cy1 - y0, cx0 - x0 : cx1 - x0]
+            panoptic_seg[cy0:cy1, cx0:cx1] = local_to_global.to(device)[core_seg]
+            stitched[cy0:cy1, cx0:cx1] = True
+
+        # segments whose pixels all fell into the cores of other tiles
+        present = set(torch.unique(panoptic_seg).tolist())
+        segments_info = [s for s in segments_info if s["id"] in present]
+        return panoptic_seg, segments_info
+
+    def _stitch_instances(self, windows, tile_instances, image_size, output_size):
+        masks = [x.pred_masks > 0.5 for x in tile_instances]
+        classes = [x.pred_classes for x in tile_instances]
+        offsets = [0]
+        for x in tile_instances:
+            offsets.append(offsets[-1] + len(x))
+        num_instances = offsets[-1]
+
+        # union-find over all instances of all tiles
+        parent = list(range(num_instances))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for a, (ay0, ay1, ax0, ax1) in enumerate(windows):
+            for b in range(a + 1, len(windows)):
+                by0, by1, bx0, bx1 = windows[b]
+                y0, y1, x0, x1 = max(ay0, by0), min(ay1, by1), max(ax0, bx0), min(ax1, bx1)
+                if y0 >= y1 or x0 >= x1 or len(masks[a]) == 0 or len(masks[b]) == 0:
+                    continue
+                mask_a = masks[a][:, y0 - ay0 : y1 - ay0, x0 - ax0 : x1 - ax0].flatten(1).float()
+                mask_b = masks[b][:, y0 - by0 : y1 - by0, x0 - bx0 : x1 - bx0].flatten(1).float()
+                intersection = mask_a @ mask_b.T
+                union = mask_a.sum(1)[:, None] + mask_b.sum(1)[None, :] - intersection
+                iou = intersection / union.clamp(min=1)
+                iou[classes[a][:, None] != classes[b][None, :]] = 0
+                for i, j in (iou >= self.match_threshold).nonzero().tolist():
+                    parent[find(offsets[b] + j)] = find(offsets[a] + i)
+
+        # every group of merged instances keeps its highest score
+        device = masks[0].device
+        groups = [find(i) for i in range(num_instances)]
+        group_scores = {}
+        for group, score in zip(groups, torch.cat([x.scores for x in tile_instances]).tolist()):
+            group_scores[group] = max(group_scores.get(group, score), score)
+        roots = sorted(group_scores, key=group_scores.get, reverse=True)[: self.test_topk_per_image]
+        group_ids = torch.as_tensor(groups, dtype=torch.long, device=device)
+        root_to_output = torch.full((num_instances,), -1, dtype=torch.long, device=device)
+        root_to_output[torch.as_tensor(roots, dtype=torch.long, device=device)] = torch.arange(
+            len(roots), device=device
+        )
+
+        pred_masks = torch.zeros((len(roots),) + image_size, dtype=torch.uint8, device=device)
+        for (y0, y1, x0, x1), tile_masks, start, end in zip(windows, masks, offsets[:-1], offsets[1:]):
+            output_ids = root_to_output[group_ids[start:end]]
+            kept = output_ids >= 0
+            pred_masks[:, y0:y1, x0:x1].index_add_(0, output_ids[kept], tile_masks[kept].to(torch.uint8))
+
+        result = Instances(output_size)
+        pred_masks = pred_masks > 0
+        if output_size != image_size:
+            pred_masks = F.interpolate(pred_masks[None].float(), size=output_size, mode="nearest")[0] > 0
+        result.pred_masks = pred_masks.float()
+        if self.cfg.MODEL.MASK_FORMER.TEST.PRED_BOXES:
+            result.pred_boxes = Boxes(masks_to_boxes(pred_masks))
+        else:
+            result.pred_boxes = Boxes(torch.zeros(len(roots), 4))
+        result.scores = torch.as_tensor([group_scores[r] for r in roots], device=device)
+        result.pred_classes = torch.cat(classes)[torch.as_tensor(roots, dtype=torch.long, device=device)]
+        return result
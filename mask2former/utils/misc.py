@@ -7,6 +7,7 @@ Mostly copy-paste from torchvision references.
 """
 from typing import List, Optional
 
+import numpy as np
 import torch
 import torch.distributed as dist
 import torchvision
@@ -70,6 +71,38 @@ def nested_tensor_from_tensor_list(tensor_list: List[Tensor]):
     return NestedTensor(tensor, mask)
 
 
+class PaddedTargets(list):
+    """
+    The targets of a batch: a list of per-image dicts with "labels" and "masks", as
+    expected by the criterion and matcher, which also keeps the targets of all images
+    concatenated, so that they can be indexed without new padded copies.
+
+    Attributes:
+        masks (Tensor): [T, H_pad, W_pad] padded masks of all T targets of the batch, in the
+            dtype of the gt masks. The "masks" of every image are views of it.
+        labels (Tensor): [T] classes of all targets. The "labels" of every image are views of it.
+        offsets (list[int]): index of the first target of every image in `masks` and `labels`
+    """
+
+    def __init__(self, masks, labels, num_targets):
+        super().__init__(
+            {"labels": l, "masks": m} for l, m in zip(labels.split(num_targets), masks.split(num_targets))
+        )
+        self.masks = masks
+        self.labels = labels
+        self.offsets = np.cumsum([0] + list(num_targets[:-1])).tolist()
+
+    def flat_indices(self, indices):
+        """
+        Args:
+            indices (list[tuple[Tensor, Tensor]]): per-image (index_i, index_j) of the matcher
+        Returns:
+            Tensor: index in `masks` and `labels` of every matched target, in the order of
+                `indices`
+        """
+        return torch.cat([tgt + offset for (_, tgt), offset in zip(indices, self.offsets)])
+
+
 # _onnx_nested_tensor_from_tensor_list() is an implementation of
 # nested_tensor_from_tensor_list() that is supported by ONNX tracing.
 @torch.jit.unused
@@ -109,3 +142,26 @@ def is_dist_avail_and_initialized():
     if not dist.is_initialized():
         return False
     return True
+
+
+def id_lookup_table(id_map, size=None, fill=-1):
+    """
+    Turn a dict of integer ids, e.g. `metadata.stuff_dataset_id_to_contiguous_id`, into an
+    array `table` such that `table[key] == id_map[key]`, so that ids can be remapped with
+    a single gather. Keys missing from `id_map` map to `fill`.
+
+    Args:
+        id_map (dict[int, int]):
+        size (int): length of the table, defaults to `max(id_map) + 1`
+        fill (int): value of the keys missing from `id_map`
+    Returns:
+        np.ndarray: int64 array of shape (size,)
+    """
+    if size is None:
+        size = max(id_map, default=-1) + 1
+    table = np.full(size, fill, dtype=np.int64)
+    if id_map:
+        keys = np.fromiter(id_map.keys(), dtype=np.int64, count=len(id_map))
+        values = np.fromiter(id_map.values(), dtype=np.int64, count=len(id_map))
+        table[keys] = values
+    return table
@@ -10,6 +10,12 @@ from torch.nn import functional as F
 from detectron2.config import configurable
 from detectron2.layers import Conv2d
 
+from mask2former.modeling.transformer_decoder.mask2former_transformer_decoder import (
+    EarlyExitStats,
+    converged_images,
+    masked_multihead_attention,
+    resolve_attention_backend,
+)
 from mask2former.modeling.transformer_decoder.maskformer_transformer_decoder import TRANSFORMER_DECODER_REGISTRY
 
 from .position_encoding import PositionEmbeddingSine3D
@@ -18,9 +24,10 @@ from .position_encoding import PositionEmbeddingSine3D
 class SelfAttentionLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dropout=0.0,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attention_backend="native"):
         super().__init__()
         self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.use_sdpa = attention_backend == "sdpa"
 
         self.norm = nn.LayerNorm(d_model)
         self.dropout = nn.Dropout(dropout)
@@ -43,8 +50,12 @@ class SelfAttentionLayer(nn.Module):
                      tgt_key_padding_mask: Optional[Tensor] = None,
                      query_pos: Optional[Tensor] = None):
         q = k = self.with_pos_embed(tgt, query_pos)
-        tgt2 = self.self_attn(q, k, value=tgt, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)[0]
+        if self.use_sdpa:
+            tgt2 = masked_multihead_attention(self.self_attn, q, k, value=tgt, attn_mask=tgt_mask,
+                                              key_padding_mask=tgt_key_padding_mask, use_sdpa=True)
+        else:
+            tgt2 = self.self_attn(q, k, value=tgt, attn_mask=tgt_mask,
+                                  key_padding_mask=tgt_key_padding_mask)[0]
         tgt = tgt + self.dropout(tgt2)
         tgt = self.norm(tgt)
 
@@ -56,8 +67,12 @@ class SelfAttentionLayer(nn.Module):
                     query_pos: Optional[Tensor] = None):
         tgt2 = self.norm(tgt)
         q = k = self.with_pos_embed(tgt2, query_pos)
-        tgt2 = self.self_attn(q, k, value=tgt2, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)[0]
+        if self.use_sdpa:
+            tgt2 = masked_multihead_attention(self.self_attn, q, k, value=tgt2, attn_mask=tgt_mask,
+                                              key_padding_mask=tgt_key_padding_mask, use_sdpa=True)
+        else:
+            tgt2 = self.self_attn(q, k, value=tgt2, attn_mask=tgt_mask,
+                                  key_padding_mask=tgt_key_padding_mask)[0]
         tgt = tgt + self.dropout(tgt2)
         
         return tgt
@@ -74,11 +89,15 @@ class SelfAttentionLayer(nn.Module):
 
 
 class CrossAttentionLayer(nn.Module):
+    """
+    Cross-attention with a boolean `memory_mask` of shape (N, L, S), shared by all heads.
+    """
 
     def __init__(self, d_model, nhead, dropout=0.0,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attention_backend="native"):
         super().__init__()
         self.multihead_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.use_sdpa = attention_backend == "sdpa"
 
         self.norm = nn.LayerNorm(d_model)
         self.dropout = nn.Dropout(dropout)
@@ -101,10 +120,12 @@ class CrossAttentionLayer(nn.Module):
                      memory_key_padding_mask: Optional[Tensor] = None,
                      pos: Optional[Tensor] = None,
                      query_pos: Optional[Tensor] = None):
-        tgt2 = self.multihead_attn(query=self.with_pos_embed(tgt, query_pos),
-                                   key=self.with_pos_embed(memory, pos),
-                                   value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)[0]
+        tgt2 = masked_multihead_attention(self.multihead_attn,
+                                          query=self.with_pos_embed(tgt, query_pos),
+                                          key=self.with_pos_embed(memory, pos),
+                                          value=memory, attn_mask=memory_mask,
+                                          key_padding_mask=memory_key_padding_mask,
+                                          use_sdpa=self.use_sdpa)
         tgt = tgt + self.dropout(tgt2)
         tgt = self.norm(tgt)
         
@@ -116,10 +137,12 @@ class CrossAttentionLayer(nn.Module):
                     pos: Optional[Tensor] = None,
                     query_pos: Optional[Tensor] = None):
         tgt2 = self.norm(tgt)
-        tgt2 = self.multihead_attn(query=self.with_pos_embed(tgt2, query_pos),
-                                   key=self.with_pos_embed(memory, pos),
-                                   value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)[0]
+        tgt2 = masked_multihead_attention(self.multihead_attn,
+                                          query=self.with_pos_embed(tgt2, query_pos),
+                                          key=self.with_pos_embed(memory, pos),
+                                          value=memory, attn_mask=memory_mask,
+                                          key_padding_mask=memory_key_padding_mask,
+                                          use_sdpa=self.use_sdpa)
         tgt = tgt + self.dropout(tgt2)
 
         return tgt
@@ -250,6 +273,12 @@ class VideoMultiScaleMaskedTransformerDecoder(nn.Module):
         enforce_input_project: bool,
         # video related
         num_frames,
+        attention_backend: str = "native",
+        early_exit: bool = False,
+        early_exit_min_layers: int = 3,
+        early_exit_max_layers: int = 0,
+        early_exit_class_agreement: float = 1.0,
+        early_exit_mask_iou: float = 0.95,
     ):
         """
         NOTE: this interface is experimental.
@@ -267,6 +296,14 @@ class VideoMultiScaleMaskedTransformerDecoder(nn.Module):
             mask_dim: mask feature dimension
             enforce_input_project: add input project 1x1 conv even if input
                 channels and hidden dim is identical
+            attention_backend: "native" or "sdpa", to compute the attention of the decoder
+                layers with `F.scaled_dot_product_attention` when it is available
+            early_exit: whether to stop decoding at inference once the class labels and masks
+                of the whole video agree between consecutive layers
+            early_exit_min_layers: minimum number of layers run with early exit
+            early_exit_max_layers: maximum number of layers run with early exit, 0 for all
+            early_exit_class_agreement, early_exit_mask_iou: convergence thresholds, see
+                :func:`converged_images`
         """
         super().__init__()
 
@@ -274,6 +311,16 @@ class VideoMultiScaleMaskedTransformerDecoder(nn.Module):
         self.mask_classification = mask_classification
 
         self.num_frames = num_frames
+        self.early_exit = early_exit
+        self.early_exit_min_layers = early_exit_min_layers
+        assert 0 <= early_exit_max_layers <= dec_layers, (
+            "early_exit_max_layers must be in [0, {}], got {}".format(dec_layers, early_exit_max_layers)
+        )
+        self.early_exit_max_layers = early_exit_max_layers if early_exit_max_layers > 0 else dec_layers
+        self.early_exit_class_agreement = early_exit_class_agreement
+        self.early_exit_mask_iou = early_exit_mask_iou
+        # decoder depths of early-exit inference, see EarlyExitStats.summary
+        self.early_exit_stats = EarlyExitStats(dec_layers)
 
         # positional encoding
         N_steps = hidden_dim // 2
@@ -285,6 +332,7 @@ class VideoMultiScaleMaskedTransformerDecoder(nn.Module):
         self.transformer_self_attention_layers = nn.ModuleList()
         self.transformer_cross_attention_layers = nn.ModuleList()
         self.transformer_ffn_layers = nn.ModuleList()
+        attention_backend = resolve_attention_backend(attention_backend)
 
         for _ in range(self.num_layers):
             self.transformer_self_attention_layers.append(
@@ -293,6 +341,7 @@ class VideoMultiScaleMaskedTransformerDecoder(nn.Module):
                     nhead=nheads,
                     dropout=0.0,
                     normalize_before=pre_norm,
+                    attention_backend=attention_backend,
                 )
             )
 
@@ -302,6 +351,7 @@ class VideoMultiScaleMaskedTransformerDecoder(nn.Module):
                     nhead=nheads,
                     dropout=0.0,
                     normalize_before=pre_norm,
+                    attention_backend=attention_backend,
                 )
             )
 
@@ -362,9 +412,16 @@ class VideoMultiScaleMaskedTransformerDecoder(nn.Module):
         ret["enforce_input_project"] = cfg.MODEL.MASK_FORMER.ENFORCE_INPUT_PROJ
 
         ret["mask_dim"] = cfg.MODEL.SEM_SEG_HEAD.MASK_DIM
+        ret["attention_backend"] = cfg.MODEL.MASK_FORMER.ATTENTION_BACKEND
 
         ret["num_frames"] = cfg.INPUT.SAMPLING_FRAME_NUM
 
+        ret["early_exit"] = cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT
+        ret["early_exit_min_layers"] = cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT_MIN_LAYERS
+        ret["early_exit_max_layers"] = cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT_MAX_LAYERS
+        ret["early_exit_class_agreement"] = cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT_CLASS_AGREEMENT
+        ret["early_exit_mask_iou"] = cfg.MODEL.MASK_FORMER.TEST.EARLY_EXIT_MASK_IOU
+
         return ret
 
     def forward(self, x, mask_features, mask = None):
@@ -404,9 +461,13 @@ class VideoMultiScaleMaskedTransformerDecoder(nn.Module):
         predictions_class.append(outputs_class)
         predictions_mask.append(outputs_mask)
 
-        for i in range(self.num_layers):
+        # stop once the predictions of consecutive layers agree, at inference only
+        early_exit = self.early_exit and not self.training
+        num_layers = self.early_exit_max_layers if early_exit else self.num_layers
+        for i in range(num_layers):
             level_index = i % self.num_feature_levels
-            attn_mask[torch.where(attn_mask.sum(-1) == attn_mask.shape[-1])] = False
+            # queries whose mask is empty attend everywhere
+            attn_mask = attn_mask & ~attn_mask.all(-1, keepdim=True)
             # attention: cross-attention first
             output = self.transformer_cross_attention_layers[i](
                 output, src[level_index],
@@ -430,7 +491,26 @@ class VideoMultiScaleMaskedTransformerDecoder(nn.Module):
             predictions_class.append(outputs_class)
             predictions_mask.append(outputs_mask)
 
-        assert len(predictions_class) == self.num_layers + 1
+            if (
+                early_exit
+                and i + 1 >= self.early_exit_min_layers
+                and bool(
+                    converged_images(
+                        (predictions_class[-2].argmax(-1), predictions_mask[-2].flatten(2) > 0),
+                        (outputs_class.argmax(-1), outputs_mask.flatten(2) > 0),
+                        self.early_exit_class_agreement,
+                        self.early_exit_mask_iou,
+                        outputs_class.shape[-1] - 1,
+                    ).all()
+                )
+            ):
+                break
+
+        if early_exit:
+            # videos are decoded one at a time, the batch depth is the depth of the video
+            self.early_exit_stats.update(len(predictions_class) - 1, [len(predictions_class) - 1] * bs)
+        else:
+            assert len(predictions_class) == self.num_layers + 1
 
         out = {
             'pred_logits': predictions_class[-1],
@@ -450,12 +530,12 @@ class VideoMultiScaleMaskedTransformerDecoder(nn.Module):
         b, q, t, _, _ = outputs_mask.shape
 
         # NOTE: prediction is of higher-resolution
-        # [B, Q, T, H, W] -> [B, Q, T*H*W] -> [B, h, Q, T*H*W] -> [B*h, Q, T*HW]
+        # [B, Q, T, H, W] -> [B, Q, T*H*W], shared by all heads
         attn_mask = F.interpolate(outputs_mask.flatten(0, 1), size=attn_mask_target_size, mode="bilinear", align_corners=False).view(
             b, q, t, attn_mask_target_size[0], attn_mask_target_size[1])
         # must use bool type
         # If a BoolTensor is provided, positions with ``True`` are not allowed to attend while ``False`` values will be unchanged.
-        attn_mask = (attn_mask.sigmoid().flatten(2).unsqueeze(1).repeat(1, self.num_heads, 1, 1).flatten(0, 1) < 0.5).bool()
+        attn_mask = (attn_mask.sigmoid().flatten(2) < 0.5).bool()
         attn_mask = attn_mask.detach()
 
         return outputs_class, outputs_mask, attn_mask
@@ -47,7 +47,10 @@ class Predictor(cog.Predictor):
         v = Visualizer(im[:, :, ::-1], self.coco_metadata, scale=1.2, instance_mode=ColorMode.IMAGE_BW)
         instance_result = v.draw_instance_predictions(outputs["instances"].to("cpu")).get_image()
         v = Visualizer(im[:, :, ::-1], self.coco_metadata, scale=1.2, instance_mode=ColorMode.IMAGE_BW)
-        semantic_result = v.draw_sem_seg(outputs["sem_seg"].argmax(0).to("cpu")).get_image()
+        sem_seg = outputs["sem_seg"]
+        # "sem_seg" holds class ids already when TEST.SEMANTIC_OUTPUT is "label_map"
+        sem_seg = sem_seg.argmax(0) if sem_seg.dim() == 3 else sem_seg.long()
+        semantic_result = v.draw_sem_seg(sem_seg.to("cpu")).get_image()
         result = np.concatenate((panoptic_result, instance_result, semantic_result), axis=0)[:, :, ::-1]
         out_path = Path(tempfile.mkdtemp()) / "out.png"
         cv2.imwrite(str(out_path), result)
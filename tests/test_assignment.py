@@ -0,0 +1,53 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import unittest
+
+import torch
+from scipy.optimize import linear_sum_assignment
+
+from mask2former.modeling.assignment import (
+    auction_linear_sum_assignment,
+    batched_linear_sum_assignment,
+)
+
+
+class TestBatchedLinearSumAssignment(unittest.TestCase):
+    def _check(self, device):
+        torch.manual_seed(0)
+        num_queries = 10
+        # the last problem has more targets than queries and goes to the scipy fallback
+        costs = [torch.rand(num_queries, n, device=device) for n in (3, 7, 0, 12)]
+        results = batched_linear_sum_assignment(costs, solver="auction")
+
+        self.assertEqual(len(results), len(costs))
+        for C, (i, j) in zip(costs, results):
+            self.assertEqual(i.device, C.device)
+            self.assertEqual(j.device, C.device)
+            self.assertEqual(i.dtype, torch.int64)
+            self.assertEqual(len(i), min(C.shape))
+            self.assertEqual(i.tolist(), sorted(i.tolist()))
+            # optimal up to the rounding of the costs by the auction solver
+            expected_i, expected_j = linear_sum_assignment(C.cpu())
+            expected = float(C.cpu()[expected_i, expected_j].sum())
+            self.assertAlmostEqual(float(C[i, j].sum()), expected, delta=1e-3)
+
+        # the criterion concatenates the indices of all images
+        torch.cat([i for i, _ in results])
+
+    def test_auction_on_cpu_uses_scipy(self):
+        self._check(torch.device("cpu"))
+
+    def test_auction_solver(self):
+        torch.manual_seed(0)
+        costs = [torch.rand(10, n) for n in (1, 5, 10)]
+        for C, r in zip(costs, auction_linear_sum_assignment(costs)):
+            self.assertIsNotNone(r)
+            expected_i, expected_j = linear_sum_assignment(C)
+            self.assertAlmostEqual(float(C[r].sum()), float(C[expected_i, expected_j].sum()), delta=1e-3)
+
+    @unittest.skipIf(not torch.cuda.is_available(), "CUDA not available")
+    def test_auction_with_fallback_cuda(self):
+        self._check(torch.device("cuda"))
+
+
+if __name__ == "__main__":
+    unittest.main()
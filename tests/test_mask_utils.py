@@ -0,0 +1,53 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import unittest
+
+import torch
+
+from mask2former.data.mask_utils import downsample_masks
+
+
+def coverage_reference(masks, factor):
+    # fraction of every factor x factor cell covered by the mask, cells past the border are empty
+    N, H, W = masks.shape
+    h, w = -(-H // factor), -(-W // factor)
+    coverage = torch.zeros(N, h, w)
+    for y in range(h):
+        for x in range(w):
+            cell = masks[:, y * factor : (y + 1) * factor, x * factor : (x + 1) * factor]
+            coverage[:, y, x] = cell.flatten(1).float().sum(1) / factor ** 2
+    return coverage
+
+
+class TestDownsampleMasks(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        # sizes that are not multiples of the factor
+        self.masks = torch.rand(5, 18, 23) > 0.5
+
+    def test_factor_one(self):
+        self.assertIs(downsample_masks(self.masks, 1), self.masks)
+
+    def test_area(self):
+        output = downsample_masks(self.masks, 4)
+        self.assertEqual(output.dtype, torch.bool)
+        self.assertEqual(output.shape, (5, 5, 6))
+        self.assertTrue(torch.equal(output, coverage_reference(self.masks, 4) >= 0.5))
+
+    def test_soft(self):
+        output = downsample_masks(self.masks, 4, mode="soft")
+        self.assertEqual(output.dtype, torch.float16)
+        self.assertTrue(torch.allclose(output.float(), coverage_reference(self.masks, 4), atol=1e-3))
+
+    def test_chunks_and_dtypes(self):
+        expected = downsample_masks(self.masks, 3)
+        self.assertTrue(torch.equal(downsample_masks(self.masks, 3, chunk_size=2), expected))
+        self.assertTrue(torch.equal(downsample_masks(self.masks.to(torch.uint8), 3), expected))
+        self.assertTrue(torch.equal(downsample_masks(self.masks.float(), 3), expected))
+
+    def test_empty(self):
+        output = downsample_masks(torch.zeros(0, 18, 23), 4)
+        self.assertEqual(output.shape, (0, 5, 6))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import unittest
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from mask2former.modeling.transformer_decoder.mask2former_transformer_decoder import (
+    masked_multihead_attention,
+)
+
+
+class TestMaskedMultiheadAttention(unittest.TestCase):
+    def _inputs(self, device):
+        torch.manual_seed(0)
+        num_heads = 8
+        attn = nn.MultiheadAttention(64, num_heads).eval().to(device)
+        # (L, N, E) queries and (S, N, E) keys
+        query = torch.randn(10, 2, 64, device=device)
+        key = torch.randn(30, 2, 64, device=device)
+        value = torch.randn(30, 2, 64, device=device)
+        attn_mask = torch.rand(2, 10, 30, device=device) > 0.5
+        # an empty mask, which the decoder turns into attention everywhere
+        attn_mask[0, 3] = True
+        attn_mask = attn_mask & ~attn_mask.all(-1, keepdim=True)
+        return attn, query, key, value, attn_mask
+
+    def _check(self, device, autocast_dtype=None, atol=1e-5):
+        attn, query, key, value, attn_mask = self._inputs(device)
+        # the mask repeated across heads, as the decoder did before broadcasting it
+        repeated_mask = attn_mask.repeat_interleave(attn.num_heads, dim=0)
+        backends = [False]
+        if hasattr(F, "scaled_dot_product_attention"):
+            backends.append(True)
+        with torch.no_grad(), torch.autocast(
+            device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None
+        ):
+            reference = attn(query, key, value, attn_mask=repeated_mask)[0]
+            for use_sdpa in backends:
+                output = masked_multihead_attention(
+                    attn, query, key, value, attn_mask=attn_mask, use_sdpa=use_sdpa
+                )
+                self.assertEqual(output.dtype, reference.dtype)
+                self.assertTrue(
+                    torch.allclose(output.float(), reference.float(), atol=atol), "use_sdpa={}".format(use_sdpa)
+                )
+
+    def test_cpu(self):
+        self._check(torch.device("cpu"))
+
+    def test_cpu_autocast_bfloat16(self):
+        self._check(torch.device("cpu"), torch.bfloat16, atol=5e-2)
+
+    @unittest.skipIf(not torch.cuda.is_available(), "CUDA not available")
+    def test_cuda(self):
+        self._check(torch.device("cuda"), atol=1e-4)
+
+    @unittest.skipIf(not torch.cuda.is_available(), "CUDA not available")
+    def test_cuda_autocast_float16(self):
+        self._check(torch.device("cuda"), torch.float16, atol=1e-2)
+
+    def test_self_attention_without_mask(self):
+        attn, query, _, _, _ = self._inputs(torch.device("cpu"))
+        with torch.no_grad():
+            output = masked_multihead_attention(attn, query, query, query)
+            reference = attn(query, query, query)[0]
+            self.assertTrue(torch.allclose(output, reference, atol=1e-5))
+
+
+if __name__ == "__main__":
+    unittest.main()
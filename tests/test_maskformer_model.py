@@ -0,0 +1,236 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import unittest
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from detectron2.data.catalog import Metadata
+
+from mask2former.maskformer_model import MaskFormer
+
+NUM_CLASSES = 4
+THING_CLASSES = [0, 1]
+NUM_QUERIES = 12
+
+
+def build_model(**kwargs):
+    sem_seg_head = nn.Module()
+    sem_seg_head.num_classes = NUM_CLASSES
+    args = dict(
+        backbone=nn.Module(),
+        sem_seg_head=sem_seg_head,
+        criterion=nn.Module(),
+        num_queries=NUM_QUERIES,
+        object_mask_threshold=0.5,
+        overlap_threshold=0.8,
+        metadata=Metadata(thing_dataset_id_to_contiguous_id={10 + i: i for i in THING_CLASSES}),
+        size_divisibility=32,
+        sem_seg_postprocess_before_inference=True,
+        pixel_mean=[0.0, 0.0, 0.0],
+        pixel_std=[1.0, 1.0, 1.0],
+        semantic_on=True,
+        panoptic_on=True,
+        instance_on=True,
+        test_topk_per_image=20,
+    )
+    args.update(kwargs)
+    return MaskFormer(**args).eval()
+
+
+def random_predictions(num_images, height, width, seed):
+    generator = torch.Generator().manual_seed(seed)
+    mask_cls = torch.randn(num_images, NUM_QUERIES, NUM_CLASSES + 1, generator=generator) * 3
+    # smooth masks, so that queries cover overlapping regions
+    coarse = torch.randn(num_images, NUM_QUERIES, 4, 5, generator=generator) * 4
+    mask_pred = F.interpolate(coarse, size=(height, width), mode="bilinear", align_corners=False)
+    return mask_cls, mask_pred
+
+
+def baseline_panoptic_inference(model, mask_cls, mask_pred, stats):
+    """
+    The original per-query panoptic inference of a single image, counting in `stats` how
+    often a query is dropped by the overlap threshold and how often stuff regions merge.
+    """
+    scores, labels = F.softmax(mask_cls, dim=-1).max(-1)
+    mask_pred = mask_pred.sigmoid()
+
+    keep = labels.ne(NUM_CLASSES) & (scores > model.object_mask_threshold)
+    cur_scores = scores[keep]
+    cur_classes = labels[keep]
+    cur_masks = mask_pred[keep]
+    cur_prob_masks = cur_scores.view(-1, 1, 1) * cur_masks
+
+    h, w = cur_masks.shape[-2:]
+    panoptic_seg = torch.zeros((h, w), dtype=torch.int32)
+    segments_info = []
+    current_segment_id = 0
+    if cur_masks.shape[0] == 0:
+        return panoptic_seg, segments_info
+
+    cur_mask_ids = cur_prob_masks.argmax(0)
+    stuff_memory_list = {}
+    for k in range(cur_classes.shape[0]):
+        pred_class = cur_classes[k].item()
+        isthing = pred_class in THING_CLASSES
+        mask_area = (cur_mask_ids == k).sum().item()
+        original_area = (cur_masks[k] >= 0.5).sum().item()
+        mask = (cur_mask_ids == k) & (cur_masks[k] >= 0.5)
+
+        if mask_area > 0 and original_area > 0 and mask.sum().item() > 0:
+            if mask_area / original_area < model.overlap_threshold:
+                stats["overlap_dropped"] += 1
+                continue
+
+            # merge stuff regions
+            if not isthing:
+                if int(pred_class) in stuff_memory_list.keys():
+                    panoptic_seg[mask] = stuff_memory_list[int(pred_class)]
+                    stats["stuff_merged"] += 1
+                    continue
+                else:
+                    stuff_memory_list[int(pred_class)] = current_segment_id + 1
+
+            current_segment_id += 1
+            panoptic_seg[mask] = current_segment_id
+            segments_info.append(
+                {"id": current_segment_id, "isthing": bool(isthing), "category_id": int(pred_class)}
+            )
+    return panoptic_seg, segments_info
+
+
+class TestPanopticInference(unittest.TestCase):
+    def test_matches_baseline(self):
+        stats = {"overlap_dropped": 0, "stuff_merged": 0}
+        for seed in range(20):
+            # a lower overlap threshold keeps more queries, and more stuff queries to merge
+            model = build_model(overlap_threshold=0.8 if seed % 2 else 0.3)
+            mask_cls, mask_pred = random_predictions(3, 24, 30, seed)
+            results = model.panoptic_inference(mask_cls, mask_pred)
+            self.assertEqual(len(results), 3)
+            for i, (panoptic_seg, segments_info) in enumerate(results):
+                expected_seg, expected_info = baseline_panoptic_inference(model, mask_cls[i], mask_pred[i], stats)
+                self.assertEqual(panoptic_seg.dtype, torch.int32)
+                self.assertTrue(torch.equal(panoptic_seg, expected_seg), seed)
+                self.assertEqual(segments_info, expected_info)
+
+            # a single image gives the same result as in a batch
+            panoptic_seg, segments_info = model.panoptic_inference(mask_cls[0], mask_pred[0])
+            self.assertTrue(torch.equal(panoptic_seg, results[0][0]))
+            self.assertEqual(segments_info, results[0][1])
+        # the random predictions cover both special cases of the baseline
+        self.assertGreater(stats["overlap_dropped"], 0)
+        self.assertGreater(stats["stuff_merged"], 0)
+
+    def test_stuff_merge(self):
+        model = build_model()
+        mask_cls = torch.zeros(1, NUM_QUERIES, NUM_CLASSES + 1)
+        mask_cls[..., -1] = 10.0
+        # two queries of the same stuff class on the two halves of the image, and a thing between
+        mask_cls[0, [3, 7], 2] = 20.0
+        mask_cls[0, 5, 0] = 20.0
+        mask_pred = torch.full((1, NUM_QUERIES, 8, 8), -10.0)
+        mask_pred[0, 3, :, :4] = 10.0
+        mask_pred[0, 7, :, 4:] = 10.0
+        mask_pred[0, 5, 2:4, 3:5] = 20.0
+        panoptic_seg, segments_info = model.panoptic_inference(mask_cls, mask_pred)[0]
+        self.assertEqual(
+            segments_info,
+            [{"id": 1, "isthing": False, "category_id": 2}, {"id": 2, "isthing": True, "category_id": 0}],
+        )
+        self.assertEqual((panoptic_seg == 1).sum().item(), 64 - 4)
+        self.assertEqual((panoptic_seg == 2).sum().item(), 4)
+
+    def test_no_object(self):
+        model = build_model()
+        mask_cls = torch.zeros(2, NUM_QUERIES, NUM_CLASSES + 1)
+        mask_cls[..., -1] = 10.0
+        for panoptic_seg, segments_info in model.panoptic_inference(mask_cls, torch.randn(2, NUM_QUERIES, 8, 8)):
+            self.assertFalse(panoptic_seg.any())
+            self.assertEqual(segments_info, [])
+
+
+def assert_same_results(test, results, expected):
+    test.assertEqual(len(results), len(expected))
+    for r, e in zip(results, expected):
+        test.assertEqual(sorted(r.keys()), sorted(e.keys()))
+        test.assertEqual(r["sem_seg"].shape, e["sem_seg"].shape)
+        test.assertTrue(torch.allclose(r["sem_seg"], e["sem_seg"], atol=1e-6))
+        test.assertTrue(torch.equal(r["panoptic_seg"][0], e["panoptic_seg"][0]))
+        test.assertEqual(r["panoptic_seg"][1], e["panoptic_seg"][1])
+        r_inst, e_inst = r["instances"], e["instances"]
+        test.assertEqual(r_inst.image_size, e_inst.image_size)
+        test.assertTrue(torch.equal(r_inst.pred_classes, e_inst.pred_classes))
+        test.assertTrue(torch.equal(r_inst.pred_masks, e_inst.pred_masks))
+        test.assertTrue(torch.equal(r_inst.pred_boxes.tensor, e_inst.pred_boxes.tensor))
+        test.assertTrue(torch.allclose(r_inst.scores, e_inst.scores, atol=1e-6))
+
+
+class TestBatchedPostprocessing(unittest.TestCase):
+    def test_batched_matches_per_image(self):
+        model = build_model()
+        mask_cls, mask_pred = random_predictions(4, 32, 32, seed=0)
+        # two groups of images sharing their input and output sizes, and a single image
+        image_sizes = [(30, 28), (25, 32), (30, 28), (30, 28)]
+        batched_inputs = [{"height": 60, "width": 56}, {}, {"height": 60, "width": 56}, {"height": 45, "width": 42}]
+
+        results = model.batched_inference(mask_cls, mask_pred, batched_inputs, image_sizes)
+        expected = []
+        for i, (input_per_image, image_size) in enumerate(zip(batched_inputs, image_sizes)):
+            height = input_per_image.get("height", image_size[0])
+            width = input_per_image.get("width", image_size[1])
+            expected.extend(
+                model.full_res_inference(mask_cls[i : i + 1], mask_pred[i : i + 1], image_size, height, width)
+            )
+        assert_same_results(self, results, expected)
+        self.assertEqual(results[1]["sem_seg"].shape, (NUM_CLASSES, 25, 32))
+
+    def test_label_map(self):
+        model = build_model(semantic_output="label_map", semantic_confidence=True, semantic_chunk_size=3)
+        mask_cls, mask_pred = random_predictions(2, 32, 32, seed=1)
+        results = model.batched_inference(mask_cls, mask_pred, [{"height": 40, "width": 50}] * 2, [(30, 28)] * 2)
+        expected = build_model().batched_inference(
+            mask_cls, mask_pred, [{"height": 40, "width": 50}] * 2, [(30, 28)] * 2
+        )
+        for r, e in zip(results, expected):
+            self.assertTrue(torch.equal(r["sem_seg"].long(), e["sem_seg"].argmax(0)))
+            self.assertTrue(torch.allclose(r["sem_seg_confidence"], e["sem_seg"].max(0).values))
+
+
+class TestLowResPostprocessing(unittest.TestCase):
+    def test_stride_one_matches_full_res(self):
+        model = build_model()
+        mask_cls, mask_pred = random_predictions(3, 32, 32, seed=2)
+        batched_inputs = [{"height": 32, "width": 32}] * 3
+        image_sizes = [(32, 32)] * 3
+        results = model.batched_inference(mask_cls, mask_pred, batched_inputs, image_sizes, stride=(1, 1))
+        expected = model.batched_inference(mask_cls, mask_pred, batched_inputs, image_sizes)
+        assert_same_results(self, results, expected)
+
+    def test_panoptic_block_masks(self):
+        # masks constant on 4x4 blocks give the same panoptic segmentation at 1/4 resolution
+        model = build_model(semantic_on=False, instance_on=False)
+        mask_cls, mask_pred = random_predictions(2, 8, 8, seed=3)
+        full_res_pred = mask_pred.repeat_interleave(4, dim=2).repeat_interleave(4, dim=3)
+        batched_inputs = [{"height": 32, "width": 32}] * 2
+        results = model.batched_inference(mask_cls, mask_pred, batched_inputs, [(32, 32)] * 2, stride=(4, 4))
+        expected = model.batched_inference(mask_cls, full_res_pred, batched_inputs, [(32, 32)] * 2)
+        for r, e in zip(results, expected):
+            self.assertTrue(torch.equal(r["panoptic_seg"][0], e["panoptic_seg"][0]))
+            self.assertEqual(r["panoptic_seg"][1], e["panoptic_seg"][1])
+
+    def test_output_sizes(self):
+        model = build_model()
+        mask_cls, mask_pred = random_predictions(3, 8, 8, seed=4)
+        image_sizes = [(30, 28), (25, 32), (30, 28)]
+        batched_inputs = [{"height": 60, "width": 56}, {}, {"height": 45, "width": 42}]
+        results = model.batched_inference(mask_cls, mask_pred, batched_inputs, image_sizes, stride=(4, 4))
+        for r, size in zip(results, [(60, 56), (25, 32), (45, 42)]):
+            self.assertEqual(r["sem_seg"].shape, (NUM_CLASSES,) + size)
+            self.assertEqual(r["panoptic_seg"][0].shape, size)
+            self.assertEqual(r["instances"].image_size, size)
+            self.assertEqual(r["instances"].pred_masks.shape[1:], size)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import unittest
+
+import numpy as np
+import torch
+
+from mask2former.utils.misc import PaddedTargets, id_lookup_table
+
+
+class TestIdLookupTable(unittest.TestCase):
+    def test_lookup(self):
+        id_map = {3: 0, 7: 1, 12: 2}
+        table = id_lookup_table(id_map)
+        self.assertEqual(table.dtype, np.int64)
+        self.assertEqual(table.shape, (13,))
+        for key in range(13):
+            self.assertEqual(table[key], id_map.get(key, -1))
+
+        ids = np.array([12, 3, 5, 7, 3])
+        self.assertEqual(table[ids].tolist(), [2, 0, -1, 1, 0])
+
+    def test_size_and_fill(self):
+        table = id_lookup_table({1: 4}, size=5, fill=255)
+        self.assertEqual(table.tolist(), [255, 4, 255, 255, 255])
+
+    def test_empty(self):
+        self.assertEqual(id_lookup_table({}).shape, (0,))
+        self.assertEqual(id_lookup_table({}, size=3).tolist(), [-1, -1, -1])
+
+
+class TestPaddedTargets(unittest.TestCase):
+    def setUp(self):
+        self.num_targets = [2, 0, 3]
+        self.masks = torch.rand(sum(self.num_targets), 6, 8) > 0.5
+        self.labels = torch.tensor([4, 1, 0, 2, 7])
+        self.targets = PaddedTargets(self.masks, self.labels, self.num_targets)
+
+    def test_per_image_views(self):
+        self.assertEqual(len(self.targets), len(self.num_targets))
+        start = 0
+        for target, n in zip(self.targets, self.num_targets):
+            self.assertEqual(target["masks"].shape, (n, 6, 8))
+            self.assertTrue(torch.equal(target["masks"], self.masks[start : start + n]))
+            self.assertTrue(torch.equal(target["labels"], self.labels[start : start + n]))
+            start += n
+        # views, not copies
+        self.assertEqual(self.targets[2]["masks"].data_ptr(), self.masks[2].data_ptr())
+        self.assertEqual(self.targets.offsets, [0, 2, 2])
+
+    def test_flat_indices(self):
+        indices = [
+            (torch.tensor([5, 9]), torch.tensor([1, 0])),
+            (torch.tensor([], dtype=torch.int64), torch.tensor([], dtype=torch.int64)),
+            (torch.tensor([0, 3, 4]), torch.tensor([2, 0, 1])),
+        ]
+        flat = self.targets.flat_indices(indices)
+        self.assertEqual(flat.tolist(), [1, 0, 4, 2, 3])
+        expected = torch.cat([t["labels"][j] for t, (_, j) in zip(self.targets, indices)])
+        self.assertTrue(torch.equal(self.labels[flat], expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import functools
+import unittest
+
+import torch
+
+from detectron2.structures import BitMasks
+
+from mask2former.modeling.postprocessing import (
+    InferenceCache,
+    batched_sem_seg_postprocess,
+    masks_to_boxes,
+    semantic_label_map,
+)
+
+
+class TestSemanticLabelMap(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        # (B, Q, K+1) class probabilities and (B, Q, H, W) mask probabilities
+        self.cls_prob = torch.randn(2, 10, 8).softmax(-1)
+        self.mask_prob = torch.rand(2, 10, 12, 16)
+
+    def dense_scores(self, postprocess=None):
+        semseg = torch.einsum("bqc,bqhw->bchw", self.cls_prob[..., :-1], self.mask_prob)
+        return semseg if postprocess is None else postprocess(semseg)
+
+    def test_chunks(self):
+        expected_score, expected_label = self.dense_scores().max(1)
+        # one class per chunk, chunks not dividing the number of classes, and a single chunk
+        for chunk_size in (1, 3, 7, 64):
+            labels, confidence = semantic_label_map(
+                self.cls_prob, self.mask_prob, chunk_size=chunk_size, return_confidence=True
+            )
+            self.assertEqual(labels.dtype, torch.int16)
+            self.assertTrue(torch.equal(labels.long(), expected_label), chunk_size)
+            self.assertTrue(torch.allclose(confidence, expected_score), chunk_size)
+
+    def test_postprocess(self):
+        postprocess = functools.partial(
+            batched_sem_seg_postprocess, img_size=(10, 13), output_height=25, output_width=31
+        )
+        expected = self.dense_scores(postprocess).argmax(1)
+        labels, confidence = semantic_label_map(self.cls_prob, self.mask_prob, postprocess, chunk_size=3)
+        self.assertEqual(labels.shape, (2, 25, 31))
+        self.assertIsNone(confidence)
+        self.assertTrue(torch.equal(labels.long(), expected))
+
+    def test_ties(self):
+        # identical classes: the lowest class id wins, like argmax
+        cls_prob = torch.ones(1, 4, 6) / 6
+        labels, _ = semantic_label_map(cls_prob, torch.rand(1, 4, 5, 5), chunk_size=2)
+        self.assertTrue((labels == 0).all())
+
+
+class TestMasksToBoxes(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        masks = torch.zeros(6, 20, 30, dtype=torch.bool)
+        masks[0, 3:9, 4:20] = True
+        masks[1, 0, 0] = True
+        masks[2, 19, 29] = True
+        masks[3, 5:7, :] = True
+        # masks[4] stays empty
+        masks[5] = torch.rand(20, 30) > 0.9
+        self.masks = masks
+
+    def test_matches_bitmasks(self):
+        expected = BitMasks(self.masks).get_bounding_boxes().tensor
+        boxes = masks_to_boxes(self.masks)
+        self.assertEqual(boxes.dtype, torch.float32)
+        self.assertTrue(torch.equal(boxes, expected))
+        self.assertTrue(torch.equal(boxes[4], torch.zeros(4)))
+
+    def test_batched(self):
+        masks = torch.stack([self.masks, self.masks.flip(-1)])
+        boxes = masks_to_boxes(masks)
+        self.assertEqual(boxes.shape, (2, 6, 4))
+        for masks_i, boxes_i in zip(masks, boxes):
+            self.assertTrue(torch.equal(boxes_i, BitMasks(masks_i).get_bounding_boxes().tensor))
+
+    def test_scale(self):
+        boxes = masks_to_boxes(self.masks, scale=(2.0, 4.0))
+        expected = masks_to_boxes(self.masks) * torch.tensor([4.0, 2.0, 4.0, 2.0])
+        self.assertTrue(torch.equal(boxes, expected))
+
+
+class TestInferenceCache(unittest.TestCase):
+    def test_thresholds(self):
+        torch.manual_seed(0)
+        mask_pred = torch.randn(2, 5, 6, 7)
+        # logits whose sigmoid rounds to exactly 0.5
+        mask_pred[0, 0, :2] = -1e-8
+        mask_pred[1, 3, 3:] = 1e-8
+        mask_prob = mask_pred.sigmoid()
+        cache = InferenceCache(torch.randn(2, 5, 4), mask_pred)
+
+        # panoptic inference thresholds probabilities, instance inference thresholds logits
+        self.assertTrue(torch.equal(cache.mask_area, (mask_prob >= 0.5).flatten(2).sum(-1)))
+        self.assertTrue(torch.equal(cache.mask_fg, mask_pred > 0))
+        self.assertNotEqual(cache.mask_area[0, 0].item(), cache.mask_fg[0, 0].sum().item())
+        expected_score = (mask_prob * (mask_pred > 0)).flatten(2).sum(-1) / ((mask_pred > 0).flatten(2).sum(-1) + 1e-6)
+        self.assertTrue(torch.equal(cache.mask_score, expected_score))
+
+    def test_get_and_release(self):
+        mask_cls, mask_pred = torch.randn(1, 3, 4), torch.randn(1, 3, 5, 5)
+        cache = InferenceCache(mask_cls, mask_pred)
+        self.assertIs(InferenceCache.get(cache, mask_cls, mask_pred), cache)
+        self.assertIsNot(InferenceCache.get(cache, mask_cls.clone(), mask_pred), cache)
+        self.assertIsNot(InferenceCache.get(None, mask_cls, mask_pred), cache)
+
+        mask_prob = cache.mask_prob
+        self.assertIs(cache.mask_prob, mask_prob)
+        cache.release("mask_prob", "mask_fg")
+        self.assertIsNot(cache.mask_prob, mask_prob)
+        self.assertTrue(torch.equal(cache.mask_prob, mask_prob))
+
+
+if __name__ == "__main__":
+    unittest.main()
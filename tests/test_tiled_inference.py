@@ -0,0 +1,175 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import unittest
+
+import torch
+from torch import nn
+
+from detectron2.config import get_cfg
+from detectron2.structures import Instances
+
+from mask2former import add_maskformer2_config
+from mask2former.tiled_inference import MaskFormerWithTiling, _tile_cores, _tile_starts
+
+NUM_CLASSES = 6
+HEIGHT, WIDTH = 50, 70
+
+
+def build_cfg():
+    cfg = get_cfg()
+    add_maskformer2_config(cfg)
+    cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_ON = True
+    cfg.MODEL.MASK_FORMER.TEST.PANOPTIC_ON = True
+    cfg.MODEL.MASK_FORMER.TEST.INSTANCE_ON = True
+    cfg.MODEL.MASK_FORMER.TEST.TILE_SIZE = 24
+    cfg.MODEL.MASK_FORMER.TEST.TILE_OVERLAP = 8
+    cfg.MODEL.MASK_FORMER.TEST.TILE_BATCH_SIZE = 5
+    return cfg
+
+
+class CroppingModel(nn.Module):
+    """
+    Returns the crops of fixed image-level outputs for every tile. The tile window is read from
+    the image, whose first two channels hold the y and x coordinates of every pixel.
+    Panoptic ids are relabeled per tile, as a model running on the tile alone would.
+    """
+
+    def __init__(self, sem_seg, panoptic_seg, segments_info, instances):
+        super().__init__()
+        self.sem_seg = sem_seg
+        self.panoptic_seg = panoptic_seg
+        self.segments_info = segments_info
+        self.instances = instances
+        self.generator = torch.Generator().manual_seed(0)
+
+    def forward(self, batched_inputs):
+        return [self.crop(x["image"]) for x in batched_inputs]
+
+    def crop(self, image):
+        y0, x0 = int(image[0, 0, 0]), int(image[1, 0, 0])
+        y1, x1 = int(image[0, -1, 0]) + 1, int(image[1, 0, -1]) + 1
+
+        panoptic_seg = self.panoptic_seg[y0:y1, x0:x1]
+        present = [s for s in self.segments_info if (panoptic_seg == s["id"]).any()]
+        order = torch.randperm(len(present), generator=self.generator).tolist()
+        tile_seg = torch.zeros_like(panoptic_seg)
+        tile_info = []
+        for local_id, k in enumerate(order, 1):
+            tile_seg[panoptic_seg == present[k]["id"]] = local_id
+            tile_info.append(dict(present[k], id=local_id))
+
+        masks = self.instances.pred_masks[:, y0:y1, x0:x1]
+        keep = masks.flatten(1).any(1)
+        instances = Instances((y1 - y0, x1 - x0))
+        instances.pred_masks = masks[keep].float()
+        instances.scores = self.instances.scores[keep]
+        instances.pred_classes = self.instances.pred_classes[keep]
+        return {
+            "sem_seg": self.sem_seg[:, y0:y1, x0:x1],
+            "panoptic_seg": (tile_seg, tile_info),
+            "instances": instances,
+        }
+
+
+def image_outputs():
+    torch.manual_seed(0)
+    sem_seg = torch.rand(NUM_CLASSES, HEIGHT, WIDTH)
+
+    # stuff covering the background, things of the same category across and inside tiles
+    panoptic_seg = torch.ones(HEIGHT, WIDTH, dtype=torch.int32)
+    panoptic_seg[:, 40:] = 2
+    segments_info = [
+        {"id": 1, "isthing": False, "category_id": 4},
+        {"id": 2, "isthing": False, "category_id": 5},
+    ]
+    for i, (y0, y1, x0, x1) in enumerate([(5, 30, 10, 45), (32, 48, 12, 20), (20, 22, 16, 18), (40, 50, 50, 70)]):
+        panoptic_seg[y0:y1, x0:x1] = i + 3
+        segments_info.append({"id": i + 3, "isthing": True, "category_id": 0})
+
+    # every instance has its own class, so that none of them should be merged with another
+    boxes = [(5, 30, 10, 45), (0, 50, 30, 33), (16, 20, 16, 20), (40, 50, 0, 70), (2, 8, 60, 68)]
+    instances = Instances((HEIGHT, WIDTH))
+    instances.pred_masks = torch.zeros(len(boxes), HEIGHT, WIDTH, dtype=torch.bool)
+    for i, (y0, y1, x0, x1) in enumerate(boxes):
+        instances.pred_masks[i, y0:y1, x0:x1] = True
+    instances.scores = torch.tensor([0.3, 0.9, 0.5, 0.7, 0.1])
+    instances.pred_classes = torch.arange(len(boxes))
+    return sem_seg, panoptic_seg, segments_info, instances
+
+
+def coordinate_image(height, width):
+    ys = torch.arange(height, dtype=torch.float32)[:, None].expand(height, width)
+    xs = torch.arange(width, dtype=torch.float32)[None, :].expand(height, width)
+    return torch.stack([ys, xs, torch.zeros(height, width)])
+
+
+class TestTiles(unittest.TestCase):
+    def test_cores_partition(self):
+        for size in (10, 24, 25, 50, 70, 101):
+            starts = _tile_starts(size, 24, 8)
+            self.assertEqual(starts[0], 0)
+            self.assertEqual(min(starts[-1] + 24, size), size)
+            cores = _tile_cores(starts, size, 24)
+            self.assertEqual(cores[0][0], 0)
+            self.assertEqual(cores[-1][1], size)
+            for (_, end), (start, _) in zip(cores[:-1], cores[1:]):
+                self.assertEqual(end, start)
+            for start, (core_start, core_end) in zip(starts, cores):
+                self.assertLessEqual(start, core_start)
+                self.assertLess(core_start, core_end)
+                self.assertLessEqual(core_end, start + 24)
+
+
+class TestStitching(unittest.TestCase):
+    def setUp(self):
+        self.sem_seg, self.panoptic_seg, self.segments_info, self.instances = image_outputs()
+        model = CroppingModel(self.sem_seg, self.panoptic_seg, self.segments_info, self.instances)
+        self.tiled_model = MaskFormerWithTiling(build_cfg(), model)
+
+    def test_semantic(self):
+        result = self.tiled_model([{"image": coordinate_image(HEIGHT, WIDTH)}])[0]
+        self.assertTrue(torch.allclose(result["sem_seg"], self.sem_seg, atol=1e-6))
+
+    def test_panoptic(self):
+        panoptic_seg, segments_info = self.tiled_model([{"image": coordinate_image(HEIGHT, WIDTH)}])[0][
+            "panoptic_seg"
+        ]
+        self.assertEqual(panoptic_seg.shape, (HEIGHT, WIDTH))
+        # the same segmentation, up to the segment ids
+        pairs = torch.unique(torch.stack([panoptic_seg.flatten(), self.panoptic_seg.flatten()]), dim=1)
+        self.assertEqual(pairs.shape[1], len(self.segments_info))
+        self.assertEqual(len(torch.unique(pairs[0])), len(self.segments_info))
+        self.assertEqual(len(torch.unique(pairs[1])), len(self.segments_info))
+
+        expected_info = {s["id"]: s for s in self.segments_info}
+        self.assertEqual(sorted(s["id"] for s in segments_info), sorted(pairs[0].tolist()))
+        stitched_to_expected = dict(pairs.T.tolist())
+        for s in segments_info:
+            expected = expected_info[stitched_to_expected[s["id"]]]
+            self.assertEqual(s["isthing"], expected["isthing"])
+            self.assertEqual(s["category_id"], expected["category_id"])
+
+    def test_instances(self):
+        instances = self.tiled_model([{"image": coordinate_image(HEIGHT, WIDTH)}])[0]["instances"]
+        order = self.instances.scores.argsort(descending=True)
+        self.assertEqual(instances.image_size, (HEIGHT, WIDTH))
+        self.assertTrue(torch.equal(instances.scores, self.instances.scores[order]))
+        self.assertTrue(torch.equal(instances.pred_classes, self.instances.pred_classes[order]))
+        self.assertTrue(torch.equal(instances.pred_masks > 0, self.instances.pred_masks[order]))
+        for box, mask in zip(instances.pred_boxes.tensor, instances.pred_masks > 0):
+            ys, xs = mask.nonzero(as_tuple=True)
+            self.assertEqual(box.tolist(), [xs.min(), ys.min(), xs.max() + 1, ys.max() + 1])
+
+    def test_output_size(self):
+        inputs = [
+            {"image": coordinate_image(HEIGHT, WIDTH), "height": 2 * HEIGHT, "width": 2 * WIDTH},
+            {"image": coordinate_image(20, 30)},
+        ]
+        results = self.tiled_model(inputs)
+        for result, size in zip(results, [(2 * HEIGHT, 2 * WIDTH), (20, 30)]):
+            self.assertEqual(result["sem_seg"].shape, (NUM_CLASSES,) + size)
+            self.assertEqual(result["panoptic_seg"][0].shape, size)
+            self.assertEqual(result["instances"].pred_masks.shape[1:], size)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Measure the latency and peak memory of the masked transformer decoder on random features,
+e.g. for 1024x1024 LSJ training or long-video inference. With --layers, compare instead the
+latency of one cross-attention and self-attention layer with every attention backend, for
+100 and 200 queries against the res5, res4 and res3 token counts.
+"""
+import argparse
+import time
+
+import torch
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from mask2former.modeling.transformer_decoder.mask2former_transformer_decoder import (
+    CrossAttentionLayer,
+    MultiScaleMaskedTransformerDecoder,
+    SelfAttentionLayer,
+    resolve_attention_backend,
+)
+
+
+def build_decoder(args):
+    kwargs = dict(
+        in_channels=args.hidden_dim,
+        mask_classification=True,
+        num_classes=args.num_classes,
+        hidden_dim=args.hidden_dim,
+        num_queries=args.num_queries,
+        nheads=8,
+        dim_feedforward=2048,
+        dec_layers=9,
+        pre_norm=False,
+        mask_dim=args.hidden_dim,
+        enforce_input_project=False,
+        attention_backend=args.attention_backend,
+    )
+    if args.num_frames > 0:
+        from mask2former_video.modeling.transformer_decoder.video_mask2former_transformer_decoder import (
+            VideoMultiScaleMaskedTransformerDecoder,
+        )
+
+        return VideoMultiScaleMaskedTransformerDecoder(num_frames=args.num_frames, **kwargs)
+    return MultiScaleMaskedTransformerDecoder(**kwargs)
+
+
+def random_inputs(args, device):
+    # videos are decoded one at a time at inference, frames are stacked in the batch dimension
+    n = args.num_frames if args.num_frames > 0 else args.batch_size
+    # res5, res4, res3 features and 1/4 scale mask features
+    x = [
+        torch.randn(n, args.hidden_dim, args.height // s, args.width // s, device=device)
+        for s in (32, 16, 8)
+    ]
+    mask_features = torch.randn(n, args.hidden_dim, args.height // 4, args.width // 4, device=device)
+    return x, mask_features
+
+
+def timeit(fn, num_iters, device):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_iters * 1000
+
+
+@torch.no_grad()
+def benchmark_layers(args, device):
+    backends = ["native"]
+    if resolve_attention_backend("sdpa") == "sdpa":
+        backends.append("sdpa")
+    print(f"{'queries':>8s} {'level':>6s} {'tokens':>7s} " + " ".join(f"{b + ' ms':>10s}" for b in backends))
+    for num_queries in (100, 200):
+        for name, stride in (("res5", 32), ("res4", 16), ("res3", 8)):
+            num_tokens = (args.height // stride) * (args.width // stride)
+            tgt = torch.randn(num_queries, args.batch_size, args.hidden_dim, device=device)
+            query_pos = torch.randn_like(tgt)
+            memory = torch.randn(num_tokens, args.batch_size, args.hidden_dim, device=device)
+            pos = torch.randn_like(memory)
+            memory_mask = torch.rand(args.batch_size, num_queries, num_tokens, device=device) > 0.5
+            times = []
+            for backend in backends:
+                torch.manual_seed(0)
+                cross = CrossAttentionLayer(args.hidden_dim, 8, attention_backend=backend).to(device).eval()
+                self_attn = SelfAttentionLayer(args.hidden_dim, 8, attention_backend=backend).to(device).eval()
+
+                def run():
+                    out = cross(tgt, memory, memory_mask=memory_mask, pos=pos, query_pos=query_pos)
+                    self_attn(out, query_pos=query_pos)
+
+                times.append(timeit(run, args.num_iters, device))
+            print(f"{num_queries:8d} {name:>6s} {num_tokens:7d} " + " ".join(f"{t:10.2f}" for t in times))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--num-frames", type=int, default=0, help="> 0 to benchmark the video decoder")
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("--num-classes", type=int, default=133)
+    parser.add_argument("--hidden-dim", type=int, default=256)
+    parser.add_argument("--train", action="store_true", help="forward and backward in training mode")
+    parser.add_argument("--attention-backend", default="native", choices=["native", "sdpa"])
+    parser.add_argument("--layers", action="store_true", help="compare the attention backends per layer")
+    parser.add_argument("--num-iters", type=int, default=10)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    assert not (args.train and args.num_frames > 0), "video training is not supported"
+
+    device = torch.device(args.device)
+    if args.layers:
+        benchmark_layers(args, device)
+        return
+    decoder = build_decoder(args).to(device).train(args.train)
+    x, mask_features = random_inputs(args, device)
+
+    def run():
+        with torch.set_grad_enabled(args.train):
+            out = decoder(x, mask_features)
+            if args.train:
+                loss = out["pred_masks"].mean() + sum(o["pred_masks"].mean() for o in out["aux_outputs"])
+                loss.backward()
+
+    run()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(args.num_iters):
+        run()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        peak = f", peak memory {(torch.cuda.max_memory_allocated() - base) / 2 ** 20:.1f} MB"
+    else:
+        peak = ""
+    print(f"{(time.perf_counter() - start) / args.num_iters * 1000:.2f} ms per forward{peak}")
+
+
+if __name__ == "__main__":
+    main()
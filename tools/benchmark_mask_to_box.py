@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Benchmark the cost of computing instance boxes from masks, relative to the rest of
+`MaskFormer.instance_inference`, on random predictions.
+"""
+import argparse
+import time
+from types import SimpleNamespace
+
+import torch
+
+from detectron2.structures import BitMasks
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from mask2former.maskformer_model import MaskFormer
+from mask2former.modeling.postprocessing import masks_to_boxes
+
+
+def benchmark(fn, num_iters, warmup=3):
+    for _ in range(warmup):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("--num-classes", type=int, default=80)
+    parser.add_argument("--topk", type=int, default=100)
+    parser.add_argument("--height", type=int, default=800)
+    parser.add_argument("--width", type=int, default=1216)
+    parser.add_argument("--num-iters", type=int, default=20)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    mask_cls = torch.randn(1, args.num_queries, args.num_classes + 1, device=args.device)
+    # smooth random masks, so that boxes are not trivially the full image
+    mask_pred = torch.nn.functional.interpolate(
+        torch.randn(1, args.num_queries, args.height // 32, args.width // 32, device=args.device) * 4,
+        size=(args.height, args.width),
+        mode="bilinear",
+        align_corners=False,
+    )
+
+    # only the attributes used by `instance_inference`
+    model = SimpleNamespace(
+        sem_seg_head=SimpleNamespace(num_classes=args.num_classes),
+        test_topk_per_image=args.topk,
+        panoptic_on=False,
+        pred_boxes=False,
+    )
+    instance_inference = MaskFormer.instance_inference.__get__(model)
+    model.instance_inference = instance_inference
+    pred_masks = instance_inference(mask_cls, mask_pred)[0].pred_masks > 0
+
+    results = {
+        "instance_inference (no boxes)": benchmark(lambda: instance_inference(mask_cls, mask_pred), args.num_iters),
+        "masks_to_boxes": benchmark(lambda: masks_to_boxes(pred_masks), args.num_iters),
+        "masks_to_boxes (1/4 resolution)": benchmark(
+            lambda: masks_to_boxes(pred_masks[:, ::4, ::4], (4, 4)), args.num_iters
+        ),
+        "BitMasks.get_bounding_boxes": benchmark(
+            lambda: BitMasks(pred_masks).get_bounding_boxes(), args.num_iters
+        ),
+    }
+    assert torch.equal(masks_to_boxes(pred_masks), BitMasks(pred_masks).get_bounding_boxes().tensor)
+
+    print(f"{len(pred_masks)} masks of {args.height}x{args.width} on {args.device}")
+    base = results["instance_inference (no boxes)"]
+    for name, ms in results.items():
+        print(f"{name:35s} {ms:8.3f} ms  ({ms / base:.1%} of instance_inference)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Check the assignments of the torch auction solver against scipy on random matching problems,
+and compare their speed. With --sampling, compare instead the time and peak memory of sampling
+the masks of one image for all layers, with per-mask point copies and float targets, and with
+the shared points of `shared_point_sample`.
+"""
+import argparse
+import time
+
+import torch
+from scipy.optimize import linear_sum_assignment
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from detectron2.projects.point_rend.point_features import point_sample
+
+from mask2former.modeling.assignment import auction_linear_sum_assignment
+from mask2former.modeling.matcher import shared_point_sample
+
+
+def random_costs(num_problems, num_queries, max_targets, device):
+    # costs in the range of the matcher: -prob + sigmoid CE + dice with unit weights
+    costs = []
+    for _ in range(num_problems):
+        num_targets = int(torch.randint(1, max_targets + 1, (1,)))
+        cost_class = -torch.rand(num_queries, num_targets).softmax(0)
+        cost_mask = torch.rand(num_queries, num_targets) * 2
+        cost_dice = torch.rand(num_queries, num_targets)
+        costs.append((cost_class + cost_mask + cost_dice).to(device))
+    return costs
+
+
+def benchmark_sampling(args):
+    device = torch.device(args.device)
+    num_targets = args.max_targets
+    pred_masks = [
+        torch.randn(args.num_queries, args.height // 4, args.width // 4, device=device)
+        for _ in range(args.num_layers)
+    ]
+    tgt_masks = torch.rand(num_targets, args.height, args.width, device=device) > 0.5
+
+    def run_repeat():
+        # sampling of the original matcher: new points, a float copy of the targets and
+        # per-mask point copies for every layer
+        for out_mask in pred_masks:
+            point_coords = torch.rand(1, args.num_points, 2, device=device)
+            tgt = tgt_masks.to(out_mask)[:, None]
+            point_sample(tgt, point_coords.repeat(num_targets, 1, 1), align_corners=False)
+            point_sample(out_mask[:, None], point_coords.repeat(len(out_mask), 1, 1), align_corners=False)
+
+    def run_shared():
+        point_coords = torch.rand(args.num_points, 2, device=device)
+        shared_point_sample(tgt_masks, point_coords)
+        for out_mask in pred_masks:
+            shared_point_sample(out_mask, point_coords)
+
+    for name, fn in [("repeat", run_repeat), ("shared", run_shared)]:
+        fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        for _ in range(args.num_iters):
+            fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            peak = f", peak {(torch.cuda.max_memory_allocated() - base) / 2 ** 20:.1f} MB"
+        else:
+            peak = ""
+        print(f"{name:8s} {(time.perf_counter() - start) / args.num_iters * 1000:8.2f} ms per image{peak}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-problems", type=int, default=160, help="e.g. batch size x decoder layers")
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("--max-targets", type=int, default=100)
+    parser.add_argument("--num-iters", type=int, default=5)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--sampling", action="store_true", help="benchmark the point sampling instead")
+    parser.add_argument("--num-layers", type=int, default=10)
+    parser.add_argument("--num-points", type=int, default=112 * 112)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    if args.sampling:
+        benchmark_sampling(args)
+        return
+    costs = random_costs(args.num_problems, args.num_queries, args.max_targets, args.device)
+
+    # correctness: the total cost of every assignment must be optimal
+    auction = auction_linear_sum_assignment(costs)
+    num_failed = sum(r is None for r in auction)
+    max_gap = 0.0
+    for C, r in zip(costs, auction):
+        C = C.cpu()
+        i, j = linear_sum_assignment(C)
+        optimal = float(C[i, j].sum())
+        if r is not None:
+            assert len(r[0]) == len(i), (len(r[0]), len(i))
+            max_gap = max(max_gap, float(C[r[0].cpu(), r[1].cpu()].sum()) - optimal)
+    print(f"{args.num_problems} problems of {args.num_queries} queries x <= {args.max_targets} targets")
+    print(f"auction: {num_failed} not converged, max cost above the scipy optimum: {max_gap:.2e}")
+
+    def run_scipy():
+        for C in costs:
+            linear_sum_assignment(C.cpu())
+
+    def run_auction():
+        auction_linear_sum_assignment(costs)
+
+    for name, fn in [("scipy", run_scipy), ("auction", run_auction)]:
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(args.num_iters):
+            fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        print(f"{name:8s} {(time.perf_counter() - start) / args.num_iters * 1000:8.2f} ms per batch of problems")
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,13 @@ from pycocotools import mask as maskUtils
 
 from panopticapi.evaluation import PQStat
 
+# fmt: off
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from mask2former.utils.misc import id_lookup_table
+
 
 def default_argument_parser():
     """
@@ -161,6 +168,15 @@ def main():
     ignore_label = meta.ignore_label
     conf_matrix = np.zeros((num_classes + 1, num_classes + 1), dtype=np.int64)
 
+    # map dataset ids of predictions to contiguous ids with a single gather
+    if hasattr(meta, "stuff_dataset_id_to_contiguous_id"):
+        category_table = id_lookup_table(meta.stuff_dataset_id_to_contiguous_id)
+    else:
+        category_table = None
+    # as in a per-annotation loop, an annotation of unknown category keeps the category of the
+    # previous annotation, possibly of the previous image
+    category_id = None
+
     categories = {}
     for i in range(num_classes):
         categories[i] = {"id": i, "name": class_names[i], "isthing": 0}
@@ -183,15 +199,26 @@ def main():
         # get predictions
         segm_dt = np.zeros_like(segm_gt)
         anns = imgToAnns[image_id]
-        for ann in anns:
+        if anns:
             # map back category_id
-            if hasattr(meta, "stuff_dataset_id_to_contiguous_id"):
-                if ann["category_id"] in meta.stuff_dataset_id_to_contiguous_id:
-                    category_id = meta.stuff_dataset_id_to_contiguous_id[ann["category_id"]]
-            else:
-                category_id = ann["category_id"]
-            mask = maskUtils.decode(ann["segmentation"])
-            segm_dt[mask > 0] = category_id
+            category_ids = np.array([ann["category_id"] for ann in anns], dtype=np.int64)
+            if category_table is not None:
+                known = (category_ids >= 0) & (category_ids < len(category_table))
+                known[known] = category_table[category_ids[known]] >= 0
+                category_ids[known] = category_table[category_ids[known]]
+                # index of the last known annotation up to every annotation, -1 if none
+                previous = np.maximum.accumulate(np.where(known, np.arange(len(anns)), -1))
+                if previous[0] < 0:
+                    assert category_id is not None, "Unknown category id {}".format(anns[0]["category_id"])
+                    fill = category_id
+                else:
+                    fill = -1
+                category_ids = np.where(previous >= 0, category_ids[np.maximum(previous, 0)], fill)
+            category_id = category_ids[-1]
+            # (H, W, N) masks; later annotations overwrite earlier ones
+            masks = maskUtils.decode([ann["segmentation"] for ann in anns]) > 0
+            last = masks.shape[-1] - 1 - masks[..., ::-1].argmax(-1)
+            segm_dt = np.where(masks.any(-1), category_ids[last], segm_dt)
 
         # miou
         gt = segm_gt.copy()
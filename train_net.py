@@ -21,6 +21,7 @@ from collections import OrderedDict
 from typing import Any, Dict, List, Set
 
 import torch
+from torch.nn.parallel import DistributedDataParallel
 
 import detectron2.utils.comm as comm
 from detectron2.checkpoint import DetectionCheckpointer
@@ -34,12 +35,13 @@ from detectron2.engine import (
 )
 from detectron2.evaluation import (
     CityscapesInstanceEvaluator,
-    CityscapesSemSegEvaluator,
     COCOEvaluator,
     COCOPanopticEvaluator,
+    DatasetEvaluator,
     DatasetEvaluators,
     LVISEvaluator,
-    SemSegEvaluator,
+    inference_on_dataset,
+    print_csv_format,
     verify_results,
 )
 from detectron2.projects.deeplab import add_deeplab_config, build_lr_scheduler
@@ -48,17 +50,38 @@ from detectron2.utils.logger import setup_logger
 
 # MaskFormer
 from mask2former import (
+    BucketedInferenceLoader,
     COCOInstanceNewBaselineDatasetMapper,
     COCOPanopticNewBaselineDatasetMapper,
     InstanceSegEvaluator,
+    LabelMapCityscapesSemSegEvaluator,
+    LabelMapSemSegEvaluator,
     MaskFormerInstanceDatasetMapper,
     MaskFormerPanopticDatasetMapper,
     MaskFormerSemanticDatasetMapper,
+    MaskFormerWithTiling,
     SemanticSegmentorWithTTA,
     add_maskformer2_config,
 )
 
 
+def get_size_divisibility(model):
+    """
+    Returns:
+        int: the size divisibility of a MaskFormer, possibly wrapped in DDP, tiled or TTA
+            inference, or None if `model` has none
+    """
+    while True:
+        if isinstance(model, DistributedDataParallel):
+            model = model.module
+        elif hasattr(model, "size_divisibility"):
+            return model.size_divisibility
+        elif hasattr(model, "model"):
+            model = model.model
+        else:
+            return None
+
+
 class Trainer(DefaultTrainer):
     """
     Extension of the Trainer class adapted to MaskFormer.
@@ -80,7 +103,7 @@ class Trainer(DefaultTrainer):
         # semantic segmentation
         if evaluator_type in ["sem_seg", "ade20k_panoptic_seg"]:
             evaluator_list.append(
-                SemSegEvaluator(
+                LabelMapSemSegEvaluator(
                     dataset_name,
                     distributed=True,
                     output_dir=output_folder,
@@ -102,12 +125,12 @@ class Trainer(DefaultTrainer):
         if evaluator_type == "coco_panoptic_seg" and cfg.MODEL.MASK_FORMER.TEST.INSTANCE_ON:
             evaluator_list.append(COCOEvaluator(dataset_name, output_dir=output_folder))
         if evaluator_type == "coco_panoptic_seg" and cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_ON:
-            evaluator_list.append(SemSegEvaluator(dataset_name, distributed=True, output_dir=output_folder))
+            evaluator_list.append(LabelMapSemSegEvaluator(dataset_name, distributed=True, output_dir=output_folder))
         # Mapillary Vistas
         if evaluator_type == "mapillary_vistas_panoptic_seg" and cfg.MODEL.MASK_FORMER.TEST.INSTANCE_ON:
             evaluator_list.append(InstanceSegEvaluator(dataset_name, output_dir=output_folder))
         if evaluator_type == "mapillary_vistas_panoptic_seg" and cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_ON:
-            evaluator_list.append(SemSegEvaluator(dataset_name, distributed=True, output_dir=output_folder))
+            evaluator_list.append(LabelMapSemSegEvaluator(dataset_name, distributed=True, output_dir=output_folder))
         # Cityscapes
         if evaluator_type == "cityscapes_instance":
             assert (
@@ -118,13 +141,13 @@ class Trainer(DefaultTrainer):
             assert (
                 torch.cuda.device_count() > comm.get_rank()
             ), "CityscapesEvaluator currently do not work with multiple machines."
-            return CityscapesSemSegEvaluator(dataset_name)
+            return LabelMapCityscapesSemSegEvaluator(dataset_name)
         if evaluator_type == "cityscapes_panoptic_seg":
             if cfg.MODEL.MASK_FORMER.TEST.SEMANTIC_ON:
                 assert (
                     torch.cuda.device_count() > comm.get_rank()
                 ), "CityscapesEvaluator currently do not work with multiple machines."
-                evaluator_list.append(CityscapesSemSegEvaluator(dataset_name))
+                evaluator_list.append(LabelMapCityscapesSemSegEvaluator(dataset_name))
             if cfg.MODEL.MASK_FORMER.TEST.INSTANCE_ON:
                 assert (
                     torch.cuda.device_count() > comm.get_rank()
@@ -172,6 +195,72 @@ class Trainer(DefaultTrainer):
             mapper = None
             return build_detection_train_loader(cfg, mapper=mapper)
 
+    @classmethod
+    def build_test_loader(cls, cfg, dataset_name, size_divisibility=None):
+        """
+        Args:
+            size_divisibility (int or None): padding of the bucketed test loader. Defaults to
+                `MODEL.MASK_FORMER.SIZE_DIVISIBILITY`, which is -1 when the model falls back to
+                the one of its backbone; :meth:`test` passes the one of the model instead.
+        """
+        data_loader = super().build_test_loader(cfg, dataset_name)
+        if cfg.DATALOADER.TEST_BATCH_SIZE > 1:
+            if size_divisibility is None:
+                size_divisibility = cfg.MODEL.MASK_FORMER.SIZE_DIVISIBILITY
+            data_loader = BucketedInferenceLoader(
+                data_loader,
+                cfg.DATALOADER.TEST_BATCH_SIZE,
+                aspect_ratio_boundaries=cfg.DATALOADER.TEST_ASPECT_RATIO_BOUNDARIES,
+                size_boundaries=cfg.DATALOADER.TEST_SIZE_BOUNDARIES,
+                size_divisibility=max(size_divisibility, 0),
+            )
+        return data_loader
+
+    @classmethod
+    def test(cls, cfg, model, evaluators=None):
+        """
+        Same as :meth:`DefaultTrainer.test`, but builds the test loaders with the size
+        divisibility of `model`.
+        """
+        logger = logging.getLogger(__name__)
+        if isinstance(evaluators, DatasetEvaluator):
+            evaluators = [evaluators]
+        if evaluators is not None:
+            assert len(cfg.DATASETS.TEST) == len(evaluators), "{} != {}".format(
+                len(cfg.DATASETS.TEST), len(evaluators)
+            )
+
+        size_divisibility = get_size_divisibility(model)
+        results = OrderedDict()
+        for idx, dataset_name in enumerate(cfg.DATASETS.TEST):
+            data_loader = cls.build_test_loader(cfg, dataset_name, size_divisibility)
+            if evaluators is not None:
+                evaluator = evaluators[idx]
+            else:
+                try:
+                    evaluator = cls.build_evaluator(cfg, dataset_name)
+                except NotImplementedError:
+                    logger.warn(
+                        "No evaluator found. Use `DefaultTrainer.test(evaluators=)`, "
+                        "or implement its `build_evaluator` method."
+                    )
+                    results[dataset_name] = {}
+                    continue
+            results_i = inference_on_dataset(model, data_loader, evaluator)
+            results[dataset_name] = results_i
+            if comm.is_main_process():
+                assert isinstance(
+                    results_i, dict
+                ), "Evaluator must return a dict on the main process. Got {} instead.".format(
+                    results_i
+                )
+                logger.info("Evaluation results for {} in csv format:".format(dataset_name))
+                print_csv_format(results_i)
+
+        if len(results) == 1:
+            results = list(results.values())[0]
+        return results
+
     @classmethod
     def build_lr_scheduler(cls, cfg, optimizer):
         """
@@ -303,7 +392,10 @@ def main(args):
         DetectionCheckpointer(model, save_dir=cfg.OUTPUT_DIR).resume_or_load(
             cfg.MODEL.WEIGHTS, resume=args.resume
         )
-        res = Trainer.test(cfg, model)
+        if cfg.MODEL.MASK_FORMER.TEST.TILED_INFERENCE:
+            res = Trainer.test(cfg, MaskFormerWithTiling(cfg, model))
+        else:
+            res = Trainer.test(cfg, model)
         if cfg.TEST.AUG.ENABLED:
             res.update(Trainer.test_with_TTA(cfg, model))
         if comm.is_main_process():